@@ -0,0 +1,126 @@
+"""Test setup: the workflow modules use flat imports from the workflows
+directory.
+"""
+
+import logging
+import os
+import stat
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+WORKFLOWS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "workflows"
+)
+sys.path.insert(0, WORKFLOWS)
+
+# Log to stderr instead of ../logs/workflows.log, logger_base's basicConfig is
+# then a no-op
+logging.basicConfig(level=logging.INFO)
+os.environ.setdefault(
+    "WORKFLOW_TELEMETRY",
+    os.path.join(
+        os.environ.get("TMPDIR", "/tmp"), "workflows-test-telemetry.jsonl"
+    ),
+)
+
+
+# Numbers the jobs from 4242 in submission order and logs the arguments of each
+FAKE_SBATCH = """#!/bin/sh
+n=0
+[ -f "{log}" ] && n=$(wc -l < "{log}")
+echo "$@" >> "{log}"
+echo "$((4242 + n));cluster"
+"""
+# Reports every job of the -j list, the last argument, as completed
+FAKE_SACCT = """#!/bin/sh
+for jobs; do :; done
+echo "$jobs" | tr ',' '\\n' | sed 's/$/|COMPLETED/'
+"""
+
+
+def _fake_command(bin_dir, name, text):
+    path = bin_dir / name
+    path.write_text(text)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+
+@pytest.fixture
+def fake_slurm(tmp_path, monkeypatch):
+    """Puts a fake sbatch, squeue and sacct first on PATH and sets ROOT_DIR to
+    tmp_path.
+
+    Returns the file logging the arguments of every sbatch call, one line per
+    job.
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    log = tmp_path / "sbatch.log"
+    _fake_command(bin_dir, "sbatch", FAKE_SBATCH.format(log=log))
+    _fake_command(bin_dir, "squeue", "#!/bin/sh\n")
+    _fake_command(bin_dir, "sacct", FAKE_SACCT)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("ROOT_DIR", str(tmp_path))
+    from service import slurm
+
+    tracker = slurm.JobTracker(
+        poll_interval=0.01, history_path=str(tmp_path / "history.jsonl")
+    )
+    monkeypatch.setattr(slurm, "tracker", tracker)
+    return log
+
+
+class ObjectServer:
+    """Serves one object per path with ETag, Range and If-Range support."""
+
+    def __init__(self):
+        self.objects = {}
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests.append((self.path, dict(self.headers)))
+                data, etag = server.objects[self.path]
+                start = 0
+                rng = self.headers.get("Range")
+                if rng and self.headers.get("If-Range", etag) == etag:
+                    start = int(rng.split("=")[1].rstrip("-"))
+                    if start >= len(data):
+                        self.send_response(416)
+                        self.send_header(
+                            "Content-Range", f"bytes */{len(data)}"
+                        )
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header(
+                        "Content-Range",
+                        f"bytes {start}-{len(data) - 1}/{len(data)}",
+                    )
+                else:
+                    self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(data) - start))
+                self.end_headers()
+                self.wfile.write(data[start:])
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return self.base + path
+
+
+@pytest.fixture
+def server():
+    srv = ObjectServer()
+    yield srv
+    srv.httpd.shutdown()
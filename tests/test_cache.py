@@ -0,0 +1,115 @@
+import os
+from pathlib import Path
+
+from feedbackloop import cache
+from feedbackloop.cache import ObjectCache, version_of
+
+
+def test_unknown_version_is_a_cache_miss(server, tmp_path):
+    assert version_of(None) is None
+    assert version_of({"size": 10}) is None
+    assert version_of({"ETag": '"abc"'}) == "abc"
+    assert (
+        version_of({"size": 10, "LastModified": "2024-01-01"})
+        == "10-2024-01-01"
+    )
+
+    server.objects["/a.tif"] = (b"first", '"v1"')
+    store = ObjectCache(str(tmp_path / "cache"))
+    output_dir = tmp_path / "raw"
+    assert (
+        store.fetch(server.url("/a.tif"), None, str(output_dir))["status"]
+        == "done"
+    )
+    server.objects["/a.tif"] = (b"second", '"v2"')
+    assert (
+        store.fetch(server.url("/a.tif"), None, str(output_dir))["status"]
+        == "done"
+    )
+    assert (output_dir / "a.tif").read_bytes() == b"second"
+    assert store.size() == 0
+
+
+def test_link_race_with_eviction_refetches(server, tmp_path, monkeypatch):
+    server.objects["/a.tif"] = (b"data", '"v1"')
+    store = ObjectCache(str(tmp_path / "cache"))
+    url = server.url("/a.tif")
+    store.put(url, "v1", str(_write(tmp_path / "staged", b"data")))
+    # Another process evicts the object between get() and link()
+    get = store.get
+
+    def get_then_evict(*args):
+        path = get(*args)
+        store.evict(0)
+        return path
+
+    monkeypatch.setattr(store, "get", get_then_evict)
+    result = store.fetch(url, "v1", str(tmp_path / "raw"))
+    assert result["status"] == "done"
+    assert (tmp_path / "raw" / "a.tif").read_bytes() == b"data"
+
+
+def test_fetch_links_before_publishing(server, tmp_path, monkeypatch):
+    server.objects["/a.tif"] = (b"data", '"v1"')
+    store = ObjectCache(str(tmp_path / "cache"))
+    put = store.put
+
+    def put_then_evict(*args):
+        path = put(*args)
+        store.evict(0)
+        return path
+
+    monkeypatch.setattr(store, "put", put_then_evict)
+    result = store.fetch(server.url("/a.tif"), "v1", str(tmp_path / "raw"))
+    assert result["status"] == "done"
+    assert (tmp_path / "raw" / "a.tif").read_bytes() == b"data"
+
+
+def test_symlinked_object_evicted_after_publishing(
+    server, tmp_path, monkeypatch
+):
+    server.objects["/a.tif"] = (b"data", '"v1"')
+    store = ObjectCache(str(tmp_path / "cache"))
+    monkeypatch.setattr(cache.os, "link", _cross_device_link)
+    put = store.put
+
+    def put_then_evict(*args):
+        path = put(*args)
+        store.evict(0)
+        return path
+
+    monkeypatch.setattr(store, "put", put_then_evict)
+    result = store.fetch(server.url("/a.tif"), "v1", str(tmp_path / "raw"))
+    assert result["status"] == "done"
+    destination = tmp_path / "raw" / "a.tif"
+    assert not destination.is_symlink() and destination.read_bytes() == b"data"
+
+
+def _cross_device_link(src, dst):
+    if not os.path.exists(src):
+        raise FileNotFoundError(src)
+    raise OSError(cache.errno.EXDEV, "Invalid cross-device link")
+
+
+def _write(path, data):
+    path.write_bytes(data)
+    return path
+
+
+def test_partial_download_resumes_across_runs(server, tmp_path):
+    data = os.urandom(100_000)
+    server.objects["/a.tif"] = (data, '"v1"')
+    store = ObjectCache(str(tmp_path / "cache"))
+    url = server.url("/a.tif")
+    # A previous run stopped half way through the download
+    staging = store.staging_dir(url)
+    os.makedirs(staging)
+    part = Path(staging) / "a.tif.part"
+    _write(part, data[:40_000])
+    _write(part.with_suffix(".part.validator"), b'"v1"')
+    result = store.fetch(url, "v1", str(tmp_path / "raw"))
+    assert result["status"] == "done" and result["bytes"] == 60_000
+    assert server.requests[-1][1]["Range"] == "bytes=40000-"
+    assert (tmp_path / "raw" / "a.tif").read_bytes() == data
+    # Stored objects leave no staging data behind
+    assert not os.path.exists(staging)
@@ -0,0 +1,54 @@
+import shlex
+
+from state import chains
+
+COMMAND = (
+    "python3 -m hmsc.run_gibbs_sampler --input models/{model}.rds "
+    "--output models/{model}_Chain{chain}.rds --samples 10\n"
+)
+COMMANDS = "".join(
+    COMMAND.format(model=model, chain=chain)
+    for model, chain in (("M1", 1), ("M1", 2), ("M2", 1), ("M3", 1))
+)
+
+
+def _merge_commands(log):
+    commands = []
+    for call in log.read_text().splitlines():
+        script = open(call.split()[-1]).read()
+        if chains.MERGE_SCRIPT in script:
+            line = next(
+                line
+                for line in script.splitlines()
+                if chains.MERGE_SCRIPT in line
+            )
+            commands.append((call, shlex.split(line)[3:]))
+    return commands
+
+
+def test_refit_merges_each_model_on_its_own(fake_slurm, tmp_path):
+    model_dir = tmp_path / "models"
+    model_dir.mkdir()
+    (model_dir / chains.COMMANDS_FILE).write_text(COMMANDS)
+    for name in ("M1.rds", "M2.rds", "M3.rds"):
+        (model_dir / name).write_bytes(b"input")
+    # M1 needs one chain, M3 is complete
+    for name in ("M1_Chain1.rds", "M3_Chain1.rds"):
+        (model_dir / name).write_bytes(b"posterior")
+
+    status = chains.refit(
+        str(model_dir / chains.COMMANDS_FILE),
+        str(tmp_path / "logs"),
+        root=str(tmp_path),
+        wait=False,
+    )
+    array_id = status["chains_job"].job_id
+    merges = dict(
+        (tuple(args[1:]), call) for call, args in _merge_commands(fake_slurm)
+    )
+    assert set(merges) == {("M1",), ("M2",), ("M3",)}
+    assert f"afterok:{array_id}_0" in merges[("M1",)]
+    assert f"afterok:{array_id}_1" in merges[("M2",)]
+    assert "afterok" not in merges[("M3",)]
+    for future in [status["chains_job"], *status["merge_jobs"].values()]:
+        future.result(timeout=10)
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import socket
+
+import pytest
+
+from feedbackloop.chelsa import (
+    ENDPOINT,
+    _sense_batched,
+    discard_stale_parts,
+    entry_url,
+    s3_path,
+    sense,
+)
+from feedbackloop.download import PART_SUFFIX, VALIDATOR_SUFFIX
+
+
+def test_s3_path_and_entry_url():
+    assert s3_path(f"{ENDPOINT}chelsa/a.tif") == "chelsa/a.tif"
+    assert s3_path("/chelsa/a.tif\n") == "chelsa/a.tif"
+    assert entry_url("chelsa/a.tif") == f"{ENDPOINT}chelsa/a.tif"
+    # URLs on other hosts are kept as they are
+    foreign = "https://example.org/data/b.tif"
+    assert s3_path(foreign) == foreign
+    assert entry_url(s3_path(foreign)) == foreign
+
+
+def test_discard_stale_parts(tmp_path):
+    for name, validator in (
+        ("same.tif", '"e1"'),
+        ("changed.tif", '"old"'),
+        ("bare.tif", None),
+    ):
+        (tmp_path / (name + PART_SUFFIX)).write_bytes(b"x")
+        if validator:
+            (tmp_path / (name + PART_SUFFIX + VALIDATOR_SUFFIX)).write_text(
+                validator
+            )
+    snapshot = [
+        {"name": "chelsa/same.tif", "ETag": '"e1"'},
+        {"name": "chelsa/changed.tif", "ETag": '"new"'},
+        {"name": "chelsa/bare.tif", "ETag": '"e3"'},
+    ]
+    discard_stale_parts(
+        ["chelsa/same.tif", "chelsa/changed.tif", "chelsa/bare.tif"],
+        snapshot,
+        tmp_path,
+    )
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "same.tif" + PART_SUFFIX,
+        "same.tif" + PART_SUFFIX + VALIDATOR_SUFFIX,
+    ]
+
+
+@pytest.fixture(scope="module")
+def s3_endpoint():
+    boto3 = pytest.importorskip("boto3")
+    server_module = pytest.importorskip("moto.server")
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = server_module.ThreadedMotoServer(port=port, verbose=False)
+    server.start()
+    endpoint = f"http://127.0.0.1:{port}/"
+    client = boto3.client(
+        "s3",
+        endpoint_url=endpoint,
+        region_name="us-east-1",
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+    )
+    client.create_bucket(Bucket="envicloud")
+    client.put_bucket_policy(
+        Bucket="envicloud",
+        Policy=json.dumps(
+            {
+                "Statement": [
+                    {
+                        "Effect": "Allow",
+                        "Principal": "*",
+                        "Action": "s3:*",
+                        "Resource": [
+                            "arn:aws:s3:::envicloud",
+                            "arn:aws:s3:::envicloud/*",
+                        ],
+                    }
+                ]
+            }
+        ),
+    )
+    for i in range(30):
+        client.put_object(
+            Bucket="envicloud",
+            Key=f"chelsa/{i % 3}/obj_{i}.tif",
+            Body=b"x" * (100 + i),
+        )
+    yield endpoint
+    server.stop()
+
+
+def test_sense_batched_uses_listings(s3_endpoint):
+    paths = [f"envicloud/chelsa/{i % 3}/obj_{i}.tif" for i in range(30)]
+    snapshot, calls = asyncio.run(
+        _sense_batched(paths, s3_endpoint, max_concurrency=8)
+    )
+    # One listing per prefix and no HEAD per object
+    assert calls == 3
+    assert [m["name"] for m in snapshot] == paths
+    assert [m["size"] for m in snapshot] == [100 + i for i in range(30)]
+    assert all(
+        m["ETag"] and isinstance(m["LastModified"], str) for m in snapshot
+    )
+
+
+def test_sense_modes_agree(s3_endpoint):
+    paths = [f"envicloud/chelsa/{i % 3}/obj_{i}.tif" for i in range(0, 30, 7)]
+    batched = sense(paths, endpoint=s3_endpoint)
+    serial = sense(paths, endpoint=s3_endpoint, batched=False)
+    # The same records, so switching modes does not change the snapshot
+    assert batched == serial
+    assert len(batched) == len(paths)
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_vanished_objects_are_skipped(s3_endpoint, batched):
+    paths = ["envicloud/chelsa/0/obj_0.tif", "envicloud/chelsa/0/gone.tif"]
+    snapshot = sense(paths, endpoint=s3_endpoint, batched=batched)
+    assert [m["name"] for m in snapshot] == paths[:1]
@@ -0,0 +1,48 @@
+import json
+import os
+
+from service import clean
+
+
+def _touch(path, mtime=None):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x")
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+        os.utime(path.parent, (mtime, mtime))
+
+
+def test_keep_last_leaves_protected_runs_untouched(tmp_path):
+    (tmp_path / "new" / "empty").mkdir(parents=True)
+    _touch(tmp_path / "new" / "a.txt")
+    _touch(tmp_path / "old" / "sub" / "b.txt", mtime=1)
+    os.utime(tmp_path / "old", (1, 1))
+    summary = clean.clean(str(tmp_path), keep_last=1)
+    assert summary["files"] == 1 and summary["kept"] == 1
+    # The old run is gone, the empty directory of the protected run is kept
+    assert sorted(os.listdir(tmp_path)) == ["new"]
+    assert (tmp_path / "new" / "empty").is_dir()
+
+
+def test_scan_skips_vanished_paths(tmp_path):
+    assert clean._scan(str(tmp_path / "missing")) == []
+    assert clean._newest([str(tmp_path / "missing")], 1) == []
+
+
+def test_manifest_matches_path_fields_only(tmp_path):
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(
+        json.dumps(
+            [
+                {
+                    "name": "chelsa/keep.tif",
+                    "ETag": "etagfile",
+                    "title": "titlefile",
+                },
+                {"full_path": "H:\\data\\clc.gdb", "files": ["listed.tif"]},
+            ]
+        )
+    )
+    names = clean._manifest_names(str(manifest))
+    assert {"keep.tif", "clc.gdb", "listed.tif", "manifest.json"} <= names
+    assert not names & {"etagfile", "titlefile"}
@@ -0,0 +1,226 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from feedbackloop import corine
+from feedbackloop.corine import CLMSSession
+from feedbackloop.store import SnapshotStore
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, body):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        tokens = self.server.clms.tokens
+        if tokens is None:
+            return True
+        token = self.headers.get("Authorization", "")
+        return token.removeprefix("Bearer ") in tokens
+
+    def _mint(self, body):
+        clms = self.server.clms
+        grant = parse_qs(body.decode())["assertion"][0]
+        jwt.decode(
+            grant,
+            clms.key.public_key(),
+            algorithms=["RS256"],
+            audience=clms.token_uri,
+        )
+        clms.minted += 1
+        token = f"token{clms.minted}"
+        clms.tokens.add(token)
+        self._send(200, {"access_token": token, "expires_in": 3600})
+
+    def do_POST(self):
+        clms = self.server.clms
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path == "/token":
+            return self._mint(data)
+        if not self._authorized():
+            return self._send(401, {"error": "Unauthorized"})
+        clms.posted.append(json.loads(data))
+        task_id = f"t{len(clms.posted)}"
+        self._send(200, {"TaskIds": [{"TaskID": task_id}]})
+
+    def do_GET(self):
+        clms = self.server.clms
+        if not self._authorized():
+            return self._send(401, {"error": "Unauthorized"})
+        if self.path.endswith("@datarequest_search"):
+            return self._send(200, clms.status)
+        if "@search" in self.path:
+            return self._send(200, {"items": clms.catalogue})
+        time.sleep(clms.file_delay)
+        self._send(200, clms.files[self.path])
+
+
+class CLMSServer:
+    """Serves the CLMS data request endpoints and the files they produce."""
+
+    def __init__(self):
+        self.catalogue = []
+        self.status = {}
+        self.files = {}
+        self.file_delay = 0.0
+        self.posted = []
+        # Access tokens accepted by the API, None to skip authorization
+        self.tokens = None
+        self.minted = 0
+        self.key = None
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.clms = self
+        self.api = f"http://127.0.0.1:{self.httpd.server_port}/api/"
+        self.token_uri = self.api.replace("/api/", "/token")
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+
+TITLE = "CORINE Land Cover 2018 (raster 100 m), Europe, 6-yearly"
+
+
+def _dataset(uid, file_id, title=TITLE):
+    files = {"items": [{"@id": file_id, "type": "Raster"}]}
+    return {
+        "UID": uid,
+        "title": title,
+        "downloadable_files": files,
+        "@id": f"https://clms/{uid}",
+    }
+
+
+@pytest.fixture
+def clms(tmp_path):
+    server = CLMSServer()
+    SnapshotStore(str(tmp_path / "logs")).append(
+        [_dataset("d1", "f1"), _dataset("d2", "f2")]
+    )
+    yield server
+    server.httpd.shutdown()
+
+
+@pytest.fixture
+def credentials(clms, tmp_path):
+    """Writes a service key for the mock token endpoint."""
+    clms.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    clms.tokens = set()
+    pem = clms.key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    service_key = {
+        "client_id": "client",
+        "user_id": "user",
+        "token_uri": clms.token_uri,
+        "private_key": pem.decode(),
+    }
+    path = tmp_path / "key.json"
+    path.write_text(json.dumps(service_key))
+    return str(path)
+
+
+def _intaker(server, tmp_path, **kwargs):
+    session = CLMSSession(token="token", api=server.api, token_cache=None)
+    options = dict(poll=0.01, max_poll=0.01, timeout=30)
+    return corine.intaker(
+        session,
+        str(tmp_path / "logs"),
+        str(tmp_path / "raw"),
+        **{**options, **kwargs},
+    )
+
+
+def _tasks(tmp_path):
+    return corine.load_tasks(str(tmp_path / "logs" / corine.TASKS_FILE))
+
+
+def test_missing_requests_are_resubmitted(clms, tmp_path):
+    # t1 is never listed by @datarequest_search, t2 fails
+    clms.status = {"t2": {"Status": "Rejected"}}
+    assert _intaker(clms, tmp_path) is False
+    tasks = _tasks(tmp_path)
+    assert tasks["d1/f1"]["status"] == "Missing"
+    assert tasks["d2/f2"]["status"] == "Rejected"
+
+    clms.files["/files/f1.tif"] = b"one"
+    clms.files["/files/f2.tif"] = b"two"
+    url = clms.api.replace("/api/", "/files/")
+    clms.status = {
+        "t3": {"Status": "Finished_ok", "DownloadURL": url + "f1.tif"},
+        "t4": {"Status": "Finished_ok", "DownloadURL": url + "f2.tif"},
+    }
+    assert _intaker(clms, tmp_path) is True
+    assert len(clms.posted) == 4
+    assert (tmp_path / "raw" / "f1.tif").read_bytes() == b"one"
+
+
+def test_downloads_running_at_the_deadline_are_recorded(clms, tmp_path):
+    clms.files["/files/f1.tif"] = b"one"
+    clms.file_delay = 0.5
+    clms.status = {
+        "t1": {
+            "Status": "Finished_ok",
+            "DownloadURL": clms.api.replace("/api/", "/files/") + "f1.tif",
+        },
+        "t2": {"Status": "In_progress"},
+    }
+    assert _intaker(clms, tmp_path, timeout=0.1) is False
+    tasks = _tasks(tmp_path)
+    assert tasks["d1/f1"]["status"] == "Downloaded"
+    assert tasks["d2/f2"]["status"] == "In_progress"
+    assert (tmp_path / "raw" / "f1.tif").read_bytes() == b"one"
+
+
+def test_vsensor_seeds_the_index_from_the_store(clms, tmp_path):
+    clms.catalogue = [
+        _dataset("d1", "f1"),
+        _dataset("d2", "f2"),
+        _dataset("d3", "f3", title=TITLE.replace("Europe", "French DOMs")),
+    ]
+    logs = str(tmp_path / "logs")
+    # No catalogue.json yet: the datasets of the last snapshot are not new
+    assert corine.vSensor(logs, api=clms.api) is False
+    assert sorted(
+        corine.load_catalogue(f"{logs}/{corine.CATALOGUE_FILE}")["datasets"]
+    ) == ["d1", "d2"]
+    clms.catalogue.append(_dataset("d4", "f4"))
+    assert corine.vSensor(logs, api=clms.api) is True
+
+
+def test_token_is_cached_privately_and_reused(clms, credentials, tmp_path):
+    cache = str(tmp_path / "auth" / "token.json")
+    with CLMSSession(credentials, api=clms.api, token_cache=cache) as session:
+        assert session.token() == "token1"
+        assert session.get("@datarequest_search").status_code == 200
+    assert os.stat(cache).st_mode & 0o777 == 0o600
+    # A later run reads the token from the cache instead of minting one
+    with CLMSSession(credentials, api=clms.api, token_cache=cache) as session:
+        assert session.token() == "token1"
+    assert clms.minted == 1
+
+
+def test_rejected_token_is_refreshed(clms, credentials, tmp_path):
+    cache = str(tmp_path / "token.json")
+    with CLMSSession(credentials, api=clms.api, token_cache=cache) as session:
+        session.token()
+        clms.tokens.clear()
+        assert session.get("@datarequest_search").status_code == 200
+    assert clms.minted == 2
+    with open(cache) as f:
+        assert json.load(f)["access_token"] == "token2"
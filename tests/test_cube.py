@@ -0,0 +1,98 @@
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+from feedbackloop.cube import (
+    consolidate,
+    init_cube,
+    open_cube,
+    parse_chelsa_name,
+    write_layer,
+)
+
+
+def test_cube_layers_round_trip(tmp_path):
+    store = str(tmp_path / "cube.zarr")
+    layers = [
+        ("bio1", "Current", "Current", "1981-2010"),
+        ("bio1", "ssp126", "GFDL-ESM4", "2041-2070"),
+    ]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        init_cube(
+            store, layers, y=np.arange(5), x=np.arange(6), crs="EPSG:3035"
+        )
+        write_layer(store, np.ones((5, 6)), *layers[1])
+        consolidate(store)
+        cube = open_cube(store)
+    # Written in the Zarr v2 format with either zarr version
+    assert os.path.exists(os.path.join(store, ".zmetadata"))
+    assert (
+        float(cube.data.sel(scenario="ssp126", model="GFDL-ESM4").sum()) == 30
+    )
+    assert np.isnan(cube.data.sel(scenario="Current").values).all()
+
+
+@pytest.mark.parametrize(
+    "name, key",
+    [
+        (
+            "CHELSA_bio1_1981-2010_V.2.1.tif",
+            ("bio1", "Current", "Current", "1981-2010", "Annual"),
+        ),
+        (
+            "CHELSA_tas_01_1981-2010_V.2.1.tif",
+            ("tas", "Current", "Current", "1981-2010", "01"),
+        ),
+        (
+            "CHELSA_rsds_1981-2010_03_V.2.1.tif",
+            ("rsds", "Current", "Current", "1981-2010", "03"),
+        ),
+        (
+            "CHELSA_rsds_1981-2010_max_V.2.1.tif",
+            ("rsds_max", "Current", "Current", "1981-2010", "Annual"),
+        ),
+        (
+            "CHELSA_bio12_2071-2100_gfdl-esm4_ssp126_V.2.1.tif",
+            ("bio12", "ssp126", "gfdl-esm4", "2071-2100", "Annual"),
+        ),
+        (
+            "CHELSA_gfdl-esm4_r1i1p1f1_w5e5_ssp126_tas_11_2071_2100_norm.tif",
+            ("tas", "ssp126", "gfdl-esm4", "2071-2100", "11"),
+        ),
+        (
+            "CHELSA_ukesm1-0-ll_r1i1p1f2_w5e5_ssp585_tasmax_01_2011_2040_norm",
+            ("tasmax", "ssp585", "ukesm1-0-ll", "2011-2040", "01"),
+        ),
+    ],
+)
+def test_parse_chelsa_name(name, key):
+    assert parse_chelsa_name(name) == key
+
+
+def test_every_reference_file_has_its_own_layer():
+    references = os.path.join(
+        os.path.dirname(__file__), "..", "references", "chelsa"
+    )
+    for name in os.listdir(references):
+        if not name.startswith("DwnLinks_Climatologies"):
+            continue
+        with open(os.path.join(references, name)) as f:
+            files = {
+                line.strip().rsplit("/", 1)[-1]
+                for line in f
+                if line.strip().endswith(".tif")
+            }
+        keys = {parse_chelsa_name(file) for file in files}
+        assert len(keys) == len(files), name
+
+
+def test_duplicate_layers_are_rejected(tmp_path):
+    layers = [
+        ("tas", "Current", "Current", "1981-2010", "01"),
+        ("tas", "Current", "Current", "1981-2010", "01"),
+    ]
+    with pytest.raises(ValueError, match="same"):
+        init_cube(str(tmp_path / "cube.zarr"), layers, y=[0], x=[0])
@@ -0,0 +1,35 @@
+from feedbackloop.diff import diff, is_empty
+
+
+def test_diff_is_keyed_and_order_free():
+    old = [
+        {"name": "a", "ETag": "1", "size": 10},
+        {"name": "b", "ETag": "2", "size": 20},
+        {"name": "c", "ETag": "3", "size": 30},
+    ]
+    new = [
+        {"name": "d", "ETag": "4", "size": 40},
+        {"name": "c", "ETag": "3", "size": 30},
+        {"name": "a", "ETag": "9", "size": 10, "owner": "wsl"},
+    ]
+    changeset = diff(old, new, "name")
+    assert changeset == {
+        "added": ["d"],
+        "removed": ["b"],
+        "changed": [
+            {
+                "name": "a",
+                "fields": {"ETag": ["1", "9"], "owner": [None, "wsl"]},
+            }
+        ],
+    }
+    assert is_empty(diff(old, list(reversed(old)), "name"))
+
+
+def test_diff_only_compares_the_given_fields():
+    old = [{"UID": "u1", "modified": "2020", "title": "CLC"}]
+    new = [{"UID": "u1", "modified": "2024", "title": "CLC 2018"}]
+    assert diff(old, new, "UID", fields=["modified"])["changed"] == [
+        {"UID": "u1", "fields": {"modified": ["2020", "2024"]}}
+    ]
+    assert is_empty(diff(old, new, "UID", fields=["size"]))
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from feedbackloop import download
+from feedbackloop.download import (
+    PART_SUFFIX,
+    VALIDATOR_SUFFIX,
+    download_all,
+    download_file,
+)
+
+
+def test_download_all(server, tmp_path):
+    for i in range(5):
+        server.objects[f"/f{i}.tif"] = (os.urandom(10000 + i), f'"v{i}"')
+    summary = download_all(
+        [server.url(f"/f{i}.tif") for i in range(5)], tmp_path, max_workers=3
+    )
+    assert summary["done"] == 5 and summary["failed"] == 0
+    for i in range(5):
+        assert (tmp_path / f"f{i}.tif").read_bytes() == server.objects[
+            f"/f{i}.tif"
+        ][0]
+    assert not list(tmp_path.glob(f"*{PART_SUFFIX}*"))
+
+
+def test_resume_sends_if_range(server, tmp_path):
+    data = os.urandom(50000)
+    server.objects["/a.tif"] = (data, '"v1"')
+    (tmp_path / "a.tif.part").write_bytes(data[:20000])
+    (tmp_path / f"a.tif{PART_SUFFIX}{VALIDATOR_SUFFIX}").write_text('"v1"')
+    result = download_file(server.url("/a.tif"), tmp_path)
+    assert result["status"] == "done" and result["bytes"] == 30000
+    assert (tmp_path / "a.tif").read_bytes() == data
+    assert server.requests[-1][1]["If-Range"] == '"v1"'
+
+
+def test_resume_restarts_when_object_changed(server, tmp_path):
+    old, new = os.urandom(50000), os.urandom(40000)
+    server.objects["/a.tif"] = (new, '"v2"')
+    (tmp_path / "a.tif.part").write_bytes(old[:20000])
+    (tmp_path / f"a.tif{PART_SUFFIX}{VALIDATOR_SUFFIX}").write_text('"v1"')
+    result = download_file(server.url("/a.tif"), tmp_path)
+    assert result["status"] == "done"
+    assert (tmp_path / "a.tif").read_bytes() == new
+
+
+@pytest.mark.parametrize("part_size", [60000, 50001])
+def test_oversized_part_is_discarded(server, tmp_path, part_size):
+    data = os.urandom(50000)
+    server.objects["/a.tif"] = (data, '"v1"')
+    (tmp_path / "a.tif.part").write_bytes(os.urandom(part_size))
+    (tmp_path / f"a.tif{PART_SUFFIX}{VALIDATOR_SUFFIX}").write_text('"v1"')
+    result = download_file(server.url("/a.tif"), tmp_path)
+    assert result["status"] == "done"
+    assert (tmp_path / "a.tif").read_bytes() == data
+
+
+def test_part_without_validator_is_not_resumed(server, tmp_path):
+    data = os.urandom(30000)
+    server.objects["/a.tif"] = (data, '"v1"')
+    (tmp_path / "a.tif.part").write_bytes(b"x" * 10000)
+    assert download_file(server.url("/a.tif"), tmp_path)["status"] == "done"
+    assert (tmp_path / "a.tif").read_bytes() == data
+    assert "Range" not in server.requests[-1][1]
+
+
+def test_complete_part_on_416(server, tmp_path):
+    data = os.urandom(30000)
+    server.objects["/a.tif"] = (data, '"v1"')
+    (tmp_path / "a.tif.part").write_bytes(data)
+    (tmp_path / f"a.tif{PART_SUFFIX}{VALIDATOR_SUFFIX}").write_text('"v1"')
+    result = download_file(server.url("/a.tif"), tmp_path)
+    assert result["status"] == "done" and result["bytes"] == 0
+    assert (tmp_path / "a.tif").read_bytes() == data
+
+
+def test_failure_after_retries(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(download.time, "sleep", lambda s: None)
+    result = download_file("http://127.0.0.1:1/x", tmp_path, retries=2)
+    assert result["status"] == "failed" and result["error"]
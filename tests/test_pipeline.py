@@ -0,0 +1,47 @@
+import pytest
+
+from service import model, pipeline
+
+
+def test_fit_body_does_not_wait():
+    body = model.fit_body("models")
+    assert "--wait" not in body
+    assert 'sbatch --parsable "$f"' in body
+    # Submitting the fits takes minutes, not the days they run for
+    assert model.FIT_RESOURCES["time"] == "00:15:00"
+
+
+def test_run_pipeline_returns_futures_without_waiting(fake_slurm, tmp_path):
+    (tmp_path / "workflows").mkdir()
+    graph = {
+        "prep": pipeline.python_node("print(1)", {"jobname": "prep"}),
+        "fit": {
+            "resources": model.FIT_RESOURCES,
+            "body": model.fit_body(),
+            "after": ["prep"],
+        },
+    }
+    futures = pipeline.run_pipeline(str(tmp_path / "logs"), graph=graph)
+    assert list(futures) == ["prep", "fit"]
+    assert [futures[name].job_id for name in futures] == ["4242", "4243"]
+
+    calls = fake_slurm.read_text().splitlines()
+    assert "--dependency" not in calls[0]
+    assert "--dependency=afterok:4242" in calls[1].split()
+    assert all(
+        future.result(timeout=10) == "COMPLETED" for future in futures.values()
+    )
+
+
+def test_run_pipeline_checks_root_dir(fake_slurm, tmp_path, monkeypatch):
+    # tmp_path has no workflows directory
+    with pytest.raises(RuntimeError, match="workflows"):
+        pipeline.run_pipeline(str(tmp_path / "logs"), graph={})
+    monkeypatch.delenv("ROOT_DIR")
+    with pytest.raises(RuntimeError, match="ROOT_DIR"):
+        pipeline.run_pipeline(str(tmp_path / "logs"), graph={})
+    assert (
+        pipeline.run_pipeline(str(tmp_path / "logs"), dry_run=True, graph={})
+        == {}
+    )
+    assert not fake_slurm.exists()
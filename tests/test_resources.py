@@ -0,0 +1,61 @@
+import json
+
+from service import resources
+
+
+def test_parse_mem_per_cpu_and_per_node():
+    assert resources.parse_mem("4000M") == 4000
+    assert resources.parse_mem("200Gn") == 200 * 1024
+    assert resources.parse_mem("4000Mc", cpus=4) == 16000
+    assert resources.parse_mem("2Gc") == 2048
+    assert resources.parse_mem("") is None
+
+
+def _history(tmp_path, entries):
+    path = tmp_path / "history.jsonl"
+    path.write_text(
+        "".join(
+            json.dumps({"name": "job", **entry}) + "\n" for entry in entries
+        )
+    )
+    return str(path)
+
+
+def test_exceeded_state_only_raises_its_own_dimension(tmp_path):
+    run = {
+        "max_rss_mb": 1000,
+        "req_mem_mb": 2000,
+        "elapsed_s": 3600,
+        "req_time_s": 7200,
+    }
+    history = _history(
+        tmp_path,
+        [
+            dict(run, state="COMPLETED"),
+            dict(run, state="COMPLETED"),
+            # Ran out of time: its memory use is real, its time request was too
+            # small
+            dict(run, state="TIMEOUT", elapsed_s=7200),
+            # Failed for another reason: no sample
+            dict(run, state="FAILED", max_rss_mb=10, elapsed_s=1),
+        ],
+    )
+    suggestion = resources.suggest(
+        "job", history_path=history, q=100, headroom=1, min_runs=3
+    )
+    # Memory: two completed runs only, the timed out run is not counted as out
+    # of memory
+    assert "mem" not in suggestion
+    # Time: twice the request of the timed out run
+    assert suggestion["time"] == resources.format_duration(2 * 7200)
+
+    history = _history(
+        tmp_path,
+        [dict(run, state="COMPLETED")] * 2
+        + [dict(run, state="OUT_OF_MEMORY")],
+    )
+    suggestion = resources.suggest(
+        "job", history_path=history, q=100, headroom=1, min_runs=3
+    )
+    assert suggestion["mem"] == resources.format_mem(2 * 2000)
+    assert "time" not in suggestion
@@ -0,0 +1,132 @@
+import subprocess
+
+import pytest
+
+from service import slurm
+from state import scheduler
+from state.chains import COMMANDS_FILE
+
+COMMAND = (
+    "python3 -m hmsc.run_gibbs_sampler --input models/{model}.rds "
+    "--output models/{model}_Chain{chain}.rds\n"
+)
+
+
+def _chain(model, chain=1):
+    output = f"models/{model}_Chain{chain}.rds"
+    return {
+        "model_dir": "models",
+        "model": model,
+        "chain": chain,
+        "input": None,
+        "output": output,
+    }
+
+
+@pytest.fixture
+def models(fake_slurm, tmp_path, monkeypatch):
+    """Three models with two unfitted chains each, under tmp_path/models."""
+    monkeypatch.setattr(scheduler, "tracker", slurm.tracker)
+    model_dir = tmp_path / "models"
+    model_dir.mkdir()
+    commands = "".join(
+        COMMAND.format(model=f"M{m}", chain=c)
+        for m in range(3)
+        for c in (1, 2)
+    )
+    (model_dir / COMMANDS_FILE).write_text(commands)
+    return tmp_path
+
+
+def test_take_batch_leaves_slots_for_merges():
+    queue = [_chain("A", 1), _chain("A", 2), _chain("B", 1), _chain("C", 1)]
+    remaining = {("models", "A"): 2, ("models", "B"): 1, ("models", "C"): 1}
+    # A's two chains and its merge fill three slots, B's chain and merge would
+    # not fit
+    batch, rest = scheduler.take_batch(queue, 4, remaining)
+    assert batch == queue[:2] and rest == queue[2:]
+    batch, rest = scheduler.take_batch(queue, 4, remaining, merge=False)
+    assert batch == queue
+
+
+def test_schedule_retries_rejected_merges(models, monkeypatch):
+    calls = []
+    submit_merge = scheduler.submit_merge
+
+    def flaky_merge(model_dir, logs_dir, dependency=None, models=None):
+        calls.append(models)
+        if len(calls) == 1:
+            raise subprocess.CalledProcessError(
+                1, "sbatch", stderr="Job dependency problem"
+            )
+        return submit_merge(model_dir, logs_dir, dependency, models)
+
+    monkeypatch.setattr(scheduler, "submit_merge", flaky_merge)
+    result = scheduler.schedule(
+        "models", str(models / "logs"), root=str(models), limit=9, wait=False
+    )
+    assert sorted(result["merges"]) == ["M0", "M1", "M2"]
+    # The rejected merge of M0 is submitted again on the next round
+    assert calls == [["M0"], ["M1"], ["M2"], ["M0"]]
+    for future in [*result["arrays"], *result["merges"].values()]:
+        future.result(timeout=10)
+
+
+def test_schedule_raises_on_a_merge_that_keeps_failing(models, monkeypatch):
+    def rejected(*args, **kwargs):
+        raise subprocess.CalledProcessError(1, "sbatch", stderr="rejected")
+
+    monkeypatch.setattr(scheduler, "submit_merge", rejected)
+    with pytest.raises(RuntimeError, match="merge"):
+        scheduler.schedule(
+            "models", str(models / "logs"), root=str(models), wait=False
+        )
+
+
+def test_merge_dependency_skips_finished_tasks(monkeypatch, tmp_path):
+    states = {"7": {0: "COMPLETED", 1: "FAILED"}, "8": {}}
+    monkeypatch.setattr(
+        scheduler, "array_states", lambda job_id: states[job_id]
+    )
+    tasks = [("7_0", _chain("A", 1)), ("8_0", _chain("A", 2))]
+    assert scheduler.merge_dependency(tasks, str(tmp_path)) == (
+        "afterok:8_0",
+        [],
+    )
+    tasks.append(("7_1", _chain("A", 3)))
+    assert scheduler.merge_dependency(tasks, str(tmp_path))[1] == ["7_1"]
+
+
+def test_merges_count_against_their_own_partition(models, monkeypatch):
+    queued = {"small-g": 0, "standard": 1}
+    rounds = []
+
+    def queued_tasks(partition=None):
+        if partition == "small-g":
+            rounds.append(partition)
+        return queued[partition]
+
+    merged = []
+    submit_merge = scheduler.submit_merge
+
+    def counted_merge(model_dir, logs_dir, dependency=None, models=None):
+        merged.append(len(rounds))
+        return submit_merge(model_dir, logs_dir, dependency, models)
+
+    monkeypatch.setattr(scheduler, "queued_tasks", queued_tasks)
+    monkeypatch.setattr(scheduler, "submit_merge", counted_merge)
+    result = scheduler.schedule(
+        "models",
+        str(models / "logs"),
+        root=str(models),
+        limit=6,
+        merge_limit=3,
+        wait=False,
+    )
+    # No small-g slot is held back for the merges, all six chains fit at once
+    assert len(result["arrays"]) == 1
+    assert sorted(result["merges"]) == ["M0", "M1", "M2"]
+    # Two standard slots are free per round
+    assert merged == [2, 2, 3]
+    for future in [*result["arrays"], *result["merges"].values()]:
+        future.result(timeout=10)
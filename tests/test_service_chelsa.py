@@ -0,0 +1,178 @@
+import os
+
+import numpy as np
+import xarray as xr
+
+import pytest
+
+from feedbackloop.cube import open_cube
+from service.chelsa import (
+    _convert2zarr,
+    convert2nc,
+    encoding_for,
+    job_processor_array,
+    shard_mem,
+)
+
+
+def _dataset(values):
+    return xr.Dataset(
+        {"bio1": (("y", "x"), values)},
+        coords={
+            "y": np.arange(values.shape[0]),
+            "x": np.arange(values.shape[1]),
+        },
+    )
+
+
+def test_default_profile_is_lossless(tmp_path):
+    values = (
+        np.random.default_rng(0).normal(280, 10, (40, 50)).astype("float32")
+    )
+    ds = _dataset(values)
+    encoding = encoding_for(ds)
+    assert (
+        "dtype" not in encoding["bio1"]
+        and "scale_factor" not in encoding["bio1"]
+    )
+    ds.to_netcdf(tmp_path / "out.nc", encoding=encoding)
+    with xr.open_dataset(tmp_path / "out.nc") as back:
+        np.testing.assert_array_equal(back["bio1"].values, values)
+
+
+def test_archive_packs_within_one_step(tmp_path):
+    values = (
+        np.random.default_rng(0).normal(280, 10, (40, 50)).astype("float32")
+    )
+    values[0, 0] = np.nan
+    ds = _dataset(values).chunk({"y": 10})
+    encoding = encoding_for(ds, "archive")
+    assert encoding["bio1"]["dtype"] == "int16"
+    ds.to_netcdf(tmp_path / "out.nc", encoding=encoding)
+    with xr.open_dataset(tmp_path / "out.nc") as back:
+        np.testing.assert_allclose(
+            back["bio1"].values, values, atol=encoding["bio1"]["scale_factor"]
+        )
+
+
+def test_archive_keeps_all_nan_variables_float(tmp_path):
+    ds = _dataset(np.full((10, 10), np.nan, dtype="float32"))
+    encoding = encoding_for(ds, "archive")
+    assert "scale_factor" not in encoding["bio1"]
+    ds.to_netcdf(tmp_path / "out.nc", encoding=encoding)
+    with xr.open_dataset(tmp_path / "out.nc") as back:
+        assert np.isnan(back["bio1"].values).all()
+
+
+def test_array_memory_follows_the_largest_layer(fake_slurm, tmp_path):
+    input_dir = tmp_path / "tifs"
+    input_dir.mkdir()
+    for name, size in (("small.tif", 1024), ("large.tif", 300 * 1024**2)):
+        with open(input_dir / name, "wb") as f:
+            f.truncate(size)
+    assert shard_mem([input_dir / "small.tif"]) == "1G"
+    assert (
+        shard_mem([input_dir / "small.tif", input_dir / "large.tif"]) == "3G"
+    )
+
+    future = job_processor_array(
+        input_dir,
+        tmp_path / "out",
+        str(tmp_path / "logs"),
+        shards=2,
+        wait=False,
+    )
+    assert future.input_size == 300 * 1024**2
+    script = open(fake_slurm.read_text().split()[-1]).read()
+    assert "#SBATCH --mem=3G" in script
+    assert "#SBATCH --array=0-1%50" in script
+    future.result(timeout=10)
+
+
+def _layer_file(directory, name, value):
+    ds = _dataset(np.full((3, 4), value, dtype="float32"))
+    ds = ds.rename({"bio1": name})
+    ds.to_netcdf(directory / f"{name}.nc")
+    return f"{name}.nc"
+
+
+def test_monthly_layers_get_their_own_slot(tmp_path):
+    files = [
+        _layer_file(tmp_path, f"CHELSA_tas_{month}_1981-2010", i)
+        for i, month in enumerate(("01", "02"))
+    ]
+    store = str(tmp_path / "cube.zarr")
+    _convert2zarr(str(tmp_path), files, store, max_workers=1)
+    cube = open_cube(store)
+    assert list(cube.month.values) == ["01", "02"]
+    assert float(cube.data.sel(month="02").max()) == 1
+
+
+def test_layers_with_the_same_key_are_rejected(tmp_path):
+    files = [
+        _layer_file(tmp_path, "CHELSA_tas_01_1981-2010", 0),
+        _layer_file(tmp_path, "tas_01_1981-2010", 1),
+    ]
+    with pytest.raises(ValueError, match="same"):
+        _convert2zarr(
+            str(tmp_path), files, str(tmp_path / "cube.zarr"), max_workers=1
+        )
+
+
+def _climate_file(directory, variable, model, scenario, value):
+    ds = _dataset(np.full((3, 4), value, dtype="float32"))
+    ds = ds.rename({"bio1": variable})
+    ds[variable].attrs.update(
+        ClimModel=model,
+        ClimScenario=scenario,
+        TimePeriod="2071-2100",
+        explanation=f"{variable} explained",
+    )
+    ds.attrs.update(
+        Var=variable,
+        Long_name=variable,
+        unit="K",
+        explanation="",
+        created_by="test",
+        date="2024",
+    )
+    ds.to_netcdf(directory / f"{variable}_{model}_{scenario}.nc")
+
+
+def test_streaming_and_eager_merges_agree(tmp_path):
+    inputs = tmp_path / "in"
+    inputs.mkdir()
+    for i, (variable, model, scenario) in enumerate(
+        [
+            ("bio1", "GFDL", "ssp126"),
+            ("bio12", "GFDL", "ssp126"),
+            ("bio1", "MPI", "ssp585"),
+            ("bio12", "MPI", "ssp585"),
+        ]
+    ):
+        _climate_file(inputs, variable, model, scenario, i)
+    # Current climate files have no model and are not merged
+    _dataset(np.zeros((3, 4), "float32")).to_netcdf(inputs / "current.nc")
+
+    merged = {}
+    for streaming in (True, False):
+        output_dir = tmp_path / f"out-{streaming}"
+        output_dir.mkdir()
+        convert2nc(
+            str(inputs), str(output_dir), streaming=streaming, max_workers=2
+        )
+        assert sorted(os.listdir(output_dir)) == [
+            "GFDL_ssp126_2071-2100.nc",
+            "MPI_ssp585_2071-2100.nc",
+        ]
+        merged[streaming] = {
+            name: xr.load_dataset(output_dir / name)
+            for name in os.listdir(output_dir)
+        }
+    for name, ds in merged[True].items():
+        xr.testing.assert_identical(
+            ds.drop_attrs(deep=False),
+            merged[False][name].drop_attrs(deep=False),
+        )
+        assert ds.attrs["ClimModel"] == name.split("_")[0]
+        assert sorted(ds.data_vars) == ["bio1", "bio12"]
@@ -0,0 +1,89 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+import pytest
+
+from service import pipeline
+from service.corine import N_CLASSES, RESOURCES, aggregate
+
+# 100 m pixels, off the 1 km grid so the border cells are partly covered
+LEFT, TOP, PIXEL, RESOLUTION = 4000350, 3000720, 100, 1000
+
+
+def _corine(path, codes):
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=codes.shape[0],
+        width=codes.shape[1],
+        count=1,
+        dtype="uint8",
+        crs="EPSG:3035",
+        transform=from_origin(LEFT, TOP, PIXEL, PIXEL),
+    ) as dst:
+        dst.write(codes, 1)
+
+
+def _reference(codes):
+    """Class counts per 1 km cell of every pixel centre, with plain NumPy."""
+    rows, cols = np.indices(codes.shape)
+    x = LEFT + (cols + 0.5) * PIXEL
+    y = TOP - (rows + 0.5) * PIXEL
+    left = np.floor(LEFT / RESOLUTION) * RESOLUTION
+    top = np.ceil(TOP / RESOLUTION) * RESOLUTION
+    dc = ((x - left) // RESOLUTION).astype(int)
+    dr = ((top - y) // RESOLUTION).astype(int)
+    counts = np.zeros((dr.max() + 1, dc.max() + 1, N_CLASSES + 1), int)
+    valid = (codes >= 1) & (codes <= N_CLASSES)
+    np.add.at(counts, (dr[valid], dc[valid], codes[valid]), 1)
+    return counts
+
+
+@pytest.mark.parametrize("tile_size", [7, 16, 1000])
+def test_aggregate_matches_numpy(tmp_path, tile_size):
+    rng = np.random.default_rng(0)
+    codes = rng.choice(
+        np.array([1, 2, 12, 44, 48, 128], np.uint8),
+        size=(45, 53),
+        p=[0.3, 0.2, 0.2, 0.1, 0.1, 0.1],
+    )
+    # A cell with nothing but nodata and outside codes
+    codes[:7, :6] = 48
+    codes[:7, :2] = 128
+    _corine(tmp_path / "clc.tif", codes)
+
+    outputs = aggregate(
+        str(tmp_path / "clc.tif"),
+        str(tmp_path / "out"),
+        resolution=RESOLUTION,
+        tile_size=tile_size,
+        max_workers=2,
+    )
+
+    counts = _reference(codes)
+    totals = counts.sum(axis=2)
+    with rasterio.open(outputs["fractions"]) as src:
+        assert src.shape == totals.shape
+        fractions = src.read()
+    with rasterio.open(outputs["majority"]) as src:
+        majority = src.read(1)
+
+    covered = totals > 0
+    assert not covered[0, 0]
+    assert np.isnan(fractions[:, ~covered]).all()
+    expected = 100 * counts[covered][:, 1:] / totals[covered][:, np.newaxis]
+    np.testing.assert_allclose(fractions[:, covered].T, expected, rtol=1e-6)
+    assert (majority[~covered] == 0).all()
+    assert (
+        majority[covered] == counts[covered][:, 1:].argmax(axis=1) + 1
+    ).all()
+
+
+def test_pipeline_aggregates_on_a_small_node():
+    node = pipeline.build_graph()["corine"]
+    assert node["resources"] is RESOURCES
+    assert "corine.R" not in node["body"]
+    assert "service.corine import aggregate" in node["body"]
+    assert int(RESOURCES["mem"].rstrip("G")) < 100
@@ -0,0 +1,253 @@
+import os
+import socket
+import threading
+
+import paramiko
+import pytest
+from paramiko import (
+    SFTPAttributes,
+    SFTPHandle,
+    SFTPServer,
+    SFTPServerInterface,
+)
+
+from service import sftp
+
+USER, PASSWORD = "user", "secret"
+
+
+class _Server(paramiko.ServerInterface):
+    def check_auth_password(self, username, password):
+        return (
+            paramiko.AUTH_SUCCESSFUL
+            if (username, password) == (USER, PASSWORD)
+            else paramiko.AUTH_FAILED
+        )
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class _Handle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class _Interface(SFTPServerInterface):
+    """Serves the local directory root over SFTP."""
+
+    def __init__(self, server, root):
+        super().__init__(server)
+        self.root = root
+
+    def _local(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip("/"))
+
+    def canonicalize(self, path):
+        return os.path.normpath("/" + path)
+
+    def list_folder(self, path):
+        try:
+            entries = []
+            for name in os.listdir(self._local(path)):
+                attr = SFTPAttributes.from_stat(
+                    os.stat(os.path.join(self._local(path), name))
+                )
+                attr.filename = name
+                entries.append(attr)
+            return entries
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._local(path), flags, 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        mode = "r+b" if flags & (os.O_WRONLY | os.O_RDWR) else "rb"
+        handle = _Handle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        os.remove(self._local(path))
+        return paramiko.SFTP_OK
+
+    def rename(self, source, destination):
+        os.rename(self._local(source), self._local(destination))
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, source, destination):
+        os.replace(self._local(source), self._local(destination))
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._local(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        if attr.st_mtime is not None:
+            os.utime(self._local(path), (attr.st_atime, attr.st_mtime))
+        return paramiko.SFTP_OK
+
+
+@pytest.fixture(scope="module")
+def host_key():
+    return paramiko.RSAKey.generate(2048)
+
+
+@pytest.fixture
+def server(tmp_path, host_key):
+    """Runs an SFTP server on a local port and returns (port, root,
+    known_hosts).
+    """
+    root = tmp_path / "remote"
+    root.mkdir()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(10)
+    port = sock.getsockname()[1]
+
+    def serve():
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler(
+                "sftp", SFTPServer, _Interface, str(root)
+            )
+            transport.start_server(server=_Server())
+
+    threading.Thread(target=serve, daemon=True).start()
+    known_hosts = tmp_path / "known_hosts"
+    keys = paramiko.HostKeys()
+    keys.add(f"[127.0.0.1]:{port}", host_key.get_name(), host_key)
+    keys.save(str(known_hosts))
+    yield port, root, str(known_hosts)
+    sock.close()
+
+
+def _pool(server, known_hosts=True):
+    port, _, path = server
+    return sftp.SFTPPool(
+        "127.0.0.1",
+        USER,
+        PASSWORD,
+        port=port,
+        size=2,
+        known_hosts=path if known_hosts else None,
+    )
+
+
+def test_unknown_host_key_is_rejected(server):
+    with _pool(server, known_hosts=False) as pool:
+        with pytest.raises(paramiko.SSHException, match="known_hosts"):
+            with pool.connection():
+                pass
+
+
+def test_round_trip_and_skip(server, tmp_path):
+    local = tmp_path / "local"
+    (local / "sub").mkdir(parents=True)
+    for name in ("a.bin", "sub/b.bin"):
+        (local / name).write_bytes(os.urandom(200_000))
+    with _pool(server) as pool:
+        assert sftp.upload_tree(str(local), "/data", pool=pool)["done"] == 2
+        assert sftp.upload_tree(str(local), "/data", pool=pool)["skipped"] == 2
+        back = tmp_path / "back"
+        assert sftp.download_tree("/data", str(back), pool=pool)["done"] == 2
+    for name in ("a.bin", "sub/b.bin"):
+        assert (back / name).read_bytes() == (local / name).read_bytes()
+
+
+def test_corrupt_resumed_upload_is_redone_with_checksum(server, tmp_path):
+    _, root, _ = server
+    data = os.urandom(300_000)
+    (tmp_path / "a.bin").write_bytes(data)
+    (root / "a.bin.part").write_bytes(os.urandom(100_000))
+    with _pool(server) as pool:
+        result = sftp._transfer(
+            pool, "upload", str(tmp_path / "a.bin"), "/a.bin", True, 3, 0
+        )
+    assert result["status"] == "done"
+    assert (root / "a.bin").read_bytes() == data
+
+
+def test_corrupt_resumed_download_is_redone_with_checksum(server, tmp_path):
+    _, root, _ = server
+    data = os.urandom(300_000)
+    (root / "a.bin").write_bytes(data)
+    (tmp_path / "a.bin.part").write_bytes(os.urandom(100_000))
+    with _pool(server) as pool:
+        result = sftp._transfer(
+            pool, "download", str(tmp_path / "a.bin"), "/a.bin", True, 3, 0
+        )
+    assert result["status"] == "done"
+    assert (tmp_path / "a.bin").read_bytes() == data
+    assert not (tmp_path / "a.bin.part").exists()
+
+
+@pytest.mark.parametrize("changed", [False, True])
+def test_download_resumes_only_the_same_source(server, tmp_path, changed):
+    _, root, _ = server
+    data = os.urandom(300_000)
+    (root / "a.bin").write_bytes(data)
+    os.utime(root / "a.bin", (1_000_000, 1_000_000))
+    part = tmp_path / "a.bin.part"
+    part.write_bytes(data[:100_000] if not changed else os.urandom(100_000))
+    mtime = 999_999 if changed else 1_000_000
+    (tmp_path / "a.bin.part.validator").write_text(f"300000 {mtime}")
+    with _pool(server) as pool:
+        result = sftp._transfer(
+            pool, "download", str(tmp_path / "a.bin"), "/a.bin", False, 1, 0
+        )
+    assert result["status"] == "done"
+    assert result["bytes"] == (300_000 if changed else 200_000)
+    assert (tmp_path / "a.bin").read_bytes() == data
+    assert not part.exists()
+    assert not (tmp_path / "a.bin.part.validator").exists()
+
+
+@pytest.mark.parametrize("changed", [False, True])
+def test_upload_resumes_only_the_same_source(server, tmp_path, changed):
+    _, root, _ = server
+    data = os.urandom(300_000)
+    (tmp_path / "a.bin").write_bytes(data)
+    os.utime(tmp_path / "a.bin", (1_000_000, 1_000_000))
+    (root / "a.bin.part").write_bytes(
+        data[:100_000] if not changed else os.urandom(100_000)
+    )
+    mtime = 999_999 if changed else 1_000_000
+    (root / "a.bin.part.validator").write_text(f"300000 {mtime}")
+    with _pool(server) as pool:
+        result = sftp._transfer(
+            pool, "upload", str(tmp_path / "a.bin"), "/a.bin", False, 1, 0
+        )
+        # Validators of interrupted transfers are not files of the tree
+        (root / "b.bin.part.validator").write_text("1 1")
+        listed = sftp.download_tree("/", str(tmp_path / "back"), pool=pool)
+    assert result["status"] == "done"
+    assert result["bytes"] == (300_000 if changed else 200_000)
+    assert (root / "a.bin").read_bytes() == data
+    assert sorted(os.listdir(root)) == ["a.bin", "b.bin.part.validator"]
+    assert [r["remote"] for r in listed["files"]] == ["/a.bin"]
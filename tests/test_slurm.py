@@ -0,0 +1,85 @@
+import shlex
+
+import pytest
+
+from service import EASIN, GBIF, IAS, eLTER, railways, roads, samplingEfforts
+from service import chelsa as service_chelsa
+from service import slurm
+
+
+def test_render_requires_root_dir(monkeypatch, tmp_path):
+    monkeypatch.delenv("ROOT_DIR", raising=False)
+    with pytest.raises(RuntimeError, match="ROOT_DIR"):
+        slurm.render({"jobname": "job"}, "true", "logs")
+    monkeypatch.setenv("ROOT_DIR", str(tmp_path / "missing"))
+    with pytest.raises(RuntimeError, match="ROOT_DIR"):
+        slurm.render({"jobname": "job"}, "true", "logs")
+
+
+def test_submit_with_fake_sbatch(fake_slurm, tmp_path):
+    logs_dir = tmp_path / "logs"
+    future = slurm.submit(
+        {"jobname": "job", "mem": "1G"},
+        "true",
+        str(logs_dir),
+        dependency="afterok:1:2",
+    )
+    assert future.job_id == "4242"
+    assert future.result(timeout=10) == "COMPLETED"
+
+    args = fake_slurm.read_text().split()
+    assert args[:2] == ["--parsable", "--dependency=afterok:1:2"]
+    script = open(args[2]).read()
+    assert f"#SBATCH --chdir={tmp_path}" in script
+    assert "#SBATCH --job-name=job" in script
+    assert script.rstrip().endswith("exit $status")
+
+
+def test_python_jobs_render_valid_code(fake_slurm, tmp_path):
+    logs_dir = str(tmp_path / "logs")
+    futures = [
+        service_chelsa.job_vSensor(
+            "../it's.txt",
+            "../logs/feedback/",
+            "../logs/diff/",
+            logs_dir,
+            wait=False,
+        ),
+        service_chelsa.job_intaker(
+            "../list.txt", "/data/out dir", logs_dir, wait=False
+        ),
+    ]
+    # Let the tracker finish before PATH is restored
+    assert [future.result(timeout=10) for future in futures] == [
+        "COMPLETED",
+        "COMPLETED",
+    ]
+
+    scripts = [
+        line.split()[-1] for line in fake_slurm.read_text().splitlines()
+    ]
+    codes = []
+    for script_path in scripts:
+        command = next(
+            line for line in open(script_path) if "python3 -c" in line
+        )
+        assert command.startswith("cd workflows && ")
+        codes.append(shlex.split(command)[-1])
+    for code in codes:
+        compile(code, "job", "exec")
+    assert codes[0].endswith(
+        "vSensor(\"../it's.txt\", '../logs/feedback/', '../logs/diff/')"
+    )
+    assert codes[1].endswith("output_dir='/data/out dir')")
+
+
+@pytest.mark.parametrize(
+    "module", [EASIN, GBIF, IAS, eLTER, railways, roads, samplingEfforts]
+)
+def test_job_process_does_not_wait_by_default(fake_slurm, tmp_path, module):
+    future = module.job_process(
+        "workflows/process/job.R", str(tmp_path / "logs")
+    )
+    assert isinstance(future, slurm.SlurmFuture)
+    assert future.job_id == "4242"
+    assert future.result(timeout=10) == "COMPLETED"
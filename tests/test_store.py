@@ -0,0 +1,90 @@
+import json
+
+from feedbackloop.store import SnapshotStore
+
+
+def test_rows_with_different_keys(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    snapshot = [
+        {"name": "a", "size": 1},
+        {"name": "b", "size": 2, "x-amz-meta": {"owner": "wsl"}},
+        {"name": "c", "tags": ["v2.1"], "size": 3.5},
+    ]
+    store.append(snapshot, timestamp=100)
+    assert SnapshotStore(str(tmp_path)).latest() == snapshot
+
+
+def test_mixed_types_fall_back_to_json(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    snapshot = [{"name": "a", "version": 1}, {"name": "b", "version": "v2"}]
+    store.append(snapshot, timestamp=100)
+    assert store.latest() == snapshot
+
+
+def test_compact_promotes_int_and_double(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    store.append([{"name": "a", "size": 1}], timestamp=100)
+    store.append([{"name": "a", "size": 1.5}], timestamp=200)
+    store.append(
+        [{"name": "a", "size": 2}, {"name": "b", "etag": "e"}], timestamp=300
+    )
+    assert store.compact() == 3
+    store = SnapshotStore(str(tmp_path))
+    assert [store.read(run) for run in store.runs] == [
+        [{"name": "a", "size": 1}],
+        [{"name": "a", "size": 1.5}],
+        [{"name": "a", "size": 2}, {"name": "b", "etag": "e"}],
+    ]
+
+
+def test_imports_legacy_json_history(tmp_path):
+    for timestamp, size in ((1699881271, 1), (1717587346, 2)):
+        with open(tmp_path / f"clms-{timestamp}.json", "w") as f:
+            json.dump([{"UID": "u1", "size": size}], f)
+    (tmp_path / "catalogue.json").write_text("{}")
+    store = SnapshotStore(str(tmp_path))
+    assert [run["timestamp"] for run in store.runs] == [1699881271, 1717587346]
+    assert store.latest() == [{"UID": "u1", "size": 2}]
+    # Imported once, the index is the history from then on
+    store.append([{"UID": "u1", "size": 3}], timestamp=1800000000)
+    assert len(SnapshotStore(str(tmp_path)).runs) == 3
+
+
+def test_explicit_nulls_are_kept(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    snapshot = [{"name": "a", "etag": None}, {"name": "b", "size": 2}]
+    store.append(snapshot, timestamp=100)
+    assert SnapshotStore(str(tmp_path)).latest() == snapshot
+
+
+def test_compact_string_and_numeric_runs(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    runs = [
+        [{"name": "a", "version": 1}],
+        [{"name": "a", "version": "v2"}],
+        [{"name": "a", "version": [1, "v3"]}],
+        [{"name": "a", "version": None}],
+    ]
+    for i, snapshot in enumerate(runs):
+        store.append(snapshot, timestamp=100 + i)
+    assert store.compact() == 4
+    store = SnapshotStore(str(tmp_path))
+    assert [store.read(run) for run in store.runs] == runs
+    # A compacted file merges again with later runs
+    store.append([{"name": "a", "version": 2.5}], timestamp=200)
+    assert store.compact() == 2
+    assert store.latest() == [{"name": "a", "version": 2.5}]
+    assert store.read(store.runs[1]) == runs[1]
+
+
+def test_as_of(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    assert store.as_of(100) is None
+    for timestamp in (100, 200):
+        store.append([{"name": "a", "size": timestamp}], timestamp=timestamp)
+    assert store.as_of(50) is None
+    assert store.as_of(150) == [{"name": "a", "size": 100}]
+    store.append([{"name": "a", "size": 300}], timestamp=300)
+    assert store.as_of(300) == [{"name": "a", "size": 300}]
+    store.retain(keep_last=1)
+    assert store.as_of(250) is None
@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+
+import telemetry
+
+
+def test_runs_started_together_get_their_own_id():
+    env = {k: v for k, v in os.environ.items() if k != "WORKFLOW_RUN_ID"}
+    command = [
+        sys.executable,
+        "-c",
+        "import telemetry; print(telemetry.RUN_ID)",
+    ]
+    workflows = os.path.dirname(telemetry.__file__)
+    processes = [
+        subprocess.Popen(
+            command, cwd=workflows, env=env, stdout=subprocess.PIPE, text=True
+        )
+        for _ in range(2)
+    ]
+    run_ids = [process.communicate()[0].strip() for process in processes]
+    assert run_ids[0] != run_ids[1]
+    assert all(
+        run_id.endswith(f"-{process.pid}")
+        for run_id, process in zip(run_ids, processes)
+    )
+
+
+def test_stage_peaks_are_per_stage(tmp_path, monkeypatch):
+    path = str(tmp_path / "telemetry.jsonl")
+    monkeypatch.setattr(telemetry, "TELEMETRY_PATH", path)
+    # Only a child peaking above the earlier children can be seen
+    size_mb = int(telemetry._children_peak_kb() / 1024) + 200
+    with telemetry.stage("child"):
+        subprocess.run(
+            [sys.executable, "-c", f"x = bytearray({size_mb} * 2**20)"],
+            check=True,
+        )
+    with telemetry.stage("idle"):
+        pass
+    child, idle = telemetry.load(path)
+    assert child["children_peak_rss_mb"] >= size_mb
+    assert child["peak_rss_mb"] >= size_mb
+    # The child of the previous stage is not charged to this one
+    assert idle["children_peak_rss_mb"] is None
+    if idle["peak_rss_scope"] == "stage":
+        assert idle["peak_rss_mb"] < child["peak_rss_mb"]
@@ -0,0 +1,79 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from feedbackloop import warp
+from feedbackloop.chelsa import (
+    DOWNSCALE_FACTOR,
+    EUROPE_BOUNDS,
+    TARGET_CRS,
+    _warp_layer,
+)
+from feedbackloop.warp import WarpPlan, get_plan
+
+GRID = (EUROPE_BOUNDS, DOWNSCALE_FACTOR, TARGET_CRS)
+NODATA = -99999
+
+
+def _global_tif(path, values):
+    """Writes a global half-degree lon/lat GeoTIFF."""
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=360,
+        width=720,
+        count=1,
+        dtype="float32",
+        crs="EPSG:4326",
+        transform=from_origin(-180, 90, 0.5, 0.5),
+        nodata=NODATA,
+    ) as dst:
+        dst.write(values.astype(np.float32), 1)
+    return str(path)
+
+
+def _latitudes():
+    return np.repeat(np.linspace(89.75, -89.75, 360)[:, np.newaxis], 720, 1)
+
+
+def test_plan_is_built_once_per_grid(tmp_path, monkeypatch):
+    paths = [
+        _global_tif(
+            tmp_path / f"CHELSA_bio{i}_1981-2010_V.2.1.tif", _latitudes()
+        )
+        for i in (1, 12)
+    ]
+    builds = []
+    build = WarpPlan.build.__func__
+
+    def counted_build(cls, *args):
+        builds.append(args)
+        return build(cls, *args)
+
+    monkeypatch.setattr(warp.WarpPlan, "build", classmethod(counted_build))
+    plans = [get_plan(path, str(tmp_path / "plans"), *GRID) for path in paths]
+    assert plans[0] == plans[1]
+    assert len(builds) == 1
+
+
+def test_plan_averages_like_gdal(tmp_path):
+    path = _global_tif(tmp_path / "lat.tif", _latitudes())
+    plan = WarpPlan.load(get_plan(path, str(tmp_path), *GRID))
+    planned = plan.warp(path, "bio1")["bio1"].values.squeeze()
+    reference = _warp_layer(path, "bio1")["bio1"].values.squeeze()
+    assert planned.shape == reference.shape
+    covered = ~np.isnan(planned)
+    assert covered.mean() > 0.5
+    # GDAL weighs partly covered pixels, the plan counts pixel centres
+    assert np.abs(planned - reference)[covered].max() < 2
+
+
+def test_plan_skips_nodata(tmp_path):
+    values = np.full((360, 720), 7.0)
+    values[::2] = NODATA
+    values[1::4] = np.nan
+    path = _global_tif(tmp_path / "holes.tif", values)
+    plan = WarpPlan.load(get_plan(path, str(tmp_path), *GRID))
+    planned = plan.warp(path, "bio1")["bio1"].values
+    assert np.nanmin(planned) == np.nanmax(planned) == 7
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Scaling benchmark for the keyed snapshot diff against DeepDiff.
+
+Run from the workflows directory:
+
+    python -m benchmarks.diff
+"""
+import random
+import time
+
+import deepdiff
+from feedbackloop.diff import diff
+
+SIZES = [10, 100, 1000, 10000, 100000]
+# DeepDiff is only timed up to this size, beyond it the run takes too long
+DEEPDIFF_MAX = 1000
+PREFIX = "envicloud/chelsa/chelsa_V2/GLOBAL/climatologies/bio"
+
+
+def synthetic_snapshot(n, seed=0):
+    """Builds a CHELSA-like snapshot of n S3 objects."""
+    rng = random.Random(seed)
+    return [
+        {
+            "name": f"{PREFIX}/CHELSA_bio{i}_V.2.1.tif",
+            "ETag": f'"{rng.getrandbits(128):032x}"',
+            "size": rng.randint(10**6, 10**9),
+            "LastModified": "2021-06-01 12:00:00",
+            "type": "file",
+            "StorageClass": "STANDARD",
+        }
+        for i in range(n)
+    ]
+
+
+def mutate(snapshot, fraction=0.01, seed=1):
+    """Returns a shuffled copy of snapshot with a fraction of objects changed,
+    added and removed.
+    """
+    rng = random.Random(seed)
+    new = [dict(item) for item in snapshot]
+    k = max(1, int(len(new) * fraction))
+    for item in rng.sample(new, k):
+        item["ETag"] = f'"{rng.getrandbits(128):032x}"'
+    del new[:k]
+    new.extend(synthetic_snapshot(k, seed=seed + 1))
+    for i, item in enumerate(new[-k:]):
+        item["name"] = f"{item['name']}.new{i}"
+    rng.shuffle(new)
+    return new
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def run(sizes=SIZES):
+    """Times the keyed diff (and DeepDiff for small sizes) for each snapshot
+    size.
+
+    Returns:
+        list of dicts with size, keyed and deepdiff timings in seconds.
+    """
+    results = []
+    for n in sizes:
+        old = synthetic_snapshot(n)
+        new = mutate(old)
+        row = {
+            "size": n,
+            "keyed": timed(
+                diff,
+                old,
+                new,
+                key="name",
+                fields=("ETag", "size", "LastModified"),
+            ),
+            "deepdiff": None,
+        }
+        if n <= DEEPDIFF_MAX:
+            row["deepdiff"] = timed(deepdiff.DeepDiff, old, new, view="tree")
+        results.append(row)
+    return results
+
+
+if __name__ == "__main__":
+    print(f"{'objects':>10} {'keyed (s)':>12} {'deepdiff (s)':>14}")
+    for row in run():
+        deep = f"{row['deepdiff']:.4f}" if row["deepdiff"] is not None else "-"
+        print(f"{row['size']:>10} {row['keyed']:>12.4f} {deep:>14}")
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the merged CHELSA output profiles on the 10 km EU grid.
+
+Writes a synthetic merged dataset with every profile in service.chelsa.PROFILES
+and reports write time, file size and read latency for a spatial window and
+for a single pixel across all layers. Run from the workflows directory:
+
+    python -m benchmarks.profiles
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+import xarray as xr
+
+from service.chelsa import PROFILES, encoding_for
+
+# Shape of the 10 km EPSG:3035 grid for the Europe window of CHELSA
+GRID = (400, 560)
+LAYERS = 19
+WINDOW = 100
+
+
+def synthetic_merged(shape=GRID, layers=LAYERS, seed=0):
+    """Builds a merged-like dataset of smooth float32 bioclim layers."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:shape[0], 0:shape[1]]
+    data_vars = {}
+    for i in range(layers):
+        field = np.sin(x / rng.uniform(20, 80)) + np.cos(
+            y / rng.uniform(20, 80)
+        )
+        field = field * rng.uniform(1, 100) + rng.normal(0, 0.1, shape)
+        data_vars[f"bio{i + 1}"] = (
+            ("band", "y", "x"),
+            field[np.newaxis].astype("float32"),
+        )
+    return xr.Dataset(
+        data_vars,
+        coords={
+            "band": [1],
+            "y": 5.9e6 - 1e4 * np.arange(shape[0]),
+            "x": 1.2e6 + 1e4 * np.arange(shape[1]),
+        },
+    )
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def run(repeat=5):
+    """Times each output profile.
+
+    Returns:
+        dict of profile -> write seconds, size in bytes, window and pixel read
+        seconds.
+    """
+    ds = synthetic_merged()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in PROFILES:
+            path = os.path.join(tmp, f"{name}.nc")
+            write = timed(
+                lambda: ds.to_netcdf(path, encoding=encoding_for(ds, name))
+            )
+
+            def read_window():
+                with xr.open_dataset(path) as f:
+                    f.isel(y=slice(0, WINDOW), x=slice(0, WINDOW)).load()
+
+            def read_pixel():
+                with xr.open_dataset(path) as f:
+                    f.isel(y=GRID[0] // 2, x=GRID[1] // 2).load()
+
+            results[name] = {
+                "write": write,
+                "size": os.path.getsize(path),
+                "window": min(timed(read_window) for _ in range(repeat)),
+                "pixel": min(timed(read_pixel) for _ in range(repeat)),
+            }
+    return results
+
+
+if __name__ == "__main__":
+    print(
+        f"{'profile':>10} {'write (s)':>10} {'size (MB)':>10} "
+        f"{'window (s)':>11} {'pixel (s)':>10}"
+    )
+    for name, row in run().items():
+        print(
+            f"{name:>10} {row['write']:>10.3f} {row['size'] / 1e6:>10.2f} "
+            f"{row['window']:>11.4f} {row['pixel']:>10.4f}"
+        )
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+"""Benchmark suite of the Python data path on synthetic CHELSA-like data.
+
+Times geotiff_to_netcdf, convert2nc, the vSensor snapshot diff, S3 sensing
+against a local moto server (when moto is installed) and intake against a
+local HTTP server. Each case runs in a fresh process so its peak memory is
+its own. Results are stored under ../logs/benchmarks/<commit>.json, or
+$BENCHMARK_RESULTS, outside the sources and ignored by git, and
+compared with a baseline; the run fails when a case is slower or larger
+than the baseline by more than the threshold. Run from the workflows directory:
+
+    python -m benchmarks.suite [--scale DEG] [--baseline REF] [--threshold T]
+"""
+import argparse
+import functools
+import http.server
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+from benchmarks.warp import synthetic_geotiff
+
+RESULTS_DIR = os.environ.get("BENCHMARK_RESULTS", "../logs/benchmarks")
+THRESHOLD = 0.2
+# Cases shorter than this are too noisy to compare
+MIN_SECONDS = 0.05
+
+VARIABLES = ["bio1", "bio2", "bio3", "bio4"]
+MODELS = ["gfdl-esm4", "ipsl-cm6a-lr"]
+SCENARIOS = ["ssp126", "ssp585"]
+GRID = (400, 560)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def _peak_rss_mb():
+    from telemetry import peak_rss_mb
+
+    return peak_rss_mb()
+
+
+def make_geotiffs(directory, scale):
+    """Writes one synthetic global GeoTIFF per variable; scale is the
+    resolution in degrees.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for variable in VARIABLES:
+        synthetic_geotiff(
+            os.path.join(directory, f"CHELSA_{variable}_1981-2010_V.2.1.tif"),
+            scale,
+        )
+    return directory
+
+
+def make_netcdfs(directory, scale):
+    """Writes per-layer NetCDFs with the attributes of the processed CHELSA
+    layers.
+
+    The grid is the 10 km EU grid, shrunk or grown with scale relative to 0.1
+    degrees.
+    """
+    os.makedirs(directory, exist_ok=True)
+    factor = 0.1 / scale
+    height, width = int(GRID[0] * factor), int(GRID[1] * factor)
+    rng = np.random.default_rng(0)
+    for model in MODELS:
+        for scenario in SCENARIOS:
+            for variable in VARIABLES:
+                name = f"{variable}_2011-2040_{model}_{scenario}"
+                data = rng.normal(0, 1, (1, height, width)).astype("float32")
+                ds = xr.Dataset(
+                    {name: (("band", "y", "x"), data)},
+                    coords={
+                        "band": [1],
+                        "y": 5.9e6 - 1e4 / factor * np.arange(height),
+                        "x": 1.2e6 + 1e4 / factor * np.arange(width),
+                    },
+                    # Dataset attributes written by the R processing, dropped
+                    # when merging
+                    attrs={
+                        "Var": variable,
+                        "Long_name": variable,
+                        "unit": "1",
+                        "explanation": variable,
+                        "created_by": "benchmarks.suite",
+                        "date": "2024-01-01",
+                    },
+                )
+                ds[name].attrs.update(
+                    ClimModel=model,
+                    ClimScenario=scenario,
+                    TimePeriod="2011-2040",
+                    explanation=variable,
+                )
+                ds.to_netcdf(os.path.join(directory, f"{name}.nc"))
+    return directory
+
+
+def make_snapshot(count, seed=0):
+    """Builds an S3-like snapshot of count objects."""
+    rng = np.random.default_rng(seed)
+    return [
+        {
+            "name": f"envicloud/chelsa/obj_{i}.tif",
+            "ETag": f'"{rng.integers(1 << 60):x}"',
+            "size": int(rng.integers(1 << 20, 1 << 30)),
+            "LastModified": "2024-01-01 00:00:00",
+            "type": "file",
+        }
+        for i in range(count)
+    ]
+
+
+def case_geotiff_to_netcdf(workdir, scale):
+    from feedbackloop.chelsa import geotiff_to_netcdf
+
+    source = make_geotiffs(os.path.join(workdir, "tif"), scale)
+    start = time.perf_counter()
+    geotiff_to_netcdf(source, os.path.join(workdir, "nc"), max_workers=2)
+    seconds = time.perf_counter() - start
+    size = sum(
+        os.path.getsize(os.path.join(source, f)) for f in os.listdir(source)
+    )
+    return {"seconds": seconds, "throughput_mb_s": size / 1e6 / seconds}
+
+
+def case_convert2nc(workdir, scale):
+    from service.chelsa import convert2nc
+
+    source = make_netcdfs(os.path.join(workdir, "layers"), scale)
+    output = os.path.join(workdir, "merged")
+    os.makedirs(output, exist_ok=True)
+    start = time.perf_counter()
+    convert2nc(source, output, max_workers=2, profile="balanced")
+    seconds = time.perf_counter() - start
+    size = sum(
+        os.path.getsize(os.path.join(source, f)) for f in os.listdir(source)
+    )
+    return {"seconds": seconds, "throughput_mb_s": size / 1e6 / seconds}
+
+
+def case_vsensor_diff(workdir, scale):
+    from feedbackloop.diff import diff
+    from feedbackloop.store import SnapshotStore
+
+    count = int(20000 * 0.1 / scale)
+    old, new = make_snapshot(count, 0), make_snapshot(count, 0)
+    for item in new[::100]:
+        item["ETag"] = '"changed"'
+    store = SnapshotStore(os.path.join(workdir, "store"))
+    start = time.perf_counter()
+    store.append(old, timestamp=1)
+    store.append(new, timestamp=2)
+    diff(
+        store.previous(),
+        store.latest(),
+        key="name",
+        fields=("ETag", "size", "LastModified"),
+    )
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "objects_s": count / seconds}
+
+
+def case_sense_s3(workdir, scale):
+    try:
+        import boto3
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        return {"skipped": "moto is not installed"}
+    from feedbackloop.chelsa import sense
+
+    port = _free_port()
+    server = ThreadedMotoServer(port=port, verbose=False)
+    server.start()
+    try:
+        endpoint = f"http://127.0.0.1:{port}/"
+        client = boto3.client(
+            "s3",
+            endpoint_url=endpoint,
+            region_name="us-east-1",
+            aws_access_key_id="bench",
+            aws_secret_access_key="bench",
+        )
+        client.create_bucket(Bucket="envicloud")
+        client.put_bucket_policy(
+            Bucket="envicloud",
+            Policy=json.dumps(
+                {
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Principal": "*",
+                            "Action": "s3:*",
+                            "Resource": [
+                                "arn:aws:s3:::envicloud",
+                                "arn:aws:s3:::envicloud/*",
+                            ],
+                        }
+                    ]
+                }
+            ),
+        )
+        count = int(200 * 0.1 / scale)
+        paths = []
+        for i in range(count):
+            key = f"chelsa/{i % 4}/obj_{i}.tif"
+            client.put_object(Bucket="envicloud", Key=key, Body=b"x" * 1024)
+            paths.append(f"envicloud/{key}")
+        start = time.perf_counter()
+        sense(paths, endpoint=endpoint)
+        seconds = time.perf_counter() - start
+    finally:
+        server.stop()
+    return {"seconds": seconds, "objects_s": count / seconds}
+
+
+def case_intake_http(workdir, scale):
+    from feedbackloop.chelsa import intaker
+
+    served = os.path.join(workdir, "served")
+    os.makedirs(os.path.join(served, "chelsa"), exist_ok=True)
+    count, size = 16, int(4e6 * 0.1 / scale)
+    snapshot, names = [], []
+    for i in range(count):
+        name = f"chelsa/file_{i}.tif"
+        with open(os.path.join(served, name), "wb") as f:
+            f.write(os.urandom(size))
+        names.append(name)
+        snapshot.append(
+            {
+                "name": name,
+                "ETag": str(i),
+                "size": size,
+                "LastModified": "2024-01-01 00:00:00",
+            }
+        )
+    with open(os.path.join(workdir, "list.txt"), "w") as f:
+        f.write("\n".join(names) + "\n")
+    with open(os.path.join(workdir, "snapshot.json"), "w") as f:
+        json.dump(snapshot, f)
+
+    handler = functools.partial(_QuietHandler, directory=served)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        start = time.perf_counter()
+        ok = intaker(
+            os.path.join(workdir, "list.txt"),
+            os.path.join(workdir, "raw"),
+            endpoint=f"http://127.0.0.1:{server.server_address[1]}/",
+            snapshot=os.path.join(workdir, "snapshot.json"),
+        )
+        seconds = time.perf_counter() - start
+    finally:
+        server.shutdown()
+    if not ok:
+        raise RuntimeError("intake failed")
+    return {
+        "seconds": seconds,
+        "throughput_mb_s": count * size / 1e6 / seconds,
+    }
+
+
+CASES = {
+    "geotiff_to_netcdf": case_geotiff_to_netcdf,
+    "convert2nc": case_convert2nc,
+    "vsensor_diff": case_vsensor_diff,
+    "sense_s3": case_sense_s3,
+    "intake_http": case_intake_http,
+}
+
+
+def _run_case(name, scale):
+    """Runs one case in a scratch directory and adds the peak memory of the
+    process.
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        result = CASES[name](workdir, scale)
+    if "skipped" not in result:
+        result["peak_rss_mb"] = _peak_rss_mb()
+    return result
+
+
+def run(scale=0.1, cases=None):
+    """
+    Runs the benchmark cases, each in a fresh process.
+    :param scale: The resolution in degrees of the synthetic global rasters;
+        smaller is larger.
+    :param cases: The case names, defaults to all.
+
+    Returns:
+        dict of case name -> measurements.
+    """
+    results = {}
+    # Stage telemetry of the benchmarked functions stays out of the workflow
+    # log
+    os.environ["WORKFLOW_TELEMETRY"] = os.path.join(
+        tempfile.gettempdir(), "benchmark-telemetry.jsonl"
+    )
+    context = multiprocessing.get_context("spawn")
+    for name in cases or CASES:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results[name] = pool.submit(_run_case, name, scale).result()
+    return results
+
+
+def commit():
+    """Returns the short hash of the checked out commit, or "local" outside
+    git.
+    """
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "local"
+
+
+def save(results, scale, name=None):
+    """Stores results under RESULTS_DIR and returns the file path."""
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{name or commit()}.json")
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "commit": name or commit(),
+                "time": time.time(),
+                "scale": scale,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    return path
+
+
+def load_baseline(baseline, exclude):
+    """Loads a baseline given as a commit or a file; defaults to the newest
+    other stored result.
+    """
+    if baseline is None:
+        stored = (
+            [
+                os.path.join(RESULTS_DIR, f)
+                for f in os.listdir(RESULTS_DIR)
+                if f.endswith(".json")
+                and os.path.join(RESULTS_DIR, f) != exclude
+            ]
+            if os.path.isdir(RESULTS_DIR)
+            else []
+        )
+        if not stored:
+            return None
+        baseline = max(stored, key=os.path.getmtime)
+    elif not os.path.exists(baseline):
+        baseline = os.path.join(RESULTS_DIR, f"{baseline}.json")
+    with open(baseline) as f:
+        return json.load(f)
+
+
+def regressions(baseline, results, threshold=THRESHOLD):
+    """Returns (case, metric, base, new) for every time or memory increase
+    above threshold.
+    """
+    found = []
+    for name, result in results.items():
+        base = baseline["results"].get(name, {})
+        for metric in ("seconds", "peak_rss_mb"):
+            if metric not in base or metric not in result:
+                continue
+            if metric == "seconds" and base[metric] < MIN_SECONDS:
+                continue
+            if result[metric] > base[metric] * (1 + threshold):
+                found.append((name, metric, base[metric], result[metric]))
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=0.1,
+        help="synthetic raster resolution in degrees",
+    )
+    parser.add_argument(
+        "--cases",
+        nargs="*",
+        choices=list(CASES),
+        help="cases to run, defaults to all",
+    )
+    parser.add_argument(
+        "--baseline",
+        help="commit or result file to compare with, defaults to the newest "
+             "stored",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=THRESHOLD,
+        help="allowed relative increase",
+    )
+    parser.add_argument(
+        "--name", help="name of the stored result, defaults to the commit"
+    )
+    args = parser.parse_args()
+
+    results = run(args.scale, args.cases)
+    print(f"{'case':>18} {'seconds':>9} {'peak MB':>9}  throughput")
+    for name, result in results.items():
+        if "skipped" in result:
+            print(f"{name:>18}  skipped: {result['skipped']}")
+            continue
+        rate = ", ".join(
+            f"{k}={v:.1f}"
+            for k, v in result.items()
+            if k.endswith("_s") and k != "seconds"
+        )
+        print(
+            f"{name:>18} {result['seconds']:>9.3f} "
+            f"{result['peak_rss_mb']:>9.1f}  {rate}"
+        )
+    path = save(results, args.scale, args.name)
+    print(f"results saved to {path}")
+
+    baseline = load_baseline(args.baseline, path)
+    if baseline is None:
+        print("no baseline to compare with")
+        sys.exit(0)
+    if baseline.get("scale") != args.scale:
+        print(
+            f"warning: baseline {baseline['commit']} ran at scale "
+            f"{baseline.get('scale')}"
+        )
+    found = regressions(baseline, results, args.threshold)
+    for name, metric, base, new in found:
+        print(
+            f"REGRESSION {name} {metric}: {base:.3f} -> {new:.3f} vs "
+            f"{baseline['commit']}"
+        )
+    sys.exit(1 if found else 0)
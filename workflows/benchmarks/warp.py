@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the CHELSA warp paths on a synthetic global raster.
+
+Compares the original rioxarray clip/reproject/resample chain, the single
+WarpedVRT warp and a cached WarpPlan remap. Run from the workflows directory:
+
+    python -m benchmarks.warp [resolution in degrees]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+import rioxarray as rxr
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+
+from feedbackloop.chelsa import (
+    DOWNSCALE_FACTOR,
+    EUROPE_BOUNDS,
+    TARGET_CRS,
+    _warp_layer,
+)
+from feedbackloop.warp import WarpPlan, get_plan
+
+NAME = "CHELSA_bio1_1981-2010"
+
+
+def synthetic_geotiff(path, resolution=0.05):
+    """Writes a smooth global float32 GeoTIFF on a regular lon/lat grid."""
+    width, height = int(360 / resolution), int(180 / resolution)
+    y, x = np.mgrid[0:height, 0:width]
+    data = (np.sin(x / (width / 50)) + np.cos(y / (height / 30))).astype(
+        "float32"
+    ) * 10
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=1,
+        dtype="float32",
+        crs="EPSG:4326",
+        transform=from_origin(-180, 90, resolution, resolution),
+        nodata=-9999,
+        tiled=True,
+    ) as dst:
+        dst.write(data, 1)
+    return path
+
+
+def rioxarray_path(path):
+    """The original geotiff_to_netcdf processing chain."""
+    data = rxr.open_rasterio(path, masked=True).rio.clip_box(*EUROPE_BOUNDS)
+    data = data.rio.reproject(TARGET_CRS)
+    shape = (
+        int(data.rio.height * DOWNSCALE_FACTOR),
+        int(data.rio.width * DOWNSCALE_FACTOR),
+    )
+    return data.rio.reproject(
+        data.rio.crs, shape=shape, resampling=Resampling.average
+    )
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def run(resolution=0.05, repeat=3):
+    """Times each warp path on a synthetic raster.
+
+    Returns:
+        dict of path name -> best time in seconds, plus the plan build time.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = synthetic_geotiff(
+            os.path.join(tmp, f"{NAME}_V.2.1.tif"), resolution
+        )
+        build, plan_path = timed(
+            get_plan, path, tmp, EUROPE_BOUNDS, DOWNSCALE_FACTOR, TARGET_CRS
+        )
+        plan = WarpPlan.load(plan_path)
+        results = {"plan build": build}
+        for label, func in [
+            ("rioxarray", lambda: rioxarray_path(path).load()),
+            ("warped vrt", lambda: _warp_layer(path, NAME)),
+            ("warp plan", lambda: plan.warp(path, NAME)),
+        ]:
+            results[label] = min(timed(func)[0] for _ in range(repeat))
+    return results
+
+
+if __name__ == "__main__":
+    resolution = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+    print(f"synthetic global raster at {resolution} degrees")
+    for label, seconds in run(resolution).items():
+        print(f"{label:>12} {seconds:>10.4f} s")
@@ -5,6 +5,9 @@ from feedbackloop.corine import (
     intaker as clc_intaker,
 )
 from state.rocrates import action_one
+from service.corine import job_aggregate as corine_job_aggregate
+from service.pipeline import CORINE_PROCESSED, CORINE_RASTER, run_pipeline
+from service.slurm import wait_all
 
 
 """ 
@@ -23,7 +26,6 @@ def task_setup():
 def task_chelsa():
     """CHELSA Task"""
     return {
-        "depen"
         "actions": [
             (chelsa_vSensor, [], {
                 'path_file': '/users/khantaim/iasdt-workflows/references/chelsa/test.txt',
@@ -31,23 +33,79 @@ def task_chelsa():
                 'logs_diff': '/users/khantaim/iasdt-workflows/logs/diff/chelsa/'}),
             (chelsa_intaker, [], {
                 'path_to_download_list': '/users/khantaim/iasdt-workflows/references/chelsa/test.txt',
-                'output_dir': '/users/khantaim/iasdt-workflows/datasets/raw/chelsa/'}),
+                'output_dir': '/users/khantaim/iasdt-workflows/datasets/raw/chelsa/',
+                'snapshot': '/users/khantaim/iasdt-workflows/logs/feedback/chelsa/'}),
             "Rscript /pfs/lustrep3/users/khantaim/iasdt-workflows/workflows/process/chelsa.R"
         ],
     }
 
-""" 
+
+def queue_job(job, *args):
+    """Queues a SLURM job without waiting for it, as a doit action"""
+    future = job(*args)
+    print(f"Queued as job {future.job_id}")
+    return True
+
+
+def intake_corine(credentials, logs_folder, output_dir):
+    """Downloads the new CORINE data with a fresh CLMS token"""
+    return clc_intaker(clc_get_token(credentials), logs_folder, output_dir)
+
+
 def task_corine():
-    #CLC Task
+    """CLC Task, aggregated to the 10 km grid on a small SLURM allocation"""
     return {
         "actions": [
-            clc_get_token("../references/corine/clc.json"),
-            clc_vSensor(""),
-            clc_intaker("aaccessToken", "../logs/feedback/corine/*.json","../datasets/raw/corine"),
+            (clc_vSensor, ["../logs/feedback/corine/"]),
+            (intake_corine, [
+                "../references/corine/clc.json",
+                "../logs/feedback/corine/",
+                "../datasets/raw/corine/"]),
+            (queue_job, [
+                corine_job_aggregate,
+                f"../{CORINE_RASTER}",
+                f"../{CORINE_PROCESSED}",
+                "../logs/"]),
         ],
     }
 
- """
+
+def queue_pipeline(logs_dir, dry_run, wait):
+    """Queues the workflow, waiting for every job only when asked to"""
+    futures = run_pipeline(logs_dir, dry_run=dry_run)
+    if wait:
+        return all(wait_all(futures).values())
+    return True
+
+
+def task_pipeline():
+    """Queue the whole workflow on SLURM as one dependency graph"""
+    return {
+        "actions": [
+            (
+                queue_pipeline,
+                [],
+                {"logs_dir": "/users/khantaim/iasdt-workflows/logs/"},
+            ),
+        ],
+        "params": [
+            {
+                "name": "dry_run",
+                "long": "dry-run",
+                "type": bool,
+                "default": False,
+                "help": "Print the job graph without submitting it",
+            },
+            {
+                "name": "wait",
+                "long": "wait",
+                "type": bool,
+                "default": False,
+                "help": "Block until every job has finished",
+            },
+        ],
+        "verbosity": 2,
+    }
 
 
 def task_service():
@@ -59,4 +117,4 @@ def task_service():
                 "output": "output",
                 }),
         ],
-    }
\ No newline at end of file
+    }
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed cache of raw input files shared by the intakers.
+
+Objects are stored under ``<directory>/objects/<xx>/<key>``, where the key is
+the SHA-256 of the upstream URL and its version (the ETag, or size and
+LastModified). Intakers expose cached objects in ``datasets/raw/<source>``
+with hardlinks, or symlinks across file systems, so wiping the raw
+directories or rerunning a workflow does not refetch unchanged objects.
+The cache can live in a project directory shared by several users; least
+recently used objects are evicted when it grows beyond its size cap.
+"""
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from logger_base import logger
+from feedbackloop.download import download_file, filename_from_url
+
+# Group-writable files and setgid directories so project members share the
+# cache
+FILE_MODE = 0o664
+DIR_MODE = 0o2775
+
+
+def version_of(metadata):
+    """Returns the version of an object from its S3 metadata, preferring the
+    ETag.
+
+    Returns:
+        The ETag, or size and LastModified, or None when the metadata has
+        neither and the object must not be served from the cache.
+    """
+    metadata = metadata or {}
+    etag = metadata.get("ETag")
+    if etag:
+        return etag.strip('"')
+    if metadata.get("size") is None or not metadata.get("LastModified"):
+        return None
+    return f"{metadata['size']}-{metadata['LastModified']}"
+
+
+class ObjectCache:
+    """Content-addressed store of downloaded objects.
+
+    :param directory: The cache directory, e.g. a project directory shared by
+        the team.
+    :param max_bytes: Evict least recently used objects above this size. None
+        keeps everything.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(directory, "objects")
+        self.tmp_dir = os.path.join(directory, "tmp")
+        for path in (directory, self.objects_dir, self.tmp_dir):
+            self._makedirs(path)
+
+    @staticmethod
+    def _makedirs(path):
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+            try:
+                os.chmod(path, DIR_MODE)
+            except PermissionError:
+                pass
+
+    @staticmethod
+    def key(url, version):
+        """Returns the cache key of a URL at a given version."""
+        return hashlib.sha256(f"{url}\0{version}".encode()).hexdigest()
+
+    def path(self, key):
+        """Returns the object path of a key."""
+        return os.path.join(self.objects_dir, key[:2], key)
+
+    def get(self, url, version):
+        """Returns the cached path of a URL at a version, or None, and marks it
+        as used.
+        """
+        path = self.path(self.key(url, version))
+        if not os.path.exists(path):
+            return None
+        # The sidecar's mtime records the last use, the object itself is left
+        # untouched
+        try:
+            os.utime(f"{path}.json")
+        except OSError:
+            pass
+        return path
+
+    def put(self, url, version, source_path):
+        """Moves a downloaded file into the cache and returns its cached path.
+        """
+        key = self.key(url, version)
+        path = self.path(key)
+        self._makedirs(os.path.dirname(path))
+        tmp_path = os.path.join(self.tmp_dir, f"{key}.{uuid.uuid4().hex}")
+        try:
+            os.replace(source_path, tmp_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(source_path, tmp_path)
+            os.remove(source_path)
+        os.chmod(tmp_path, FILE_MODE)
+        with open(f"{tmp_path}.json", "w") as f:
+            json.dump(
+                {
+                    "url": url,
+                    "version": version,
+                    "size": os.path.getsize(tmp_path),
+                    "added": time.time(),
+                },
+                f,
+            )
+        os.chmod(f"{tmp_path}.json", FILE_MODE)
+        # The sidecar goes first so every visible object has one
+        os.replace(f"{tmp_path}.json", f"{path}.json")
+        os.replace(tmp_path, path)
+        return path
+
+    @staticmethod
+    def link(path, destination):
+        """Exposes a cached object at destination with a hardlink, or a symlink
+        across file systems.
+
+        Returns:
+            "hardlink" or "symlink".
+        """
+        os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+        tmp_path = f"{destination}.{uuid.uuid4().hex}.link"
+        try:
+            os.link(path, tmp_path)
+            kind = "hardlink"
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            os.symlink(os.path.abspath(path), tmp_path)
+            kind = "symlink"
+        os.replace(tmp_path, destination)
+        return kind
+
+    def fetch(self, url, version, output_dir, **kwargs):
+        """Exposes url in output_dir from the cache, downloading it first if
+        needed.
+
+        Objects without a version bypass the cache: they are downloaded into
+        output_dir and not stored.
+
+        :param url: The URL of the object.
+        :param version: The object version, see :func:`version_of`.
+        :param output_dir: The raw data directory the file is exposed in.
+        :param kwargs: Passed on to :func:`download_file`.
+
+        Returns:
+            dict like :func:`download_file`, with status "cached" for cache
+            hits.
+        """
+        if version is None:
+            os.makedirs(output_dir, exist_ok=True)
+            return download_file(url, output_dir, overwrite=True, **kwargs)
+        destination = os.path.join(output_dir, filename_from_url(url))
+        result = self._serve(url, version, destination)
+        if result is not None:
+            return result
+
+        # Download into the staging directory of the URL inside the cache,
+        # then publish. The directory is kept when the download fails, so the
+        # next attempt or run resumes the partial file, and is only removed
+        # once the object is stored.
+        staging = self.staging_dir(url)
+        with open(f"{staging}.lock", "a") as lock:
+            # One process downloads a URL at a time
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another process may have published it while we waited
+            result = self._serve(url, version, destination)
+            if result is not None:
+                return result
+            self._makedirs(staging)
+            result = download_file(url, staging, overwrite=True, **kwargs)
+            if result["status"] != "done":
+                return result
+            # Link the download before publishing it, so an eviction cannot
+            # remove it first
+            kind = self.link(result["path"], destination)
+            path = self.put(url, version, result["path"])
+            shutil.rmtree(staging, ignore_errors=True)
+        result["path"] = destination
+        if kind == "symlink":
+            result = self._relink(
+                path, destination, result, output_dir, **kwargs
+            )
+        return result
+
+    def staging_dir(self, url):
+        """Returns the directory a URL is downloaded into before it is
+        stored.
+        """
+        return os.path.join(
+            self.tmp_dir, hashlib.sha256(url.encode()).hexdigest()
+        )
+
+    def _serve(self, url, version, destination):
+        """Links a cached object to destination.
+
+        Returns:
+            dict like :func:`download_file` with status "cached", or None when
+            the object is not cached.
+        """
+        cached = self.get(url, version)
+        if cached is None:
+            return None
+        try:
+            self.link(cached, destination)
+        except FileNotFoundError:
+            # Evicted by another process between the lookup and the link
+            logger.info(f"{url} was evicted from the cache, fetching it again")
+            return None
+        return {
+            "url": url,
+            "path": destination,
+            "status": "cached",
+            "bytes": 0,
+            "seconds": 0.0,
+            "error": None,
+        }
+
+    def _relink(self, path, destination, result, output_dir, **kwargs):
+        """Points a symlink at the published object, downloading outside the
+        cache if it was evicted.
+        """
+        try:
+            self.link(path, destination)
+            return result
+        except FileNotFoundError:
+            logger.info(
+                f"{result['url']} was evicted from the cache, downloading it "
+                "outside the cache"
+            )
+            return download_file(
+                result["url"], output_dir, overwrite=True, **kwargs
+            )
+
+    def fetch_all(self, items, output_dir, max_workers=8, **kwargs):
+        """Fetches many (url, version) pairs concurrently.
+
+        Returns:
+            dict like :func:`download_all`, with a "cached" count.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        start = time.monotonic()
+        results = []
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(self.fetch, url, version, output_dir, **kwargs)
+                for url, version in items
+            ]
+            for future in as_completed(futures):
+                res = future.result()
+                results.append(res)
+                if res["status"] == "failed":
+                    logger.error(
+                        f"failed to download {res['url']}: {res['error']}"
+                    )
+        elapsed = time.monotonic() - start
+        total_bytes = sum(r["bytes"] for r in results)
+        summary = {
+            "files": results,
+            "done": sum(r["status"] in ("done", "cached") for r in results),
+            "cached": sum(r["status"] == "cached" for r in results),
+            "skipped": 0,
+            "failed": sum(r["status"] == "failed" for r in results),
+            "bytes": total_bytes,
+            "seconds": elapsed,
+            "throughput": total_bytes / max(elapsed, 1e-9) / 1e6,
+        }
+        logger.info(
+            f"fetched {summary['done']} files ({summary['cached']} from the "
+            "cache), "
+            f"failed {summary['failed']}: {total_bytes} bytes downloaded in "
+            f"{elapsed:.1f}s"
+        )
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+        return summary
+
+    def entries(self):
+        """Returns (last used, size, path) for every cached object."""
+        entries = []
+        for root, _, files in os.walk(self.objects_dir):
+            for name in files:
+                if name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    used = os.path.getmtime(f"{path}.json")
+                    entries.append((used, os.path.getsize(path), path))
+                except OSError:
+                    continue
+        return entries
+
+    def size(self):
+        """Returns the total size of the cached objects in bytes."""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes=None):
+        """Removes least recently used objects until the cache fits in
+        max_bytes.
+
+        Raw files hardlinked from the cache keep their data; symlinked ones are
+        refetched by the next intake.
+
+        Returns:
+            The number of bytes removed.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        # Only one process evicts at a time
+        with open(os.path.join(self.directory, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            for _, size, path in entries:
+                if total - removed <= max_bytes:
+                    break
+                for p in (path, f"{path}.json"):
+                    try:
+                        os.remove(p)
+                    except FileNotFoundError:
+                        pass
+                removed += size
+        if removed:
+            logger.info(f"evicted {removed} bytes from {self.directory}")
+        return removed
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
-import sys, glob, os, json, hashlib, time
+import asyncio
+import json
+import os
+import posixpath
+import time
 from pathlib import Path
-import wget
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import pyproj
 import netCDF4
@@ -9,139 +13,600 @@ import xarray as xr
 import rioxarray as rxr
 import rasterio
 from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
 import pandas as pd
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 import s3fs
-import deepdiff
 from logger_base import logger
+from telemetry import stage, tree_bytes
+from feedbackloop.download import (
+    PART_SUFFIX,
+    discard_part,
+    download_all,
+    filename_from_url,
+    part_validator,
+)
+from feedbackloop.cache import ObjectCache, version_of
+from feedbackloop.diff import diff, is_empty
+from feedbackloop.store import SnapshotStore
+from feedbackloop.warp import WarpPlan, get_plan, target_grid
+from feedbackloop.cube import (
+    init_cube,
+    write_layer,
+    consolidate,
+    layer_name,
+    parse_chelsa_name,
+)
+
+# TODO: Change URL string to environment variable
+ENDPOINT = "https://os.zhdk.cloud.switch.ch/"
+MANIFEST_FIELDS = ("ETag", "size", "LastModified")
+# Bounding box for Europe and the 10 km target grid
+EUROPE_BOUNDS = [-25, 35, 45, 75]
+TARGET_CRS = "EPSG:3035"
+DOWNSCALE_FACTOR = 1 / 10
+# Fields of a snapshot record, found both in a listing entry and in what
+# s3.info returns for the object
+INFO_FIELDS = ("ETag", "LastModified", "size", "name", "type", "StorageClass")
+
+
+def is_url(entry):
+    """Tells whether a download list entry is a full URL rather than an S3
+    path.
+    """
+    return "://" in entry
+
+
+def s3_path(entry, endpoint=ENDPOINT):
+    """Returns the S3 path (bucket/key) of a download list entry or URL.
+
+    URLs on another host are returned unchanged.
+    """
+    entry = entry.strip()
+    if entry.startswith(endpoint):
+        entry = entry[len(endpoint):]
+    elif is_url(entry):
+        return entry
+    return entry.lstrip("/")
+
+
+def entry_url(path, endpoint=ENDPOINT):
+    """Returns the download URL of an S3 path, or the path itself if it is a
+    URL.
+    """
+    return path if is_url(path) else f"{endpoint}{path}"
+
+
+def _record(info):
+    """Returns the snapshot record of an object from a listing entry or
+    s3.info, so both sensing modes write the same fields.
+    """
+    record = {k: info.get(k) for k in INFO_FIELDS}
+    record["LastModified"] = record["LastModified"].strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+    return record
+
+
+def _sense_serial(paths, endpoint):
+    """Queries the info of each path, one blocking call after another."""
+    s3 = s3fs.S3FileSystem(anon=True, endpoint_url=endpoint)
+    snapshot = []
+    for path in paths:
+        try:
+            info = s3.info(path=path)
+        except FileNotFoundError:
+            logger.warning(f"{path} is no longer on the server, skipping it")
+            continue
+        snapshot.append(_record(info))
+    return snapshot, len(paths)
+
+
+async def _sense_batched(paths, endpoint, max_concurrency):
+    """Lists each prefix once and only HEADs the objects the listings do not
+    describe.
+    """
+    s3 = s3fs.S3FileSystem(anon=True, endpoint_url=endpoint, asynchronous=True)
+    session = await s3.set_session()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    calls = 0
+
+    async def bounded(func, *args, **kwargs):
+        nonlocal calls
+        async with semaphore:
+            calls += 1
+            return await func(*args, **kwargs)
+
+    try:
+        # One listing per prefix provides size, ETag and LastModified
+        prefixes = sorted({posixpath.dirname(path) for path in paths})
+        listings = await asyncio.gather(
+            *[bounded(s3._ls, prefix, detail=True) for prefix in prefixes],
+            return_exceptions=True,
+        )
+        infos = {}
+        for prefix, listing in zip(prefixes, listings):
+            if isinstance(listing, Exception):
+                logger.warning(
+                    f"listing {prefix} failed, falling back to HEAD: {listing}"
+                )
+                continue
+            for entry in listing:
+                infos[entry["name"]] = entry
+
+        # Objects missing from the listings, or listed without the compared
+        # fields, get a HEAD
+        missing = [
+            path
+            for path in paths
+            if not all(k in infos.get(path, {}) for k in MANIFEST_FIELDS)
+        ]
+        heads = await asyncio.gather(
+            *[bounded(s3._info, path) for path in missing],
+            return_exceptions=True,
+        )
+        for path, info in zip(missing, heads):
+            if isinstance(info, Exception):
+                # e.g. removed between the listing and the HEAD
+                logger.warning(f"HEAD of {path} failed, skipping it: {info}")
+                infos.pop(path, None)
+            else:
+                infos[path] = info
+    finally:
+        await session.close()
+
+    snapshot = [_record(infos[path]) for path in paths if path in infos]
+    return snapshot, calls
+
+
+def sense(paths, endpoint=ENDPOINT, batched=True, max_concurrency=32):
+    """Collects S3 metadata for each CHELSA path.
+
+    In batched mode every prefix is listed once and only objects the listings
+    do not describe are HEADed, concurrently, instead of one blocking call
+    per path. Both modes write the INFO_FIELDS of each object, and skip
+    objects that disappear while they are sensed.
+
+    :param paths: The S3 paths (bucket/key) to query.
+    :param endpoint: The S3 endpoint URL.
+    :param batched: Use the batched, concurrent sensing mode.
+    :param max_concurrency: The maximum number of S3 requests in flight in
+        batched mode.
+
+    Returns:
+        list of metadata dicts, one per path.
+    """
+    start = time.monotonic()
+    foreign = [path for path in paths if is_url(path)]
+    if foreign:
+        # Objects on other hosts are not on this S3 server and are fetched
+        # every intake
+        logger.info(f"not sensing {len(foreign)} URLs outside {endpoint}")
+        paths = [path for path in paths if not is_url(path)]
+    if batched:
+        snapshot, calls = asyncio.run(
+            _sense_batched(paths, endpoint, max_concurrency)
+        )
+    else:
+        snapshot, calls = _sense_serial(paths, endpoint)
+    logger.info(
+        f"sensed {len(paths)} CHELSA objects with {calls} S3 calls "
+        f"in {time.monotonic() - start:.1f}s"
+    )
+    return snapshot
 
 
-def vSensor(path_file, logs_feedback, logs_diff):
+def vSensor(
+    path_file, logs_feedback, logs_diff, batched=True, max_concurrency=32
+):
     """Senses new CHELSA data from their S3 server.
 
     :param input_path: The path for S3 CHELSA data directory where to check new data.
+    :param batched: List each prefix once and issue the HEAD requests
+        concurrently.
+    :param max_concurrency: The maximum number of S3 requests in flight in
+        batched mode.
 
     Returns:
 
     """
     logger.info("checking CHELSA metadata...")
     # Check for new CHELSA data
-   
-    #Read each line of input path
+
+    # Read each line of input path
     with open(path_file) as file:
-        lines = [line.rstrip() for line in file]
-
-    #TODO: Change URL string to environment variable
-    s3 = s3fs.S3FileSystem(anon=True, endpoint_url="https://os.zhdk.cloud.switch.ch/")
-    new_log = []
-    for i in lines:
-        #file_list = s3.ls(path=f"{i}")
-        logger.info("comparing CHELSA metadata...")
-        metadata = s3.metadata(path=f"{i}", refresh=False)
-        info = s3.info(path=f"{i}")
-        metadata.update(info)
-        metadata["LastModified"] = metadata["LastModified"].strftime(
-                "%Y-%m-%d %H:%M:%S"
-            )
-            # append new metadata to the metadata file
-        new_log.append(metadata)
-    with open(f"{logs_feedback}{round(time.time())}.json", "w+") as f:
-        json.dump(new_log, f)
-    logger.info(f"new CHELSA log saved to {f.name}")
+        lines = [s3_path(line) for line in file if line.strip()]
+
+    logger.info("comparing CHELSA metadata...")
+    with stage("chelsa.vSensor", files=len(lines)):
+        new_log = sense(
+            lines, batched=batched, max_concurrency=max_concurrency
+        )
+
+    # Compare the new metadata with the previous run
+    store = SnapshotStore(logs_feedback)
+    data = store.latest() or []
+    store.append(new_log)
+    logger.info(f"new CHELSA log saved to {store.runs[-1]['path']}")
+
+    changeset = diff(data, new_log, key="name", fields=MANIFEST_FIELDS)
+    with open(f"{logs_diff}{round(time.time())}.json", "w+") as d:
+        json.dump(changeset, d)
+        logger.info(f"new CHELSA diff saved to {d.name}")
+    if not is_empty(changeset):
+        logger.info(
+            f"CHELSA changes: {len(changeset['added'])} added, "
+            f"{len(changeset['removed'])} removed, "
+            f"{len(changeset['changed'])} changed"
+        )
+    return True
 
 
-    # Compare the new metadata with the previous metadata using DIFF
-    list_of_log_files = glob.glob(
-        f"{logs_feedback}*.json"
-    )
-    list_of_log_files.sort(key=os.path.getmtime)
-    # Get the second oldest file
-    if len(list_of_log_files) > 1:
-        compare_file = list_of_log_files[1]
-    else:
-        compare_file = list_of_log_files[0]
-
-    with open(f"{compare_file}", "r") as f:
-        # TODO: Validate the difference between the previous and new metadata
-        data = json.load(f)
-        diff = deepdiff.DeepDiff(data, new_log, view="tree")
-        diff_json = json.dumps(diff.to_json(), indent=2)
-        with open(f"{logs_diff}{round(time.time())}.json", "w+") as d:
-            json.dump(json.loads(diff_json), d)
-            logger.info(f"new CHELSA diff saved to {d.name}")
-    return True
+def load_manifest(manifest_path):
+    """Loads the intake manifest, a dict of S3 path -> metadata of the last
+    successful download.
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path):
+    """Atomically writes the intake manifest."""
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
 
 
-def intaker(path_to_download_list, output_dir):
+def changed_paths(paths, snapshot, manifest, output_dir):
+    """Selects the S3 paths whose upstream metadata differs from the manifest.
+
+    A path is (re)fetched when it is missing from the manifest, when its
+    ETag, size or LastModified changed, when it is absent from the snapshot
+    or when the local file has gone.
+
+    Returns:
+        list of S3 paths to download.
+    """
+    by_path = {s3_path(m["name"]): m for m in snapshot if "name" in m}
+    changed = []
+    for path in paths:
+        current = by_path.get(path)
+        previous = manifest.get(path)
+        local_file = os.path.join(
+            output_dir, filename_from_url(entry_url(path))
+        )
+        if (
+            current is None
+            or previous is None
+            or not os.path.exists(local_file)
+            or any(current.get(k) != previous.get(k) for k in MANIFEST_FIELDS)
+        ):
+            changed.append(path)
+    return changed
+
+
+def discard_stale_parts(paths, snapshot, output_dir, endpoint=ENDPOINT):
+    """Removes partial downloads that were started from another version of the
+    object.
+
+    A .part file is kept only if the ETag it was downloaded with is the
+    current upstream ETag, so a changed object is never resumed.
+    """
+    by_path = {s3_path(m["name"]): m for m in snapshot if "name" in m}
+    for path in paths:
+        name = filename_from_url(entry_url(path, endpoint))
+        part_path = os.path.join(output_dir, name + PART_SUFFIX)
+        if not os.path.exists(part_path):
+            continue
+        etag = (by_path.get(path) or {}).get("ETag")
+        validator = part_validator(part_path)
+        if (
+            etag is None
+            or validator is None
+            or validator.strip('"') != etag.strip('"')
+        ):
+            logger.info(f"discarding {part_path}, the object changed upstream")
+            discard_part(part_path)
+
+
+def intaker(
+    path_to_download_list,
+    output_dir,
+    max_workers=8,
+    retries=5,
+    endpoint=ENDPOINT,
+    snapshot=None,
+    manifest_path=None,
+    cache_dir=None,
+    cache_max_bytes=None,
+):
     """Downloads the CHELSA yearly data from the C3S S3 server.
 
+    Files are fetched concurrently, partial files are resumed with HTTP Range
+    requests and every file is renamed into place only once it is complete.
+    Only objects whose ETag, size or LastModified changed since the last
+    successful intake are fetched; that state is kept in a local manifest.
+
     :param path_to_download_list: The path for the txt file with CHELSA data url list.
     :param: output_dir: The path where data files are downloaded to.
+    :param max_workers: The number of files downloaded at the same time.
+    :param retries: The number of attempts per file before giving up.
+    :param endpoint: The server prepended to list entries that are not full
+        URLs.
+    :param snapshot: A JSON snapshot file, or the vSensor snapshot store to
+        take the latest snapshot from. The snapshot is computed here when not
+        given.
+    :param manifest_path: The intake manifest, defaults to
+        "<output_dir>/manifest.json".
+    :param cache_dir: A shared object cache, defaults to $RAW_CACHE_DIR. Files
+        are then linked into output_dir from the cache and only cache misses
+        are downloaded.
+    :param cache_max_bytes: The cache size cap, defaults to $RAW_CACHE_MAX_GB.
 
     Returns:
-        None
+        True if every file was downloaded, False otherwise.
     """
-    # logger = logger.getLogger(__name__)
     logger.info("downloading CHELSA data...")
-    # Download the CHELSA data from the C3S S3 server
     with open(path_to_download_list) as url_list:
-        for line in url_list:
-            dl_url = f"https://os.zhdk.cloud.switch.ch/{line}"
-            response = wget.download(dl_url, out=output_dir)
-            logger.info(f"downlaoded CHELSA data from {dl_url}".format(response))
-
-    return True
+        paths = [s3_path(line, endpoint) for line in url_list if line.strip()]
+
+    # Compare the upstream metadata with the last successful intake
+    metadata = None
+    if snapshot is not None and os.path.isdir(snapshot):
+        logger.info(f"using latest CHELSA snapshot in {snapshot}")
+        metadata = SnapshotStore(snapshot).latest()
+    elif snapshot is not None:
+        logger.info(f"using CHELSA snapshot {snapshot}")
+        with open(snapshot) as f:
+            metadata = json.load(f)
+    if metadata is None:
+        metadata = sense(paths, endpoint)
+    manifest_path = manifest_path or os.path.join(output_dir, "manifest.json")
+    manifest = load_manifest(manifest_path)
+    to_fetch = changed_paths(paths, metadata, manifest, output_dir)
+    logger.info(
+        f"{len(to_fetch)} of {len(paths)} CHELSA files changed upstream"
+    )
 
+    discard_stale_parts(to_fetch, metadata, output_dir, endpoint)
 
-def geotiff_to_netcdf(directory_path, output_file_path):
-    # Define the bounding box for Europe
-    europe_bounds = [-25, 35, 45, 75]
-
-    # Iterate over all files in the directory
-    for filename in os.listdir(directory_path):
-        print("---------------------------------------------")
-        output = filename.rsplit("_V")
-        # Check if the file is a GeoTIFF
-        if filename.endswith(".tif"):
-            print(f"Reading {filename}...")
-
-            # Open the GeoTIFF using rioxarray
-            data = rxr.open_rasterio(os.path.join(directory_path, filename))
-            print(f"Processing {filename} as xarray...")
-
-            # Slice the data for Europe
-            data_europe = data.rio.clip_box(*europe_bounds)
-            print(f"Clipping {filename} for Europe...")
-
-            # Reproject the data to ESPG-3530
-            data_europe = data_europe.rio.reproject("EPSG:3035")
-            print(f"Reprojecting {filename} as ESPG:3035...")
-
-            # Resample data to 10x10 KM grids based on https://corteva.github.io/rioxarray/stable/examples/resampling.html
-            downscale_factor = 1 / 10
-            new_width = data_europe.rio.width * downscale_factor
-            new_height = data_europe.rio.height * downscale_factor
-            data_resampled = data_europe.rio.reproject(
-                data_europe.rio.crs,
-                shape=(new_height, new_width),
-                resampling=Resampling.average,
+    # Download the CHELSA data from the C3S S3 server
+    by_path = {s3_path(m["name"]): m for m in metadata if "name" in m}
+    cache_dir = cache_dir or os.environ.get("RAW_CACHE_DIR")
+    with stage("chelsa.intaker") as metrics:
+        if cache_dir:
+            if cache_max_bytes is None and os.environ.get("RAW_CACHE_MAX_GB"):
+                cache_max_bytes = float(os.environ["RAW_CACHE_MAX_GB"]) * 1e9
+            summary = ObjectCache(cache_dir, cache_max_bytes).fetch_all(
+                [
+                    (entry_url(path, endpoint), version_of(by_path.get(path)))
+                    for path in to_fetch
+                ],
+                output_dir,
+                max_workers=max_workers,
+                retries=retries,
             )
-            print(f"Resamplimg {filename} using average algorithm...")
-
-            # Convert to xarray DataArray to xrray Dataset
-            dsout = data_resampled.to_dataset(name=f"{output[0]}")
+        else:
+            summary = download_all(
+                [entry_url(path, endpoint) for path in to_fetch],
+                output_dir,
+                max_workers=max_workers,
+                retries=retries,
+                overwrite=True,
+            )
+        metrics.update(
+            files=summary["done"],
+            cached=summary.get("cached", 0),
+            skipped=len(paths) - len(to_fetch) + summary["skipped"],
+            failed=summary["failed"],
+            bytes_downloaded=summary["bytes"],
+        )
+
+    # Record what was fetched so unchanged objects are skipped next time
+    for res in summary["files"]:
+        path = s3_path(res["url"], endpoint)
+        if res["status"] in ("done", "cached") and path in by_path:
+            manifest[path] = {k: by_path[path].get(k) for k in MANIFEST_FIELDS}
+    save_manifest(manifest, manifest_path)
+
+    return summary["failed"] == 0
+
+
+def _convert_layer(path, output_path=None, plan_path=None, store=None):
+    """Warps one GeoTIFF onto the 10 km EPSG:3035 grid for Europe.
+
+    The clip, reprojection and averaging resample are done in a single warp
+    through a WarpedVRT, which reads only the source blocks that fall in the
+    Europe window, so memory is bounded by the output grid. With a warp plan
+    the window is remapped with the plan's precomputed indices instead.
+
+    :param path: The path of the GeoTIFF.
+    :param output_path: The NetCDF file to write the layer to. When None the
+        dataset is returned.
+    :param plan_path: A saved WarpPlan for the grid of the GeoTIFF.
+    :param store: A Zarr cube to write the layer into instead of a NetCDF file.
 
-            print(f"Final dataset for {output[0]}: ")
-            print(dsout)
+    Returns:
+        The layer name and the output path, or the dataset when output_path is
+        None.
+    """
+    name = layer_name(path)
+    if plan_path is not None:
+        dsout = WarpPlan.load(plan_path).warp(path, name)
+    else:
+        dsout = _warp_layer(path, name)
+    if store is not None:
+        write_layer(
+            store, dsout[name].values.squeeze(), *parse_chelsa_name(path)
+        )
+        return name, store
+    if output_path is None:
+        return name, dsout
+    dsout.to_netcdf(output_path, format="NETCDF4")
+    return name, output_path
+
+
+def _warp_layer(path, name):
+    """Warps a GeoTIFF with GDAL through a WarpedVRT."""
+    with rasterio.open(path) as src:
+        transform, width, height = target_grid(
+            src, EUROPE_BOUNDS, DOWNSCALE_FACTOR, TARGET_CRS
+        )
+        with WarpedVRT(
+            src,
+            crs=TARGET_CRS,
+            transform=transform,
+            width=width,
+            height=height,
+            resampling=Resampling.average,
+        ) as vrt:
+            data = rxr.open_rasterio(vrt).load()
+    return data.to_dataset(name=name)
+
+
+def geotiff_to_netcdf(
+    directory_path,
+    output_path,
+    max_workers=None,
+    plan_dir=None,
+    backend="netcdf",
+):
+    """Converts the CHELSA GeoTIFFs in a directory to NetCDF on the 10 km
+    EPSG:3035 grid.
+
+    Files are processed in parallel across a process pool. When output_path is
+    a directory every layer is written by its worker to
+    ``<output_path>/<layer>.nc``. When output_path is a ``.nc`` file the small
+    resampled layers are sent back and appended to it one after another, as
+    before. With the "zarr" backend output_path is a consolidated Zarr cube and
+    every worker writes its own layer.
+
+    :param directory_path: The directory with the CHELSA GeoTIFFs.
+    :param output_path: An output directory for per-layer files, or a single
+        NetCDF file.
+    :param max_workers: The number of worker processes, defaults to the number
+        of CPUs.
+    :param plan_dir: Directory of cached warp plans. When given, the warp
+        geometry is computed once per source grid and every layer is remapped
+        with it.
+    :param backend: "netcdf" or "zarr".
 
-            # Convert the data to a netCDF4 file using xarray
-            dsout.to_netcdf(output_file_path, mode="a", group="/", format="NETCDF4")
-            print(
-                f"{filename} processed and saved to {output_file_path} as {output[0]}"
+    Returns:
+        list of converted layer names.
+    """
+    with stage("chelsa.geotiff_to_netcdf", backend=backend) as metrics:
+        files = sorted(
+            f for f in os.listdir(directory_path) if f.endswith(".tif")
+        )
+        store = output_path if backend == "zarr" else None
+        per_layer = store is None and not output_path.endswith(".nc")
+        if per_layer:
+            os.makedirs(output_path, exist_ok=True)
+        if store is not None and files:
+            # Lay out the cube for every layer before the workers fill it in
+            with rasterio.open(os.path.join(directory_path, files[0])) as src:
+                transform, width, height = target_grid(
+                    src, EUROPE_BOUNDS, DOWNSCALE_FACTOR, TARGET_CRS
+                )
+            init_cube(
+                store,
+                [parse_chelsa_name(f) for f in files],
+                y=transform.f + (np.arange(height) + 0.5) * transform.e,
+                x=transform.c + (np.arange(width) + 0.5) * transform.a,
+                crs=TARGET_CRS,
             )
 
-            """ 
+        converted = []
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {}
+            for filename in files:
+                print(f"Reading {filename}...")
+                path = os.path.join(directory_path, filename)
+                layer_path = None
+                if per_layer:
+                    layer_path = os.path.join(
+                        output_path, f"{layer_name(filename)}.nc"
+                    )
+                plan_path = None
+                if plan_dir is not None:
+                    plan_path = get_plan(
+                        path,
+                        plan_dir,
+                        EUROPE_BOUNDS,
+                        DOWNSCALE_FACTOR,
+                        TARGET_CRS,
+                    )
+                futures[
+                    pool.submit(
+                        _convert_layer, path, layer_path, plan_path, store
+                    )
+                ] = filename
+            for future in as_completed(futures):
+                name, result = future.result()
+                if not per_layer and store is None:
+                    result.to_netcdf(
+                        output_path,
+                        mode="a" if os.path.exists(output_path) else "w",
+                        format="NETCDF4",
+                    )
+                    result = output_path
+                converted.append(name)
+                print(
+                    f"{futures[future]} processed and saved to {result} as "
+                    f"{name}"
+                )
+        if store is not None:
+            consolidate(store)
+        metrics["files"] = len(converted)
+        metrics["bytes_written"] = tree_bytes(output_path)
+    return converted
+
+
+def convert_shard(shard_file, output_dir, result_path=None, plan_dir=None):
+    """Converts the GeoTIFFs listed in a shard file, one layer after another.
+
+    Used by the array tasks of service.chelsa.job_processor_array, each task
+    handling its own shard with a single CPU and a small memory request.
+
+    :param shard_file: A text file with one GeoTIFF path per line.
+    :param output_dir: The directory for the per-layer NetCDF files.
+    :param result_path: A JSON file to write the result to.
+    :param plan_dir: Directory of cached warp plans.
+
+    Returns:
+        dict with the "converted" layer names, the "failed" {path: error} and
+        "seconds".
+    """
+    with open(shard_file) as f:
+        paths = [line.strip() for line in f if line.strip()]
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.time()
+    result = {"converted": [], "failed": {}}
+    for path in paths:
+        layer_path = os.path.join(output_dir, f"{layer_name(path)}.nc")
+        try:
+            plan_path = None
+            if plan_dir is not None:
+                plan_path = get_plan(
+                    path, plan_dir, EUROPE_BOUNDS, DOWNSCALE_FACTOR, TARGET_CRS
+                )
+            name, _ = _convert_layer(path, layer_path, plan_path)
+            result["converted"].append(name)
+        except Exception as e:
+            print(f"Failed to convert {path}: {e}")
+            result["failed"][path] = str(e)
+    result["seconds"] = time.time() - start
+    if result_path is not None:
+        with open(result_path, "w") as f:
+            json.dump(result, f, indent=2)
+    return result
+
+
+"""
 def feedback():
     # Helper tool to print linted json objects
     def print_json(json_obj: str):
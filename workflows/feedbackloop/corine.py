@@ -6,186 +6,676 @@ import jwt
 import glob
 import os
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from requests.adapters import HTTPAdapter
+from telemetry import stage
+from feedbackloop.diff import diff
+from feedbackloop.download import download_file
+from feedbackloop.store import SnapshotStore
 
 API = "https://land.copernicus.eu/api/"
 PRODUCT = "CORINE Land Cover"
+# Access tokens are kept here between runs, readable by the owner only
+TOKEN_CACHE = os.environ.get(
+    "CLMS_TOKEN_CACHE",
+    os.path.expanduser("~/.cache/iasdt-workflows/clms_token.json"),
+)
+# Tokens are refreshed this many seconds before they expire
+REFRESH_MARGIN = 300
+# CLMS issues one-hour tokens when the response does not say otherwise
+TOKEN_LIFETIME = 3600
+# Persisted data requests, in the CORINE logs folder
+TASKS_FILE = "datarequests.json"
+# Data request states of the @datarequest_search response, plus our own
+DONE = {"Downloaded"}
+FAILED = {"Finished_nok", "Rejected", "Cancelled", "Failed", "Missing"}
+# Polls a task may be missing from @datarequest_search before it is resubmitted
+MISSING_POLLS = 5
+# The catalogue query: only CORINE Land Cover datasets, with the fields the
+# sensor compares
+CATALOGUE_QUERY = {
+    "portal_type": "DataSet",
+    "Title": PRODUCT,
+    "metadata_fields": ["UID", "modified", "downloadable_files"],
+}
+# Catalogue items per page and the index of seen datasets
+B_SIZE = 25
+CATALOGUE_FILE = "catalogue.json"
 
 
-def get_token(credentials):
-    """Gets a JWT for CLMS API access.
+class CLMSSession:
+    """Authenticated CLMS API client sharing one access token and one
+    connection pool.
+
+    The token is cached in memory and in a file only its owner can read, and is
+    refreshed REFRESH_MARGIN seconds before it expires, so parallel requests
+    and consecutive runs reuse it instead of signing and exchanging a new JWT.
+
+    :param credentials: The path to the CLMS service key JSON.
+    :param token: A ready access token, used as is when no credentials are
+        given.
+    :param api: The CLMS API base URL.
+    :param token_cache: The token cache file, None to keep the token in memory
+        only.
+    :param pool_size: The number of pooled connections per host.
+    """
+
+    def __init__(
+        self,
+        credentials=None,
+        token=None,
+        api=API,
+        token_cache=TOKEN_CACHE,
+        pool_size=16,
+    ):
+        self.credentials = credentials
+        self.api = api
+        self.token_cache = token_cache if credentials else None
+        self._service_key = None
+        self._token = token
+        self._expires = float("inf") if token else 0.0
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept"] = "application/json"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    @property
+    def service_key(self):
+        if self._service_key is None:
+            with open(self.credentials, "rb") as f:
+                self._service_key = json.load(f)
+        return self._service_key
+
+    def _valid(self, expires):
+        return expires - REFRESH_MARGIN > time.time()
+
+    def _load_cached(self):
+        """Returns (token, expires) from the cache file if it holds a token of
+        this client, else None.
+        """
+        if not self.token_cache or not os.path.exists(self.token_cache):
+            return None
+        try:
+            with open(self.token_cache) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (
+            cached.get("client_id") != self.service_key["client_id"]
+            or cached.get("api") != self.api
+        ):
+            return None
+        return cached["access_token"], cached["expires"]
+
+    def _save_cached(self, token, expires):
+        """Writes the token atomically to the cache file with mode 0600."""
+        if not self.token_cache:
+            return
+        directory = os.path.dirname(self.token_cache) or "."
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        tmp_path = f"{self.token_cache}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                {
+                    "client_id": self.service_key["client_id"],
+                    "api": self.api,
+                    "access_token": token,
+                    "expires": expires,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.token_cache)
+
+    def _mint(self):
+        """Exchanges a freshly signed JWT grant for an access token.
+
+        Returns:
+            (access_token, expires) with expires as a UNIX timestamp.
+        """
+        service_key = self.service_key
+        now = int(time.time())
+        # Create a claim set for the JWT
+        claim_set = {
+            "iss": service_key["client_id"],
+            "sub": service_key["user_id"],
+            "aud": service_key["token_uri"],
+            "iat": now,
+            "exp": now + TOKEN_LIFETIME,
+        }
+        # Create a signed JWT from the claim set
+        grant = jwt.encode(
+            claim_set,
+            service_key["private_key"].encode("utf-8"),
+            algorithm="RS256",
+        )
+        # Exchange the JWT for an access token
+        result = self.session.post(
+            service_key["token_uri"],
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            data={
+                "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
+                "assertion": grant,
+            },
+        )
+        result.raise_for_status()
+        info = result.json()
+        access_token = info.get("access_token")
+        if not access_token:
+            raise ValueError(f"No access token in the CLMS response: {info}")
+        expires = now + int(info.get("expires_in", TOKEN_LIFETIME))
+        print("New CLMS access token generated")
+        return access_token, expires
+
+    def token(self, force=False):
+        """Returns a valid access token, from memory, the cache file or the
+        token endpoint.
+
+        :param force: Mint a new token even if the cached one is still valid.
+        """
+        with self._lock:
+            if not force and self._token and self._valid(self._expires):
+                return self._token
+            if not self.credentials:
+                if self._token:
+                    return self._token
+                raise ValueError(
+                    "No CLMS credentials to refresh the access token with"
+                )
+            cached = None if force else self._load_cached()
+            if cached and self._valid(cached[1]):
+                self._token, self._expires = cached
+            else:
+                self._token, self._expires = self._mint()
+                self._save_cached(self._token, self._expires)
+            return self._token
+
+    def request(self, method, path, **kwargs):
+        """Sends an authorized request to the CLMS API, refreshing the token
+        once on a 401.
+
+        :param method: The HTTP method.
+        :param path: An endpoint relative to the API, e.g.
+            "@datarequest_search", or a full URL.
+        :param kwargs: Passed on to requests.Session.request.
+        """
+        url = (
+            path
+            if path.startswith(("http://", "https://"))
+            else f"{self.api}{path}"
+        )
+        headers = kwargs.pop("headers", {})
+        for attempt in range(2):
+            token = self.token(force=attempt > 0)
+            auth = {**headers, "Authorization": f"Bearer {token}"}
+            response = self.session.request(
+                method, url, headers=auth, **kwargs
+            )
+            if response.status_code != 401 or not self.credentials:
+                break
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+
+def get_token(credentials, token_cache=TOKEN_CACHE):
+    """Gets a JWT for CLMS API access, reusing the cached one while it is
+    valid.
 
     Returns:
        access_token: The access token for the CLMS API.
     """
-    # Load saved key from filesystem
-    service_key = json.load(open(credentials, "rb"))
-    # Convert the private key to a bytes object
-    private_key = service_key["private_key"].encode("utf-8")
-    # Create a claim set for the JWT
-    claim_set = {
-        "iss": service_key["client_id"],
-        "sub": service_key["user_id"],
-        "aud": service_key["token_uri"],
-        "iat": int(time.time()),
-        "exp": int(time.time() + (60 * 60)),
-    }
-    # Create a signed JWT from the claim set
-    grant = jwt.encode(claim_set, private_key, algorithm="RS256")
-    # Authorize user with the CLMS API
-    req1 = requests.post(
-        f"{API}@@oauth2-token",
-        headers={
-            "Accept": "application/json",
-            "Content-Type": "application/x-www-form-urlencoded",
-        },
-        data="grant_type=urn%3Aietf%3Aparams%3Aoauth%3Agrant-type%3Ajwt-bearer&assertion=REDACTED",
-    )
-    req1.raise_for_status()
-    # Make a request to the token endpoint to exchange the JWT for a token
-    result = requests.post(
-        service_key["token_uri"],
-        headers={
-            "Accept": "application/json",
-            "Content-Type": "application/x-www-form-urlencoded",
-        },
-        data={
-            "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
-            "assertion": grant,
-        },
+    with CLMSSession(credentials, token_cache=token_cache) as clms:
+        return clms.token()
+
+
+def is_corine(title):
+    """Tells whether a catalogue title is the 100 m 6-yearly European CORINE
+    Land Cover status layer.
+    """
+    return (
+        PRODUCT in title
+        and "Europe" in title
+        and "100 m" in title
+        and "6-yearly" in title
+        and "Change" not in title
     )
-    result.raise_for_status()
 
-    # Convert the response to JSON
-    access_token_info_json = result.json()
-    # Extract the access token from the JSON response
-    access_token = access_token_info_json.get("access_token")
-    access_token.raise_for_status()
-    print("New CLMS Access token generated: ", access_token)
 
-    return access_token
+def load_catalogue(path):
+    """Reads the catalogue index: {"datasets": {UID: metadata}, "pages": {url:
+    validators and items}}.
+    """
+    if not os.path.exists(path):
+        return {"datasets": {}, "pages": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_catalogue(catalogue, path):
+    """Writes the catalogue index atomically."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(catalogue, f)
+    os.replace(tmp_path, path)
+
 
+def search_catalogue(session, query, pages, api=API, b_size=B_SIZE):
+    """Pages through a filtered @search of the CLMS catalogue.
 
-def vSensor(logs_folder):
+    Each page is requested with the ETag and Last-Modified of the previous
+    run; a 304 reuses the items stored for that page.
+
+    :param session: A requests.Session.
+    :param query: The @search parameters, e.g. CATALOGUE_QUERY.
+    :param pages: The page cache of the catalogue index, updated in place.
+    :param api: The CLMS API base URL.
+    :param b_size: The number of items per page.
+
+    Yields:
+        The catalogue items, page by page.
+    """
+    url = (
+        requests.Request(
+            "GET", f"{api}@search", params={**query, "b_size": b_size}
+        )
+        .prepare()
+        .url
+    )
+    while url:
+        cached = pages.get(url, {})
+        headers = {"Accept": "application/json"}
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+        response = session.get(url, headers=headers, timeout=60)
+        if response.status_code == 304:
+            items, next_url = cached["items"], cached.get("next")
+        else:
+            response.raise_for_status()
+            result = response.json()
+            items, next_url = result["items"], result.get("batching", {}).get(
+                "next"
+            )
+            pages[url] = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "items": items,
+                "next": next_url,
+            }
+        yield from items
+        url = next_url
+
+
+def vSensor(logs_folder, session=None, api=API):
     """Senses new CORINE data from the CLMS API.
 
-    :param logs_folder: The path for the folder with CLMS logs, defaults to "../logs/feedback/corine/*.json".
+    The title and product filters are part of the @search query and the
+    results are paged, so only the CORINE datasets are transferred. Seen
+    datasets are kept in "<logs_folder>/catalogue.json", keyed by UID; the
+    first run without it compares with the latest snapshot of the store.
+
+    :param logs_folder: The snapshot store with CLMS logs, defaults to
+        "../logs/feedback/corine/".
+    :param session: A requests.Session or CLMSSession to reuse, a new session
+        by default.
+    :param api: The CLMS API base URL.
 
     Returns:
         True if new data is available, False if not.
     """
-    # Get the DataSet metadata from the CLMS API
-    req3 = requests.get(
-        f"{API}@search?portal_type=DataSet&metadata_fields=UID&metadata_fields=dataset_full_format&&metadata_fields=dataset_download_information&&b_size=100000",
-        headers={"Accept": "application/json"},
+    logs_folder = logs_folder or "../logs/feedback/corine/"
+    if isinstance(session, CLMSSession):
+        session = session.session
+    session = session or requests.Session()
+    catalogue_path = os.path.join(logs_folder, CATALOGUE_FILE)
+    catalogue = load_catalogue(catalogue_path)
+    store = SnapshotStore(logs_folder)
+    if not catalogue["datasets"]:
+        # Without an index yet, compare with the last snapshot so known
+        # datasets are not reported as new
+        catalogue["datasets"] = {
+            d["UID"]: d for d in store.latest() or [] if d.get("UID")
+        }
+
+    with stage("corine.vSensor") as metrics:
+        current = [
+            {
+                "title": data["title"],
+                "downloadable_files": data["downloadable_files"],
+                "UID": data["UID"],
+                "@id": data["@id"],
+                "modified": data.get("modified"),
+            }
+            for data in search_catalogue(
+                session, CATALOGUE_QUERY, catalogue["pages"], api=api
+            )
+            if is_corine(data["title"])
+        ]
+        metrics["files"] = len(current)
+
+    # Compare with the datasets seen before
+    changeset = diff(
+        list(catalogue["datasets"].values()),
+        current,
+        key="UID",
+        fields=["title", "downloadable_files"],
     )
-    items = req3.json()["items"]
-    substrings = ["CORINE Land Cover", "Europe", "100 m", "6-yearly"]
-    current = []
-    new = []
-    obj = {}
-    # Check if the metadata contains the required substrings
-    for data in items:
+    updated = set(changeset["added"]) | {
+        c["UID"] for c in changeset["changed"]
+    }
+    new = [i for i in current if i["UID"] in updated]
+    print(
+        f"CORINE datasets: {len(changeset['added'])} added, "
+        f"{len(changeset['changed'])} changed, "
+        f"{len(changeset['removed'])} removed"
+    )
+    if new:
+        print("New CORINE data available...")
+    else:
+        print("No new CORINE data")
+    catalogue["datasets"] = {i["UID"]: i for i in current}
+    save_catalogue(catalogue, catalogue_path)
+    store.append(current)
+    return bool(new)
+
+
+def raster_requests(dataset_list):
+    """Returns the {"DatasetID", "FileID"} data requests for the raster files
+    of the sensed datasets.
+    """
+    wanted = []
+    for dataset in dataset_list:
+        for item in dataset["downloadable_files"]["items"]:
+            if item["type"] == "Raster":
+                wanted.append(
+                    {"DatasetID": dataset["UID"], "FileID": item["@id"]}
+                )
+    return wanted
+
+
+def load_tasks(path):
+    """Reads the persisted data requests, keyed by "<DatasetID>/<FileID>"."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_tasks(tasks, path):
+    """Writes the data requests atomically so an interrupted run can resume
+    them.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(tasks, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def submit_requests(clms, wanted, tasks, tasks_path):
+    """Posts a data request for every wanted file without a live or finished
+    task.
+
+    :param clms: The CLMSSession.
+    :param wanted: The {"DatasetID", "FileID"} requests, see
+        :func:`raster_requests`.
+    :param tasks: The persisted tasks, updated in place.
+    :param tasks_path: The file the tasks are saved to after each submission.
+
+    Returns:
+        The number of requests submitted.
+    """
+    submitted = 0
+    for request in wanted:
+        key = f"{request['DatasetID']}/{request['FileID']}"
+        task = tasks.get(key)
         if (
-            (substrings[0] in data["title"])
-            & (substrings[2] in data["title"])
-            & (substrings[3] in data["title"])
-            & ("Change" not in data["title"])
+            task
+            and task["status"] not in FAILED
+            and (task["status"] not in DONE or os.path.exists(task["path"]))
         ):
-            # Append the metadata to an object and the object to a list
-            obj["title"] = data["title"]
-            #obj["dataset_full_format"] = data["dataset_full_format"]
-            #obj["dataset_download_information"] = data["dataset_download_information"]
-            obj['downloadable_files'] = data['downloadable_files']
-            obj["UID"] = data["UID"]
-            obj["@id"] = data["@id"]
-            current.append(obj)
-            obj = {}
-
-    # Load the previous metadata from the logs folder
-    list_of_files = glob.glob(
-        logs_folder or "../logs/feedback/corine/*.json"
-    )  # * means all if need specific format then *.json
-    # Get the latest log file
-    latest_file = max(list_of_files, key=os.path.getctime)
-
-    # Compare the new metadata with the previous metadata
-    if latest_file:
-        with open(latest_file, "r") as f:
-            old = json.load(f)
-            for i in new:
-                if i not in old:
-                    new.append(i)
-                    print("New CORINE data available...")
-                else:
-                    print("No new CORINE data")
-            with open(
-                f"../logs/feedback/corine/clms-{round(time.time())}.json", "w"
-            ) as f:
-                json.dump(new, f)
-    return True
+            continue
+        response = clms.post(
+            "@datarequest_post",
+            json={
+                "Datasets": [
+                    {
+                        **request,
+                        "OutputFormat": "Geotiff",
+                        "OutputGCS": "EPSG:4326",
+                    }
+                ]
+            },
+        )
+        response.raise_for_status()
+        task_id = response.json()["TaskIds"][0]["TaskID"]
+        tasks[key] = {
+            **request,
+            "TaskID": task_id,
+            "status": "Queued",
+            "path": None,
+        }
+        save_tasks(tasks, tasks_path)
+        submitted += 1
+    return submitted
+
+
+def _collect(downloads, tasks, tasks_path, block=False):
+    """Records the finished downloads in the tasks and saves them.
+
+    :param downloads: {task key: download future}, the recorded ones are
+        removed.
+    :param tasks: The persisted tasks, updated in place.
+    :param tasks_path: The file the tasks are saved to.
+    :param block: Wait for the downloads still running.
+    """
+    for key, future in list(downloads.items()):
+        if not (block or future.done()):
+            continue
+        result = future.result()
+        tasks[key]["status"] = (
+            "Downloaded"
+            if result["status"] in ("done", "skipped")
+            else "Failed"
+        )
+        tasks[key]["path"] = result["path"]
+        if result["error"] and result["status"] == "failed":
+            print(
+                f"Failed to download {tasks[key]['DownloadURL']}: "
+                f"{result['error']}"
+            )
+        del downloads[key]
+        save_tasks(tasks, tasks_path)
 
 
-def intaker(access_token, logs_folder, output_dir):
+def _update_status(status, pending, tasks, missing):
+    """Applies a @datarequest_search response to the pending tasks.
+
+    A task absent from the response for MISSING_POLLS polls in a row is
+    marked "Missing", so the next run submits it again.
+
+    :param status: The @datarequest_search response, {TaskID: info}.
+    :param pending: The keys of the tasks still waiting on the server.
+    :param tasks: The persisted tasks, updated in place.
+    :param missing: {task key: consecutive polls without the task}, updated in
+        place.
+
+    Returns:
+        The keys of the tasks whose status changed.
+    """
+    changed = []
+    for key in pending:
+        info = status.get(tasks[key]["TaskID"])
+        if info is None:
+            missing[key] = missing.get(key, 0) + 1
+            if missing[key] >= MISSING_POLLS:
+                print(
+                    f"CLMS data request {tasks[key]['TaskID']} is no longer "
+                    "listed, it will be resubmitted"
+                )
+                tasks[key]["status"] = "Missing"
+                changed.append(key)
+            continue
+        missing.pop(key, None)
+        if info.get("Status") == tasks[key]["status"]:
+            continue
+        tasks[key]["status"] = info["Status"]
+        if info["Status"] == "Finished_ok":
+            tasks[key]["DownloadURL"] = info["DownloadURL"]
+        elif info["Status"] in FAILED:
+            print(
+                f"CLMS data request {tasks[key]['TaskID']} ended with "
+                f"{info['Status']}"
+            )
+        changed.append(key)
+    return changed
+
+
+def _download_finished(pool, keys, tasks, downloads, output_dir):
+    """Starts downloading the files of the finished tasks among keys."""
+    for key in keys:
+        if tasks[key]["status"] == "Finished_ok" and key not in downloads:
+            downloads[key] = pool.submit(
+                download_file, tasks[key]["DownloadURL"], output_dir
+            )
+
+
+def intaker(
+    access_token,
+    logs_folder,
+    output_dir,
+    max_workers=4,
+    poll=10,
+    max_poll=300,
+    timeout=24 * 3600,
+):
     """Downloads the CORINE 6-yearly data from the CLMS server.
 
-    :param access_token: The access token for the CLMS API.
-    :param logs_folder: The path for the folder with CLMS logs, defaults to "../logs/feedback/corine/*.json".
+    All data requests are submitted up front and tracked with one
+    @datarequest_search call per poll, which backs off from poll to max_poll
+    seconds while nothing changes. Finished files are downloaded concurrently
+    as soon as they are ready. The task ids are saved in
+    "<logs_folder>/datarequests.json", so a restarted run resumes the pending
+    requests instead of submitting them again.
+
+    :param access_token: The access token for the CLMS API, or a CLMSSession
+        that refreshes it.
+    :param logs_folder: The snapshot store with CLMS logs, defaults to
+        "../logs/feedback/corine/".
     :param: output_dir: The path where data files are downloaded to, defaults to "../datasets/raw/corine".
+    :param max_workers: The number of files downloaded at the same time.
+    :param poll: The first and shortest wait between status polls, in seconds.
+    :param max_poll: The longest wait between status polls, in seconds.
+    :param timeout: Give up on the requests still pending after this many
+        seconds.
 
     Returns:
-        None
+        True if every file was downloaded, False otherwise.
     """
-    clms = glob.glob(
-        logs_folder or "../logs/feedback/corine/*.json"
-    )  # * means all if need specific format then *.csv
-    latest_clms = max(clms, key=os.path.getctime)
-    dataset_list = json.load(open(f"../references/corine/{latest_clms}.json", "rb"))
-    for i in dataset_list:
-        DatasetID = i["UID"]
-        DatasetDownloadInformationID = ""
-
-        for x in i["downloadable_files"]["items"]:
-            if x["type"] == "Raster":
-                DatasetDownloadInformationID = x["@id"]
-                print(DatasetID)
-                print(DatasetDownloadInformationID)
-                task = requests.post(
-                    f"{API}@datarequest_post",
-                    headers={
-                        "Accept": "application/json",
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {access_token}",
-                    },
-                    json={
-                        "Datasets": [
-                            {
-                                "DatasetID": DatasetID,
-                                "FileID": DatasetDownloadInformationID,
-                                "OutputFormat": "Geotiff",
-                                "OutputGCS": "EPSG:4326",
-                            }
-                        ]
-                    },
-                )
-                print(task.json())
-            
-                while status.json()["items"][0]["status"] != "Completed":
-                    time.sleep(10)
-                    status = requests.get(
-                        f"{API}@datarequest_search",
-                        headers={
-                            "Accept": "application/json",
-                            "Content-Type": "application/json",
-                            "Authorization": f"Bearer {access_token}",
-                        },
+    clms = (
+        access_token
+        if isinstance(access_token, CLMSSession)
+        else CLMSSession(token=access_token)
+    )
+    logs_folder = logs_folder or "../logs/feedback/corine/"
+    output_dir = output_dir or "../datasets/raw/corine"
+    os.makedirs(output_dir, exist_ok=True)
+    tasks_path = os.path.join(logs_folder, TASKS_FILE)
+    tasks = load_tasks(tasks_path)
+    wanted = raster_requests(SnapshotStore(logs_folder).latest() or [])
+
+    with stage("corine.intaker") as metrics:
+        submitted = submit_requests(clms, wanted, tasks, tasks_path)
+        print(
+            f"Submitted {submitted} CLMS data requests, "
+            f"{len(wanted) - submitted} already known"
+        )
+
+        keys = {f"{r['DatasetID']}/{r['FileID']}" for r in wanted}
+        downloads = {}
+        deadline = time.time() + timeout
+        delay = poll
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # Requests that finished before a restart are downloaded straight
+            # away
+            _download_finished(pool, keys, tasks, downloads, output_dir)
+            missing = {}
+            while True:
+                _collect(downloads, tasks, tasks_path)
+                pending = [
+                    k
+                    for k in keys
+                    if tasks[k]["status"] not in DONE | FAILED
+                    and k not in downloads
+                ]
+                if not pending and not downloads:
+                    break
+                if pending and time.time() > deadline:
+                    print(
+                        f"Gave up on {len(pending)} CLMS data requests after "
+                        f"{timeout}s"
+                    )
+                    break
+
+                changed = []
+                if pending:
+                    # One call returns the status of all of this user's
+                    # requests
+                    response = clms.get("@datarequest_search")
+                    response.raise_for_status()
+                    changed = _update_status(
+                        response.json(), pending, tasks, missing
+                    )
+                    _download_finished(
+                        pool, changed, tasks, downloads, output_dir
+                    )
+                    if changed:
+                        save_tasks(tasks, tasks_path)
+                delay = poll if changed else min(delay * 2, max_poll)
+                if downloads:
+                    # Wake up early when a download finishes
+                    wait(
+                        list(downloads.values()),
+                        timeout=delay,
+                        return_when=FIRST_COMPLETED,
                     )
-                    print(status.json())
-                #TODO: Add download functionality
-                download = requests.get(
-                    f"{API}@datarequest_search",
-                    headers={
-                        "Accept": "application/json",
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {access_token}",
-                    },
-                )
\ No newline at end of file
+                else:
+                    time.sleep(delay)
+            # Downloads still running at the deadline are waited for and
+            # recorded too
+            _collect(downloads, tasks, tasks_path, block=True)
+
+        done = [k for k in keys if tasks[k]["status"] == "Downloaded"]
+        metrics.update(
+            files=len(done),
+            submitted=submitted,
+            failed=len(keys) - len(done),
+            bytes_written=sum(
+                os.path.getsize(tasks[k]["path"])
+                for k in done
+                if os.path.exists(tasks[k]["path"])
+            ),
+        )
+    print(f"Downloaded {len(done)} of {len(keys)} CORINE files")
+    return len(done) == len(keys)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Consolidated Zarr store of processed CHELSA layers.
+
+All layers share the 10 km EPSG:3035 grid and are stored in one array with
+dimensions (variable, scenario, model, period, month, y, x). Every layer is
+a single chunk, so workers write their layers independently with region
+writes, and readers can slice any variable/scenario combination without
+touching others.
+
+The code targets the zarr 2 API pinned in requirements.txt. Stores are
+always written in the Zarr v2 format, so they are the same whether the
+pinned zarr 2 or zarr 3 is installed.
+"""
+import os
+import re
+
+import dask.array as da
+import numpy as np
+import xarray as xr
+import zarr
+
+DIMS = ("variable", "scenario", "model", "period", "month")
+DATA = "data"
+CURRENT = "Current"
+# The month of annual layers such as the bioclimatic variables
+ANNUAL = "Annual"
+# CHELSA_<model>_<member>_w5e5_<scenario>_<variable>_<month>_<start>_<end>_norm
+FUTURE_MONTHLY = re.compile(
+    r"(?P<model>[^_]+)_r\d+i\d+p\d+f\d+_w5e5_(?P<scenario>ssp\d+)_"
+    r"(?P<variable>.+)_(?P<month>\d{2})_(?P<start>\d{4})_(?P<end>\d{4})_norm"
+)
+# CHELSA_<variable>_<period>_<model>_<scenario>_V.2.1
+FUTURE = re.compile(
+    r"(?P<variable>.+?)_(?P<period>\d{4}-\d{4})_(?P<model>[^_]+)_"
+    r"(?P<scenario>ssp\d+)"
+)
+# CHELSA_<variable>[_<month>]_<period>[_<month>|_<statistic>]_V.2.1, the
+# suffixed form is used by rsds
+PRESENT = re.compile(
+    r"(?P<variable>.+?)(_(?P<month>\d{2}))?_(?P<period>\d{4}-\d{4})"
+    r"(_((?P<suffix_month>\d{2})|(?P<statistic>[a-z]+)))?"
+)
+# zarr 3 writes the v3 format unless told otherwise; zarr 2 only knows v2
+FORMAT = {"zarr_format": 2} if int(zarr.__version__.split(".")[0]) >= 3 else {}
+
+
+def layer_name(filename):
+    """Returns the CHELSA file name without directory, version and extension.
+    """
+    name = os.path.basename(filename)
+    return re.sub(r"(_V\.\d+\.\d+)?\.(tif|nc)$", "", name)
+
+
+def parse_chelsa_name(filename):
+    """Splits a CHELSA file or layer name into its cube key.
+
+    Handles the current climatologies (CHELSA_bio1_1981-2010_V.2.1.tif and
+    the monthly CHELSA_tas_01_1981-2010_V.2.1.tif), the future bioclimatic
+    layers (CHELSA_bio1_2071-2100_gfdl-esm4_ssp126_V.2.1.tif) and the future
+    monthly normals
+    (CHELSA_gfdl-esm4_r1i1p1f1_w5e5_ssp126_tas_11_2071_2100_norm.tif).
+    Current layers have no model or scenario and are stored under "Current",
+    annual layers under the month "Annual".
+
+    Returns:
+        (variable, scenario, model, period, month)
+    """
+    name = layer_name(filename).removeprefix("CHELSA_")
+    match = FUTURE_MONTHLY.fullmatch(name)
+    if match:
+        return (
+            match["variable"],
+            match["scenario"],
+            match["model"],
+            f"{match['start']}-{match['end']}",
+            match["month"],
+        )
+    match = FUTURE.fullmatch(name)
+    if match:
+        return (
+            match["variable"],
+            match["scenario"],
+            match["model"],
+            match["period"],
+            ANNUAL,
+        )
+    match = PRESENT.fullmatch(name)
+    if match:
+        variable = match["variable"]
+        if match["statistic"]:
+            variable = f"{variable}_{match['statistic']}"
+        return (
+            variable,
+            CURRENT,
+            CURRENT,
+            match["period"],
+            match["month"] or match["suffix_month"] or ANNUAL,
+        )
+    raise ValueError(f"{filename} is not a CHELSA climatology name")
+
+
+def init_cube(store, layers, y, x, crs=None, attrs=None):
+    """Creates an empty cube covering every layer, without writing any data.
+
+    :param store: The path of the Zarr store.
+    :param layers: Iterable of (variable, scenario, model, period[, month])
+        tuples, the month defaults to "Annual".
+    :param y: The y coordinates of the grid.
+    :param x: The x coordinates of the grid.
+    :param crs: The CRS of the grid, stored as the "crs" attribute.
+    :param attrs: Extra dataset attributes.
+
+    Returns:
+        The path of the store.
+    """
+    layers = [
+        tuple(layer) + (ANNUAL,) * (len(DIMS) - len(layer)) for layer in layers
+    ]
+    if len(set(layers)) != len(layers):
+        raise ValueError(
+            "several files map to the same variable/scenario/model/period/"
+            "month layer"
+        )
+    coords = {
+        dim: sorted({layer[i] for layer in layers})
+        for i, dim in enumerate(DIMS)
+    }
+    shape = tuple(len(coords[dim]) for dim in DIMS) + (len(y), len(x))
+    data = da.full(
+        shape,
+        np.nan,
+        dtype="float32",
+        chunks=(1,) * len(DIMS) + (len(y), len(x)),
+    )
+    ds = xr.Dataset(
+        {DATA: (DIMS + ("y", "x"), data)},
+        coords={**coords, "y": np.asarray(y), "x": np.asarray(x)},
+        attrs=dict(attrs or {}),
+    )
+    if crs is not None:
+        ds.attrs["crs"] = str(crs)
+    ds.to_zarr(store, mode="w", compute=False, consolidated=False, **FORMAT)
+    return store
+
+
+def write_layer(
+    store, values, variable, scenario, model, period, month=ANNUAL
+):
+    """Writes one 2D layer into its own chunk of the cube.
+
+    :param store: The path of the Zarr store.
+    :param values: The layer as a 2D (y, x) array.
+    """
+    index = xr.open_zarr(store, consolidated=False)
+    region = {}
+    key = (variable, scenario, model, period, month)
+    for dim, value in zip(DIMS, key):
+        i = int(np.flatnonzero(index[dim].values == value)[0])
+        region[dim] = slice(i, i + 1)
+    region.update(y=slice(0, index.sizes["y"]), x=slice(0, index.sizes["x"]))
+    values = np.asarray(values, dtype="float32").reshape(
+        (1,) * len(DIMS) + index[DATA].shape[-2:]
+    )
+    layer = xr.Dataset({DATA: (DIMS + ("y", "x"), values)})
+    layer.to_zarr(store, region=region, consolidated=False, **FORMAT)
+
+
+def consolidate(store):
+    """Consolidates the store metadata so readers open it with a single read.
+    """
+    zarr.consolidate_metadata(store, **FORMAT)
+
+
+def open_cube(store):
+    """Opens the cube lazily from its consolidated metadata."""
+    return xr.open_zarr(store, consolidated=True)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Keyed diff of metadata snapshots shared by the feedback loop sensors."""
+
+
+def index(snapshot, key):
+    """Indexes a list of metadata dicts by the value of key.
+
+    :param snapshot: A list of metadata dicts.
+    :param key: The field that identifies an object, e.g. "name" for S3 or
+        "UID" for CLMS.
+
+    Returns:
+        dict of key value -> metadata dict.
+    """
+    return {item[key]: item for item in snapshot}
+
+
+def diff(old, new, key, fields=None):
+    """Compares two metadata snapshots object by object.
+
+    Both snapshots are indexed by key, so the comparison runs in linear
+    time and does not depend on the order of the objects.
+
+    :param old: The previous snapshot, a list of metadata dicts.
+    :param new: The current snapshot, a list of metadata dicts.
+    :param key: The field that identifies an object.
+    :param fields: The fields compared for changes, defaults to all fields.
+
+    Returns:
+        dict with "added" and "removed" lists of keys and a "changed" list of
+        {key: ..., "fields": {field: [old, new]}} entries.
+    """
+    old_index = index(old, key)
+    new_index = index(new, key)
+    changeset = {"added": [], "removed": [], "changed": []}
+
+    for k, item in new_index.items():
+        previous = old_index.get(k)
+        if previous is None:
+            changeset["added"].append(k)
+            continue
+        compared = (
+            fields
+            if fields is not None
+            else sorted(previous.keys() | item.keys())
+        )
+        changed = {
+            f: [previous.get(f), item.get(f)]
+            for f in compared
+            if previous.get(f) != item.get(f)
+        }
+        if changed:
+            changeset["changed"].append({key: k, "fields": changed})
+
+    changeset["removed"] = [k for k in old_index if k not in new_index]
+    return changeset
+
+
+def is_empty(changeset):
+    """Returns True if the changeset records no differences."""
+    return not (
+        changeset["added"] or changeset["removed"] or changeset["changed"]
+    )
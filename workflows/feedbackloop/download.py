@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""Concurrent, resumable HTTP download engine used by the feedback loop
+intakers.
+"""
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit, unquote
+
+import requests
+from logger_base import logger
+
+CHUNK_SIZE = 1024 * 1024
+PART_SUFFIX = ".part"
+# Sidecar of a .part file with the ETag (or Last-Modified) of the object it
+# holds
+VALIDATOR_SUFFIX = ".validator"
+
+_local = threading.local()
+
+
+def _session():
+    """Returns a requests.Session bound to the calling thread."""
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def filename_from_url(url):
+    """Returns the file name component of a download URL."""
+    return unquote(os.path.basename(urlsplit(url).path))
+
+
+def _total_size(response, offset):
+    """Works out the full object size from a (possibly partial) response."""
+    content_range = response.headers.get("Content-Range")
+    if content_range and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        if total.isdigit():
+            return int(total)
+    length = response.headers.get("Content-Length")
+    if length is not None and length.isdigit():
+        return int(length) + (offset if response.status_code == 206 else 0)
+    return None
+
+
+def discard_part(part_path):
+    """Removes a temp file and its validator."""
+    for path in (part_path, part_path + VALIDATOR_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def part_validator(part_path):
+    """Returns the validator recorded for a temp file, or None."""
+    validator_path = part_path + VALIDATOR_SUFFIX
+    if not os.path.exists(validator_path):
+        return None
+    with open(validator_path) as f:
+        return f.read().strip() or None
+
+
+def _save_validator(part_path, response):
+    """Records the ETag or Last-Modified of the object a temp file holds."""
+    validator_path = part_path + VALIDATOR_SUFFIX
+    validator = response.headers.get("ETag") or response.headers.get(
+        "Last-Modified"
+    )
+    if validator:
+        with open(validator_path, "w") as f:
+            f.write(validator)
+    elif os.path.exists(validator_path):
+        os.remove(validator_path)
+
+
+def _fetch_once(url, part_path, timeout):
+    """Performs a single (possibly ranged) GET into the temp file.
+
+    A partial file is only resumed with an If-Range on the validator of the
+    object it was started from, so the server sends the whole object again
+    if it changed in between.
+
+    Returns the number of bytes written during this attempt.
+    """
+    validator = part_validator(part_path)
+    if os.path.exists(part_path) and validator is None:
+        # Nothing tells which version the bytes belong to
+        discard_part(part_path)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {}
+    if offset:
+        headers = {"Range": f"bytes={offset}-", "If-Range": validator}
+    with _session().get(
+        url, headers=headers, stream=True, timeout=timeout
+    ) as r:
+        if r.status_code == 416:
+            total = r.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+            if total.isdigit() and int(total) == offset:
+                # The temp file already holds the whole object
+                return 0
+            # The temp file is larger than the object, start over
+            r.close()
+            discard_part(part_path)
+            return _fetch_once(url, part_path, timeout)
+        r.raise_for_status()
+        if offset and r.status_code != 206:
+            # The object changed or the server ignored the Range header, start
+            # over
+            offset = 0
+        if not offset:
+            _save_validator(part_path, r)
+        total = _total_size(r, offset)
+        written = 0
+        with open(part_path, "ab" if offset else "wb") as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                written += len(chunk)
+    if total is not None and os.path.getsize(part_path) != total:
+        raise IOError(
+            f"incomplete download of {url}: "
+            f"{os.path.getsize(part_path)} of {total} bytes"
+        )
+    return written
+
+
+def download_file(
+    url, output_dir, retries=5, backoff=2, timeout=60, overwrite=False
+):
+    """Downloads a single URL into output_dir, resuming partial files.
+
+    Data is written to ``<name>.part`` and renamed into place once complete,
+    so an interrupted run never leaves a truncated file under the final name.
+
+    :param url: The URL to download.
+    :param output_dir: The directory the file is written to.
+    :param retries: Number of attempts before giving up.
+    :param backoff: Base of the exponential wait (seconds) between attempts.
+    :param timeout: Connect/read timeout (seconds) per request.
+    :param overwrite: Download again even if the final file already exists.
+
+    Returns:
+        dict with url, path, status ("done", "skipped" or "failed"), bytes,
+        seconds and error.
+    """
+    path = os.path.join(output_dir, filename_from_url(url))
+    result = {
+        "url": url,
+        "path": path,
+        "status": "skipped",
+        "bytes": 0,
+        "seconds": 0.0,
+        "error": None,
+    }
+    if os.path.exists(path) and not overwrite:
+        return result
+
+    part_path = path + PART_SUFFIX
+    start = time.monotonic()
+    for attempt in range(1, retries + 1):
+        try:
+            result["bytes"] += _fetch_once(url, part_path, timeout)
+            os.replace(part_path, path)
+            discard_part(part_path)
+            result["status"] = "done"
+            break
+        except (requests.RequestException, IOError) as e:
+            result["error"] = str(e)
+            logger.warning(
+                f"attempt {attempt}/{retries} for {url} failed: {e}"
+            )
+            if attempt < retries:
+                time.sleep(backoff**attempt)
+    else:
+        result["status"] = "failed"
+    result["seconds"] = time.monotonic() - start
+    return result
+
+
+def download_all(urls, output_dir, max_workers=8, **kwargs):
+    """Downloads many URLs concurrently with a bounded thread pool.
+
+    :param urls: Iterable of URLs to download.
+    :param output_dir: The directory files are written to.
+    :param max_workers: Maximum number of concurrent downloads.
+    :param kwargs: Passed on to :func:`download_file`.
+
+    Returns:
+        dict with the per-file results and aggregate bytes, seconds and
+        throughput (MB/s).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    results = []
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(download_file, url, output_dir, **kwargs)
+            for url in urls
+        ]
+        for future in as_completed(futures):
+            res = future.result()
+            results.append(res)
+            if res["status"] == "done":
+                rate = res["bytes"] / max(res["seconds"], 1e-9) / 1e6
+                logger.info(
+                    f"downloaded {res['url']} ({res['bytes']} bytes, "
+                    f"{rate:.2f} MB/s)"
+                )
+            elif res["status"] == "failed":
+                logger.error(
+                    f"failed to download {res['url']}: {res['error']}"
+                )
+
+    elapsed = time.monotonic() - start
+    total_bytes = sum(r["bytes"] for r in results)
+    summary = {
+        "files": results,
+        "done": sum(r["status"] == "done" for r in results),
+        "skipped": sum(r["status"] == "skipped" for r in results),
+        "failed": sum(r["status"] == "failed" for r in results),
+        "bytes": total_bytes,
+        "seconds": elapsed,
+        "throughput": total_bytes / max(elapsed, 1e-9) / 1e6,
+    }
+    logger.info(
+        f"downloaded {summary['done']} files, skipped {summary['skipped']}, "
+        f"failed {summary['failed']}: {total_bytes} bytes in {elapsed:.1f}s "
+        f"({summary['throughput']:.2f} MB/s)"
+    )
+    return summary
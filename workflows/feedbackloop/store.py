@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""Columnar history of feedback loop snapshots.
+
+Each sensor run is appended as a compressed Parquet file under
+``<directory>/date=YYYY-MM-DD/`` and registered in ``index.json``, so the
+latest, previous and as-of lookups never have to scan the directory.
+
+The sensors used to write one ``<prefix><timestamp>.json`` file per run into
+the same directory. A store without an index imports those files once, in
+time order, so the history carries over and no full re-sense is needed.
+"""
+import bisect
+import datetime
+import json
+import os
+import re
+import time
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+INDEX_FILE = "index.json"
+# Snapshots of the JSON history, e.g. 1699881271.json or clms-1699881271.json
+LEGACY_PATTERN = re.compile(r"^(?:.*-)?(\d{9,})\.json$")
+RUN_COLUMN = "_run_id"
+# The keys each row had, so that missing keys and explicit nulls stay apart
+KEYS_COLUMN = "_keys"
+COMPRESSION = "zstd"
+
+
+def _to_table(snapshot, run_id):
+    """Converts a snapshot to an Arrow table with one column per key of any
+    row.
+
+    Nested values (lists/dicts), and columns whose values have no common
+    Arrow type, are kept as JSON strings.
+
+    Returns:
+        (table, json_columns)
+    """
+    keys = list(dict.fromkeys(k for item in snapshot for k in item))
+    json_columns = sorted(
+        {
+            k
+            for item in snapshot
+            for k, v in item.items()
+            if isinstance(v, (dict, list))
+        }
+    )
+    columns = {}
+    for k in keys:
+        values = [item.get(k) for item in snapshot]
+        if k not in json_columns:
+            try:
+                columns[k] = pa.array(values)
+                continue
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                json_columns.append(k)
+        columns[k] = pa.array(
+            [
+                None if v is None else json.dumps(v, default=str)
+                for v in values
+            ],
+            pa.string(),
+        )
+    columns[RUN_COLUMN] = pa.array([run_id] * len(snapshot), pa.string())
+    columns[KEYS_COLUMN] = pa.array(
+        [list(item) for item in snapshot], pa.list_(pa.string())
+    )
+    return pa.table(columns), sorted(json_columns)
+
+
+def _unify(tables, json_columns):
+    """Gives each column one Arrow type across the tables of several runs.
+
+    A column with different types in different runs (e.g. int64 in one and
+    double or a string in another) is JSON-encoded in all of them, so the
+    values come back exactly as they were appended.
+
+    :param tables: The Arrow tables to merge.
+    :param json_columns: The JSON-encoded columns of each run id.
+
+    Returns:
+        (tables, mixed): The unified tables and the names of the columns that
+        are JSON-encoded in every run from now on.
+    """
+    types = {}
+    for table in tables:
+        for field in table.schema:
+            if not pa.types.is_null(field.type):
+                types.setdefault(field.name, set()).add(field.type)
+    mixed = {name for name, found in types.items() if len(found) > 1}
+    unified = []
+    for table in tables:
+        run_ids = table[RUN_COLUMN].to_pylist()
+        columns = []
+        for field, column in zip(table.schema, table.columns):
+            if field.name in mixed:
+                column = pa.array(
+                    [
+                        v
+                        if v is None or field.name in json_columns[run_id]
+                        else json.dumps(v, default=str)
+                        for v, run_id in zip(column.to_pylist(), run_ids)
+                    ],
+                    pa.string(),
+                )
+            elif pa.types.is_null(field.type) and field.name in types:
+                column = column.cast(next(iter(types[field.name])))
+            columns.append(column)
+        unified.append(pa.table(columns, names=table.schema.names))
+    return unified, mixed
+
+
+class SnapshotStore:
+    """Append-only store of sensor snapshots for one data source.
+
+    :param directory: The store directory, usually ``logs/feedback/<source>/``.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self._runs = None
+        self._timestamps = None
+
+    @property
+    def runs(self):
+        """Index entries of all stored runs, oldest first."""
+        if self._runs is None:
+            if os.path.exists(self.index_path):
+                with open(self.index_path) as f:
+                    self._runs = json.load(f)
+            else:
+                self._runs = []
+                self.import_legacy()
+        return self._runs
+
+    def import_legacy(self):
+        """Appends the JSON snapshots of the old per-run files in the store
+        directory.
+
+        Returns:
+            The number of runs imported.
+        """
+        if not os.path.isdir(self.directory):
+            return 0
+        legacy = []
+        for name in os.listdir(self.directory):
+            match = LEGACY_PATTERN.match(name)
+            if match:
+                legacy.append(
+                    (int(match.group(1)), os.path.join(self.directory, name))
+                )
+        last = self._runs[-1]["timestamp"] if self._runs else float("-inf")
+        imported = 0
+        for timestamp, path in sorted(legacy):
+            if timestamp <= last:
+                continue
+            with open(path) as f:
+                snapshot = json.load(f)
+            if isinstance(snapshot, list):
+                self.append(snapshot, timestamp=timestamp)
+                imported += 1
+        return imported
+
+    def _save_index(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.runs, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def append(self, snapshot, timestamp=None):
+        """Stores a snapshot as a new run.
+
+        :param snapshot: A list of metadata dicts.
+        :param timestamp: The run time in seconds since the epoch, defaults to
+            now.
+
+        Returns:
+            The run id.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        run_id = f"{timestamp:.6f}".replace(".", "")
+        if self.runs and timestamp < self.runs[-1]["timestamp"]:
+            raise ValueError("runs must be appended in time order")
+
+        table, json_columns = _to_table(snapshot, run_id)
+
+        date = datetime.datetime.fromtimestamp(
+            timestamp, datetime.timezone.utc
+        ).date()
+        partition = os.path.join(self.directory, f"date={date.isoformat()}")
+        os.makedirs(partition, exist_ok=True)
+        path = os.path.join(partition, f"{run_id}.parquet")
+        pq.write_table(table, f"{path}.tmp", compression=COMPRESSION)
+        os.replace(f"{path}.tmp", path)
+
+        if self._timestamps is not None:
+            self._timestamps.append(timestamp)
+        self.runs.append(
+            {
+                "run_id": run_id,
+                "timestamp": timestamp,
+                "path": os.path.relpath(path, self.directory),
+                "rows": len(snapshot),
+                "json_columns": json_columns,
+            }
+        )
+        self._save_index()
+        return run_id
+
+    def read(self, run):
+        """Loads the snapshot of an index entry as a list of metadata dicts."""
+        table = pq.read_table(
+            os.path.join(self.directory, run["path"]),
+            filters=[(RUN_COLUMN, "=", run["run_id"])],
+        )
+        snapshot = []
+        for row in table.drop_columns([RUN_COLUMN]).to_pylist():
+            # Keys of other rows and runs come back as nulls
+            keys = row.pop(KEYS_COLUMN, None)
+            if keys is None:
+                # Written before the keys were stored
+                row = {k: v for k, v in row.items() if v is not None}
+            else:
+                row = {k: row.get(k) for k in keys}
+            for k in run["json_columns"]:
+                if row.get(k) is not None:
+                    row[k] = json.loads(row[k])
+            snapshot.append(row)
+        return snapshot
+
+    def latest(self):
+        """Returns the most recent snapshot, or None if the store is empty."""
+        return self.read(self.runs[-1]) if self.runs else None
+
+    def previous(self):
+        """Returns the snapshot before the most recent one, or None."""
+        return self.read(self.runs[-2]) if len(self.runs) > 1 else None
+
+    def as_of(self, timestamp):
+        """Returns the last snapshot taken at or before timestamp, or None."""
+        if self._timestamps is None:
+            self._timestamps = [run["timestamp"] for run in self.runs]
+        i = bisect.bisect_right(self._timestamps, timestamp)
+        return self.read(self.runs[i - 1]) if i else None
+
+    def compact(self):
+        """Merges all runs of each date partition into a single Parquet file.
+
+        Returns:
+            The number of files removed.
+        """
+        by_path = {}
+        for run in self.runs:
+            by_path.setdefault(os.path.dirname(run["path"]), set()).add(
+                run["path"]
+            )
+        removed = 0
+        for partition, paths in by_path.items():
+            if len(paths) < 2:
+                continue
+            tables, mixed = _unify(
+                [
+                    pq.read_table(os.path.join(self.directory, p))
+                    for p in sorted(paths)
+                ],
+                {run["run_id"]: run["json_columns"] for run in self.runs},
+            )
+            merged = pa.concat_tables(tables, promote_options="default")
+            path = os.path.join(
+                partition, f"compacted-{int(time.time() * 1e6)}.parquet"
+            )
+            pq.write_table(
+                merged,
+                os.path.join(self.directory, f"{path}.tmp"),
+                compression=COMPRESSION,
+            )
+            os.replace(
+                os.path.join(self.directory, f"{path}.tmp"),
+                os.path.join(self.directory, path),
+            )
+            for run in self.runs:
+                if run["path"] in paths:
+                    run["json_columns"] = sorted(
+                        mixed.union(run["json_columns"])
+                    )
+                    run["path"] = path
+            self._save_index()
+            for p in paths:
+                os.remove(os.path.join(self.directory, p))
+                removed += 1
+        return removed
+
+    def retain(self, keep_last=None, max_age=None):
+        """Drops old runs from the store.
+
+        The latest run is always kept.
+
+        :param keep_last: Keep at most this many of the most recent runs.
+        :param max_age: Drop runs older than this many seconds.
+
+        Returns:
+            The number of runs dropped.
+        """
+        keep = list(self.runs)
+        if keep_last is not None:
+            keep = keep[-max(keep_last, 1):]
+        if max_age is not None:
+            cutoff = time.time() - max_age
+            keep = [
+                run for run in keep if run["timestamp"] >= cutoff
+            ] or self.runs[-1:]
+        dropped = [run for run in self.runs if run not in keep]
+        if not dropped:
+            return 0
+
+        kept_ids = {run["run_id"] for run in keep}
+        self._runs = keep
+        self._timestamps = None
+        self._save_index()
+        # Delete files nobody references and rewrite compacted files that still
+        # are
+        for path in {run["path"] for run in dropped}:
+            full_path = os.path.join(self.directory, path)
+            if not any(run["path"] == path for run in keep):
+                os.remove(full_path)
+                if not os.listdir(os.path.dirname(full_path)):
+                    os.rmdir(os.path.dirname(full_path))
+                continue
+            table = pq.read_table(full_path)
+            mask = pc.is_in(
+                table[RUN_COLUMN], value_set=pa.array(sorted(kept_ids))
+            )
+            pq.write_table(
+                table.filter(mask), f"{full_path}.tmp", compression=COMPRESSION
+            )
+            os.replace(f"{full_path}.tmp", full_path)
+        return len(dropped)
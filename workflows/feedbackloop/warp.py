@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""Reusable warp plans for rasters that share a source and a target grid.
+
+All CHELSA layers are published on the same global grid and are warped onto
+the same 10 km EPSG:3035 grid for Europe. A :class:`WarpPlan` records, once,
+which target cell every source pixel of the Europe window falls into, so each
+layer is then remapped with a vectorized gather and a bincount average.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import rasterio
+import xarray as xr
+import rioxarray  # noqa: F401 registers the .rio accessor
+from affine import Affine
+from pyproj import Transformer
+from rasterio.warp import calculate_default_transform
+from rasterio.windows import Window, from_bounds
+
+
+def target_grid(src, bounds, downscale_factor, crs):
+    """Computes the target grid of a lon/lat window at the downscaled
+    resolution.
+
+    :param src: An open rasterio dataset.
+    :param bounds: The (left, bottom, right, top) window in source coordinates.
+    :param downscale_factor: The ratio of the target to the default reprojected
+        resolution.
+    :param crs: The target CRS.
+
+    Returns:
+        (transform, width, height) of the target grid.
+    """
+    window = source_window(src.transform, bounds)
+    left, bottom, right, top = rasterio.windows.bounds(window, src.transform)
+    transform, width, height = calculate_default_transform(
+        src.crs, crs, window.width, window.height, left, bottom, right, top
+    )
+    new_width = int(width * downscale_factor)
+    new_height = int(height * downscale_factor)
+    transform = transform * Affine.scale(
+        width / new_width, height / new_height
+    )
+    return transform, new_width, new_height
+
+
+def source_window(transform, bounds):
+    """Returns the pixel-aligned source window covering bounds."""
+    return (
+        from_bounds(*bounds, transform=transform)
+        .round_offsets()
+        .round_lengths()
+    )
+
+
+class WarpPlan:
+    """Precomputed index remap from a source window to a target grid.
+
+    :param meta: Grid description with src_crs, src_transform, window, dst_crs,
+        dst_transform, dst_shape.
+    :param src_index: Flat indices of the window pixels that land on the target
+        grid.
+    :param dst_index: Flat target cell index of each of those pixels.
+    """
+
+    def __init__(self, meta, src_index, dst_index):
+        self.meta = meta
+        self.src_index = src_index
+        self.dst_index = dst_index
+
+    @property
+    def window(self):
+        return Window(*self.meta["window"])
+
+    @property
+    def dst_transform(self):
+        return Affine(*self.meta["dst_transform"])
+
+    @property
+    def dst_shape(self):
+        return tuple(self.meta["dst_shape"])
+
+    @staticmethod
+    def key(src, bounds, downscale_factor, crs):
+        """Identifies a source/target grid pair, used to name cached plans."""
+        grid = [
+            src.crs.to_wkt(),
+            list(src.transform)[:6],
+            src.shape,
+            list(bounds),
+            downscale_factor,
+            str(crs),
+        ]
+        return hashlib.sha1(json.dumps(grid).encode()).hexdigest()[:16]
+
+    @classmethod
+    def build(cls, src, bounds, downscale_factor, crs):
+        """Computes the plan for an open rasterio dataset.
+
+        Every source pixel centre in the window is projected to the target CRS
+        and assigned to the target cell that contains it.
+        """
+        window = source_window(src.transform, bounds)
+        dst_transform, width, height = target_grid(
+            src, bounds, downscale_factor, crs
+        )
+        win_transform = rasterio.windows.transform(window, src.transform)
+        to_dst = Transformer.from_crs(src.crs, crs, always_xy=True)
+        inverse = ~dst_transform
+
+        src_index = []
+        dst_index = []
+        # Project one block of rows at a time to keep memory bounded
+        cols = np.arange(window.width) + 0.5
+        step = max(1, 2**22 // max(window.width, 1))
+        for row0 in range(0, window.height, step):
+            rows = np.arange(row0, min(row0 + step, window.height)) + 0.5
+            c, r = np.meshgrid(cols, rows)
+            x, y = win_transform * (c, r)
+            x, y = to_dst.transform(x, y)
+            dc, dr = inverse * (x, y)
+            dc = np.floor(dc).astype(np.int64).ravel()
+            dr = np.floor(dr).astype(np.int64).ravel()
+            inside = (dc >= 0) & (dc < width) & (dr >= 0) & (dr < height)
+            flat = np.arange(
+                row0 * window.width,
+                row0 * window.width + rows.size * window.width,
+            )
+            src_index.append(flat[inside])
+            dst_index.append(dr[inside] * width + dc[inside])
+
+        meta = {
+            "src_crs": src.crs.to_wkt(),
+            "src_transform": list(src.transform)[:6],
+            "window": [
+                int(window.col_off),
+                int(window.row_off),
+                int(window.width),
+                int(window.height),
+            ],
+            "dst_crs": str(crs),
+            "dst_transform": list(dst_transform)[:6],
+            "dst_shape": [height, width],
+        }
+        return cls(
+            meta,
+            np.concatenate(src_index).astype(np.int64),
+            np.concatenate(dst_index).astype(np.int32),
+        )
+
+    def save(self, path):
+        """Writes the plan to a directory of .npy files and a JSON description.
+
+        The files are written to a temporary directory that is then renamed,
+        so concurrent jobs building the same plan never see a partial one.
+        """
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        np.save(os.path.join(tmp_path, "src_index.npy"), self.src_index)
+        np.save(os.path.join(tmp_path, "dst_index.npy"), self.dst_index)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(self.meta, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another job saved the same plan first
+            shutil.rmtree(tmp_path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a saved plan, memory-mapping the index arrays."""
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        return cls(
+            meta,
+            np.load(os.path.join(path, "src_index.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "dst_index.npy"), mmap_mode="r"),
+        )
+
+    def apply(self, data, nodata=None):
+        """Averages a window array onto the target grid.
+
+        :param data: The source window as a 2D array.
+        :param nodata: Source value excluded from the average.
+
+        Returns:
+            The target grid as a float32 array, NaN where no valid source pixel
+            fell.
+        """
+        values = np.asarray(data).ravel()[self.src_index]
+        dst_index = self.dst_index
+        valid = (
+            ~np.isnan(values)
+            if np.issubdtype(values.dtype, np.floating)
+            else np.ones(values.shape, bool)
+        )
+        if nodata is not None:
+            valid &= values != nodata
+        if not valid.all():
+            values = values[valid]
+            dst_index = dst_index[valid]
+        size = self.dst_shape[0] * self.dst_shape[1]
+        sums = np.bincount(dst_index, weights=values, minlength=size)
+        counts = np.bincount(dst_index, minlength=size)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out = (sums / counts).astype(np.float32)
+        return out.reshape(self.dst_shape)
+
+    def warp(self, path, name):
+        """Reads the window of a GeoTIFF and remaps it to a georeferenced
+        Dataset.
+        """
+        with rasterio.open(path) as src:
+            data = src.read(1, window=self.window)
+            nodata = src.nodata
+        height, width = self.dst_shape
+        transform = self.dst_transform
+        xs = transform.c + (np.arange(width) + 0.5) * transform.a
+        ys = transform.f + (np.arange(height) + 0.5) * transform.e
+        da = xr.DataArray(
+            self.apply(data, nodata)[np.newaxis],
+            dims=("band", "y", "x"),
+            coords={"band": [1], "y": ys, "x": xs},
+        )
+        da = da.rio.write_nodata(np.nan, encoded=True)
+        ds = da.to_dataset(name=name)
+        return ds.rio.write_crs(self.meta["dst_crs"]).rio.write_transform(
+            transform
+        )
+
+
+def get_plan(path, cache_dir, bounds, downscale_factor, crs):
+    """Loads the cached plan for the grid of the GeoTIFF at path, building it
+    if needed.
+
+    Returns:
+        The path of the saved plan.
+    """
+    with rasterio.open(path) as src:
+        plan_path = os.path.join(
+            cache_dir,
+            f"warp-{WarpPlan.key(src, bounds, downscale_factor, crs)}",
+        )
+        if not os.path.exists(os.path.join(plan_path, "meta.json")):
+            WarpPlan.build(src, bounds, downscale_factor, crs).save(plan_path)
+    return plan_path
@@ -1,24 +1,282 @@
-from clusterjob import Job
 import xarray as xr
 import os
+import shlex
 import numpy as np
 from natsort import natsorted
 import datetime
+import dask
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from feedbackloop.cube import (
+    CURRENT,
+    ANNUAL,
+    init_cube,
+    write_layer,
+    consolidate,
+    parse_chelsa_name,
+)
+from telemetry import stage, tree_bytes
+from service.resources import MIN_MEM_MB, format_mem
+from service.slurm import submit, submit_array, submit_rscript, finish, gather
 
 
-account = "project_465001588"
+# TODO Convert paths to environment variables
 
+# Output profiles for the merged files: spatial chunk shape, compression and
+# optional packing of float variables into integers with scale/offset.
+# "archive" packs into int16 and is lossy, so it is only used when asked for.
+PROFILES = {
+    "archive": {
+        "chunks": {"y": 256, "x": 256},
+        "zlib": True,
+        "complevel": 9,
+        "shuffle": True,
+        "pack": "int16",
+    },
+    "balanced": {
+        "chunks": {"y": 256, "x": 256},
+        "zlib": True,
+        "complevel": 4,
+        "shuffle": True,
+        "pack": None,
+    },
+    "fast-read": {
+        "chunks": {"y": 64, "x": 64},
+        "zlib": True,
+        "complevel": 1,
+        "shuffle": True,
+        "pack": None,
+    },
+}
+DEFAULT_PROFILE = "balanced"
+
+
+def _scan_header(path):
+    """Reads the ClimModel/ClimScenario/TimePeriod key of a netCDF file without
+    loading data.
 
-# TODO Convert paths to environment variables
+    Returns:
+        The merge key of the file, or None for current climate files.
+    """
+    with xr.open_dataset(path) as ds:
+        attrs = ds[list(ds.data_vars)[0]].attrs
+        if (
+            "ClimModel" in attrs
+            and "ClimScenario" in attrs
+            and "TimePeriod" in attrs
+        ):
+            return (
+                f"{attrs['ClimModel']}_{attrs['ClimScenario']}_"
+                f"{attrs['TimePeriod']}"
+            )
+    return None
+
+
+def _layer_key(ds):
+    """Returns the (variable, scenario, model, period, month) cube key of a
+    per-layer netCDF file.
+
+    The climate attributes written by the R processing take precedence over
+    the CHELSA name of the variable, see feedbackloop.cube.parse_chelsa_name.
+    """
+    name = list(ds.data_vars)[0]
+    attrs = ds[name].attrs
+    try:
+        key = parse_chelsa_name(name)
+    except ValueError:
+        if "Var" not in ds.attrs or "TimePeriod" not in attrs:
+            raise
+        key = (None, CURRENT, CURRENT, None, ANNUAL)
+    variable, scenario, model, period, month = key
+    return (
+        ds.attrs.get("Var", variable),
+        attrs.get("ClimScenario", scenario),
+        attrs.get("ClimModel", model),
+        attrs.get("TimePeriod", period),
+        month,
+    )
+
+
+def _write_zarr_layer(path, store):
+    """Copies the first variable of a per-layer netCDF file into its slot of
+    the cube.
+    """
+    with xr.open_dataset(path) as ds:
+        key = _layer_key(ds)
+        write_layer(store, ds[list(ds.data_vars)[0]].values.squeeze(), *key)
+    return key
+
+
+def _convert2zarr(directory, files, store, max_workers):
+    """Writes every layer into one consolidated Zarr cube, one worker per
+    layer.
+    """
+    paths = [os.path.join(directory, file) for file in files]
+    layers = []
+    for path in paths:
+        with xr.open_dataset(path) as ds:
+            layers.append(_layer_key(ds))
+    # init_cube raises when several files map to the same layer
+    with xr.open_dataset(paths[0]) as ds:
+        y, x = ds["y"].values, ds["x"].values
+    init_cube(
+        store,
+        layers,
+        y=y,
+        x=x,
+        crs="EPSG:3035",
+        attrs={
+            "Organization": (
+                "Helmholtz Centre for Environmental Research (UFZ)"
+            ),
+            "Project": "Biodiversity Digital Twin (BioDT)",
+            "Date": str(datetime.datetime.now()),
+        },
+    )
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(_write_zarr_layer, path, store): path for path in paths
+        }
+        for future in as_completed(futures):
+            print(f"Wrote {futures[future]} to {store} as {future.result()}")
+    consolidate(store)
+    return True
+
+
+def _prepare(ds):
+    """Moves the climate attributes of the first variable to the dataset."""
+    variables = list(ds.data_vars)
+    # ds[variables[0]].attrs["lambert_azimuthal_equal_area"]
+    # ds[variables[0]].attrs["LongName"] = ds[variables[0]].attrs["Long_name"]
+    # ds[variables[0]].attrs.pop("Long_name", None)
+    # ds[variables[0]].attrs["Var"] = ds.attrs["Var"]
+    ds[variables[0]].attrs["Explanation"] = ds[variables[0]].attrs[
+        "explanation"
+    ]
+    del ds[variables[0]].attrs["explanation"]
+    ds.attrs["ClimModel"] = ds[variables[0]].attrs["ClimModel"]
+    ds.attrs["ClimScenario"] = ds[variables[0]].attrs["ClimScenario"]
+    ds.attrs["TimePeriod"] = ds[variables[0]].attrs["TimePeriod"]
+    return ds
+
+
+def encoding_for(ds, profile=DEFAULT_PROFILE):
+    """Builds the per-variable netCDF encoding of a dataset for an output
+    profile.
+
+    Args:
+        ds (xarray.Dataset): The dataset to be written.
+        profile (str or dict): A name from PROFILES or a profile dict.
+
+    Returns:
+        dict: The encoding to pass to ``to_netcdf``.
+    """
+    if isinstance(profile, str):
+        profile = PROFILES[profile]
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        if var.ndim == 0:
+            continue
+        enc = {
+            "zlib": profile["zlib"],
+            "complevel": profile["complevel"],
+            "shuffle": profile["shuffle"],
+            "chunksizes": tuple(
+                min(profile["chunks"].get(dim, 1), size)
+                for dim, size in var.sizes.items()
+            ),
+        }
+        if profile["pack"] and var.dtype.kind == "f":
+            # Map the value range onto the integer range, keeping the lowest
+            # value for NaN
+            info = np.iinfo(profile["pack"])
+            # One pass over the data for both bounds
+            vmin, vmax = (float(v) for v in dask.compute(var.min(), var.max()))
+            if not (np.isfinite(vmin) and np.isfinite(vmax)):
+                # All NaN: there is no range to pack, the variable stays float
+                encoding[name] = enc
+                continue
+            scale = (vmax - vmin) / (info.max - info.min - 1) or 1.0
+            enc.update(
+                dtype=profile["pack"],
+                scale_factor=scale,
+                add_offset=vmin - (info.min + 1) * scale,
+                _FillValue=info.min,
+            )
+        encoding[name] = enc
+    return encoding
+
+
+def _write_merged(datasets, output_path, profile=DEFAULT_PROFILE):
+    """Merges the datasets of one key and writes them to output_path."""
+    # Combine all datasets into a single dataset
+    merged_ds = xr.merge(datasets)
+    # Delete unnecessary attributes
+    del merged_ds.attrs["Var"]
+    del merged_ds.attrs["Long_name"]
+    del merged_ds.attrs["unit"]
+    del merged_ds.attrs["explanation"]
+    del merged_ds.attrs["created_by"]
+    del merged_ds.attrs["date"]
+    # Add metadata to the merged dataset
+    merged_ds.attrs["Organization"] = (
+        "Helmholtz Centre for Environmental Research (UFZ)"
+    )
+    merged_ds.attrs["Project"] = "Biodiversity Digital Twin (BioDT)"
+    merged_ds.attrs["Date"] = str(datetime.datetime.now())
+    merged_ds.attrs["EPSG"] = "3035"
+    # Save the merged dataset to a netCDF file
+    merged_ds.to_netcdf(output_path, encoding=encoding_for(merged_ds, profile))
+    return output_path
 
 
-def convert2nc(input_paths, output_dir):
+def _merge_group(key, paths, output_dir, chunks, profile):
+    """Lazily opens the files of one key, writes the merged file and releases
+    the handles.
+    """
+    datasets = [
+        _prepare(xr.open_dataset(path, chunks=chunks)) for path in paths
+    ]
+    try:
+        return _write_merged(datasets, f"{output_dir}/{key}.nc", profile)
+    finally:
+        for ds in datasets:
+            ds.close()
+
+
+def convert2nc(
+    input_paths,
+    output_dir,
+    streaming=True,
+    max_workers=None,
+    chunks="auto",
+    profile=DEFAULT_PROFILE,
+    backend="netcdf",
+):
     """
     Converts netCDF files to a merged netCDF file.
 
+    In streaming mode the files are first grouped by their ClimModel,
+    ClimScenario and TimePeriod attributes with a header scan. Each group is
+    then opened lazily with dask chunks, merged and written as soon as it is
+    complete, with groups spread across worker processes.
+
+    With the "zarr" backend every file is instead written as one layer of a
+    single consolidated Zarr store at output_dir, with dimensions for variable,
+    scenario, model and period, so readers can slice any combination lazily.
+
     Args:
         input_paths (str): The directory path where the netCDF files are located.
         output_dir (str): The directory path where the merged netCDF file will be saved.
+        streaming (bool): Merge group by group instead of opening every file up
+            front.
+        max_workers (int): The number of groups merged in parallel in streaming
+            mode.
+        chunks (str or dict): The dask chunks used to open the files in
+            streaming mode.
+        profile (str or dict): The output profile, one of PROFILES or a profile
+            dict. Defaults to the lossless "balanced"; "archive" packs values
+            into int16.
+        backend (str): "netcdf" for one merged file per key, or "zarr".
 
     Returns:
         None
@@ -29,6 +287,51 @@ def convert2nc(input_paths, output_dir):
     # Get a list of all netCDF files in the directory
     files = natsorted([file for file in os.listdir(directory) if file.endswith(".nc")])
 
+    with stage(
+        "chelsa.convert2nc",
+        backend=backend,
+        streaming=streaming,
+        files=len(files),
+    ) as metrics:
+        if backend == "zarr":
+            result = _convert2zarr(directory, files, output_dir, max_workers)
+        elif not streaming:
+            result = _convert2nc_eager(directory, files, output_dir, profile)
+        else:
+            result = _convert2nc_streaming(
+                directory, files, output_dir, max_workers, chunks, profile
+            )
+        metrics["bytes_written"] = tree_bytes(output_dir)
+    return result
+
+
+def _convert2nc_streaming(
+    directory, files, output_dir, max_workers, chunks, profile
+):
+    """Merges the files group by group, each group opened lazily in a worker.
+    """
+    # Group the files by key from their headers only
+    groups = {}
+    for file in files:
+        key = _scan_header(os.path.join(directory, file))
+        if key is not None:
+            groups.setdefault(key, []).append(os.path.join(directory, file))
+
+    # Merge and write each group as soon as its worker gets to it
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(
+                _merge_group, key, paths, output_dir, chunks, profile
+            ): key
+            for key, paths in groups.items()
+        }
+        for future in as_completed(futures):
+            print(f"Merged {futures[future]} to {future.result()}")
+    return True
+
+
+def _convert2nc_eager(directory, files, output_dir, profile):
+    """Opens every file up front and merges the datasets of each key."""
     # Create an empty dictionary to store the datasets
     datasets_m = {}
     datasets_c = {}
@@ -44,31 +347,12 @@ def convert2nc(input_paths, output_dir):
             and "ClimScenario" in ds[variables[0]].attrs
             and "TimePeriod" in ds[variables[0]].attrs
         ):
-            # Get the unique ClimModel and ClimScenario attributes
-            clim_model = ds[variables[0]].attrs["ClimModel"]
-            clim_scenario = ds[variables[0]].attrs["ClimScenario"]
-            time_period = ds[variables[0]].attrs["TimePeriod"]
-            # ds[variables[0]].attrs["lambert_azimuthal_equal_area"]
-            # ds[variables[0]].attrs["LongName"] = ds[variables[0]].attrs["Long_name"]
-            # ds[variables[0]].attrs.pop("Long_name", None)
-            # ds[variables[0]].attrs["Var"] = ds.attrs["Var"]
-            ds[variables[0]].attrs["Explanation"] = ds[variables[0]].attrs[
-                "explanation"
-            ]
-            del ds[variables[0]].attrs["explanation"]
-            ds.attrs["ClimModel"] = clim_model
-            ds.attrs["ClimScenario"] = clim_scenario
-            ds.attrs["TimePeriod"] = time_period
-            # ds.attrs['crs_wkt'] = str(ds[variables[1]].attrs["crs_wkt"])
-            # ds.attrs['spatial_ref'] = str(ds[variables[1]].attrs["spatial_ref"])
-            # ds.attrs['proj4'] = str(ds[variables[1]].attrs["proj4"])
-            # ds.attrs['epsg_code'] = str(ds[variables[1]].attrs["epsg_code"])
-            # ds.attrs['geotransform'] = str(ds[variables[1]].attrs["geotransform"])
-            # ds.attrs['crs'] = ds[variables[1]].attrs["crs_wkt"]
-            # ds = ds.rename({variables[0]: ds.attrs["Var"]})
-
+            ds = _prepare(ds)
             # Create a key for the dataset dictionary using the ClimModel and ClimScenario attributes
-            key = f"{clim_model}_{clim_scenario}_{time_period}"
+            key = (
+                f"{ds.attrs['ClimModel']}_{ds.attrs['ClimScenario']}_"
+                f"{ds.attrs['TimePeriod']}"
+            )
 
             # Store the dataset in the dictionary
             if key not in datasets_m:
@@ -80,182 +364,206 @@ def convert2nc(input_paths, output_dir):
 
     # Iterate over the datasets dictionary and merge the datasets
     for key, ds in datasets_m.items():
-        # Combine all datasets into a single dataset
-        merged_ds = xr.merge(ds)
-        # Delete unnecessary attributes
-        del merged_ds.attrs["Var"]
-        del merged_ds.attrs["Long_name"]
-        del merged_ds.attrs["unit"]
-        del merged_ds.attrs["explanation"]
-        del merged_ds.attrs["created_by"]
-        del merged_ds.attrs["date"]
-        # Add metadata to the merged dataset
-        merged_ds.attrs["Organization"] = (
-            "Helmholtz Centre for Environmental Research (UFZ)"
-        )
-        merged_ds.attrs["Project"] = "Biodiversity Digital Twin (BioDT)"
-        merged_ds.attrs["Date"] = str(datetime.datetime.now())
-        merged_ds.attrs["EPSG"] = "3035"
-        # Save the merged dataset to a netCDF file
-        merged_ds.encoding.update({"zlib": True, "complevel": 9})
-        merged_ds.to_netcdf(f"{output_dir}/{key}.nc")
+        _write_merged(ds, f"{output_dir}/{key}.nc", profile)
     return True
 
 
-def job_vSensor(input_paths):
-    """Executes the workflow."""
-    vSensor = f"python3 -c 'from feedbackloop.chelsa import vSensor; vSensor(input_paths={input_paths})'"
-    job = JobScript(
-        shebang="#!/bin/bash",
-        root_dir=os.environ["ROOT_DIR"],
-        preamble=[
-            "module load cray-python",
-            "source /pfs/lustrep3/users/khantaim/iasdt-workflows/iasdt-pyenv/bin/activate",
-        ],
-        body=vSensor,
-        backend="slurm",
-        jobname="CHELSA_vSensor",
-        time="00:05:00",
-        nodes=1,
-        threads=1,
-        mem=4000,
-        account=account,
-        partition="standard",
+# SLURM resources for the CHELSA jobs
+VSENSOR_RESOURCES = {
+    "jobname": "CHELSA_vSensor",
+    "time": "00:05:00",
+    "nodes": 1,
+    "cpus_per_task": 1,
+    "mem": "4000M",
+}
+INTAKER_RESOURCES = {
+    "jobname": "CHELSA_intaker",
+    "time": "02:00:00",
+    "nodes": 2,
+    "cpus_per_task": 4,
+    "mem": "16000M",
+}
+PROCESSOR_RESOURCES = {
+    "jobname": "CHELSA_process",
+    "time": "01:00:00",
+    "mem": "200G",
+    "nodes": 1,
+    "ntasks": 1,
+}
+# Per array task: one CPU warping one Europe window at a time, the memory comes
+# from shard_mem()
+ARRAY_RESOURCES = {
+    "jobname": "CHELSA_array",
+    "time": "00:30:00",
+    "ntasks": 1,
+    "cpus_per_task": 1,
+}
+# Memory per MB of the largest GeoTIFF of a task: the compressed layer expands
+# when its window is read and is warped into a second array
+ARRAY_MEM_PER_MB = 8
+
+PYTHON_PREAMBLE = """module load cray-python
+source /pfs/lustrep3/users/khantaim/iasdt-workflows/iasdt-pyenv/bin/activate
+"""
+
+
+def job_vSensor(
+    path_file,
+    logs_feedback,
+    logs_diff,
+    logs_dir="../logs",
+    wait=False,
+    dependency=None,
+):
+    """
+    Submits the CHELSA vSensor, run from the workflows directory.
+    Args:
+        path_file (str): Path to the CHELSA file list.
+        logs_feedback (str): Directory for the sensed snapshots.
+        logs_diff (str): Directory for the lists of changed files.
+        logs_dir (str): Path to the directory to store job logs.
+        wait (bool): Wait for the job to finish instead of returning its
+            future.
+        dependency (str): An sbatch --dependency expression.
+    Returns:
+        SlurmFuture: The job future, or whether the job completed when wait
+            is True.
+    """
+    code = (
+        "from feedbackloop.chelsa import vSensor; "
+        f"vSensor({path_file!r}, {logs_feedback!r}, {logs_diff!r})"
     )
-    # Submit the job to SLURM
-    ar = job.submit()
+    body = PYTHON_PREAMBLE + f"cd workflows && python3 -c {shlex.quote(code)}"
+    future = submit(VSENSOR_RESOURCES, body, logs_dir, dependency=dependency)
 
     print("CHELSA vSensor job submitted successfully!")
 
-    ar.wait()  # Wait for the job to complete
-
-    job_state = ar.sucessful()
-
-    # Check the state of the job and return the appropriate message
-    if job_state == False:
-        print("CHELSA vSensor job failed!")
-        return False
-
-    if job_state == True:
-        print("CHELSA vSensor job done!")
-        return True
-
-
-def job_intaker(download_list, output_dir):
-    """Submits the CHELSA intaker."""
-    intaker = f"python3 -c 'from feedbackloop.chelsa import intaker; intaker(path_to_download_list={download_list}, output_dir={output_dir})'"
-    job = JobScript(
-        shebang="#!/bin/bash",
-        backend="slurm",
-        root_dir=os.environ["ROOT_DIR"],
-        preamble=[
-            "module load cray-python",
-            "source /pfs/lustrep3/users/khantaim/iasdt-workflows/iasdt-pyenv/bin/activate",
-        ],
-        body=intaker,
-        backend="slurm",
-        jobname="CHELSA_intaker",
-        time="02:00:00",
-        nodes=2,
-        threads=4,
-        mem=16000,
-        account=account,
-        partition="standard",
-    )
-    # Submit the job to SLURM
-    ar = job.submit()
-
-    print("CHELSA intaker job submitted successfully!")
+    if not wait:
+        return future
+    return finish(future, "CHELSA vSensor job")
 
-    ar.wait()  # Wait for the job to complete
 
-    job_state = ar.sucessful()
+def job_intaker(
+    download_list, output_dir, logs_dir="../logs", wait=False, dependency=None
+):
+    """Submits the CHELSA intaker, run from the workflows directory."""
+    code = (
+        "from feedbackloop.chelsa import intaker; "
+        f"intaker(path_to_download_list={download_list!r}, "
+        f"output_dir={output_dir!r})"
+    )
+    body = PYTHON_PREAMBLE + f"cd workflows && python3 -c {shlex.quote(code)}"
+    future = submit(INTAKER_RESOURCES, body, logs_dir, dependency=dependency)
 
-    # Check the state of the job and return the appropriate message
-    if job_state == False:
-        print("CHELSA intaker job failed!")
-        return False
+    print("CHELSA intaker job submitted successfully!")
 
-    if job_state == True:
-        print("CHELSA intaker job done!")
-        return True
+    if not wait:
+        return future
+    return finish(future, "CHELSA intaker job")
 
 
-def job_processor(script_path, logs_dir):
+def job_processor(script_path, logs_dir, wait=False, dependency=None):
     """
-    Create and submit a SLURM job directly using clusterjob for the CHELSA processing task.
+    Submit a SLURM job for the CHELSA processing task.
+    Args:
+        script_path (str): Path to the R script to run.
+        logs_dir (str): Path to the directory to store job logs.
+        wait (bool): Wait for the job to finish instead of returning its
+            future.
+        dependency (str): An sbatch --dependency expression.
+    Returns:
+        SlurmFuture: The job future, or whether the job completed when wait
+            is True.
     """
+    future = submit_rscript(
+        script_path, logs_dir, PROCESSOR_RESOURCES, dependency=dependency
+    )
 
-    # Define a script
-
-    script = f"""
-    echo "Start time = $(date)"
-    echo "Submitting directory = "$SLURM_SUBMIT_DIR
-    echo "working directory = "$PWD
-    echo "Project name = "$SLURM_JOB_ACCOUNT
-    echo "Job id = "$SLURM_JOB_ID
-    echo "Job name = "$SLURM_JOB_NAME
-    echo "memory per CPU = "$SLURM_MEM_PER_CPU
-    echo "Node running the job script = "$SLURMD_NODENAME
-    echo "Process ID of the process started for the task = "$SLURM_TASK_PID
-    echo "Dependency = "$SLURM_JOB_DEPENDENCY
-    echo "Number of nodes assigned to a job = "$SLURM_NNODES
-    echo "Number of tasks requested by the job = "$SLURM_NTASKS
-    echo "Number of cpus per task = "$SLURM_CPUS_PER_TASK
-
-    module load LUMI/23.09 partition/L GDAL fontconfig FriBidi HarfBuzz git UDUNITS libsodium GSL libarchive/3.6.2-cpeGNU-23.09 R
+    print("CHELSA processing job submitted successfully!")
 
-    export CRAYBLAS_WARN=0
+    if not wait:
+        return future
+    return finish(future, "CHELSA processing job")
 
-    Rscript --vanilla {script_path}
 
-    echo "End of program at `date`"
+def shard_mem(paths):
+    """
+    Memory request of the array tasks, sized for the largest GeoTIFF any of
+    them converts.
+    The tasks convert one layer at a time, so the largest layer bounds their
+    peak memory.
+    Args:
+        paths (list): The GeoTIFFs of the array job.
+    Returns:
+        str: An sbatch memory value.
+    """
+    largest = max((os.path.getsize(path) for path in paths), default=0)
+    return format_mem(max(MIN_MEM_MB, ARRAY_MEM_PER_MB * largest / 1024**2))
+
+
+def job_processor_array(
+    input_dir,
+    output_dir,
+    logs_dir,
+    shards=100,
+    max_parallel=50,
+    plan_dir=None,
+    mem=None,
+    wait=False,
+    dependency=None,
+):
+    """
+    Submit the CHELSA layer conversion as an array job, one task per shard of
+    GeoTIFFs.
+    Args:
+        input_dir (str): The directory with the CHELSA GeoTIFFs.
+        output_dir (str): The directory for the per-layer NetCDF files.
+        logs_dir (str): Path to the directory to store job logs and shards.
+        shards (int): The maximum number of array tasks.
+        max_parallel (int): The maximum number of tasks running at once.
+        plan_dir (str): Directory of cached warp plans shared by the tasks.
+        mem (str): Memory per task, overriding the estimate of shard_mem().
+        wait (bool): Wait for the job to finish instead of returning its
+            future.
+        dependency (str): An sbatch --dependency expression.
+    Returns:
+        SlurmFuture: The job future, or the per-shard summary from gather()
+            when wait is True.
     """
-    # Define the SLURM job
-    job = Job(
-        backend="slurm",
-        jobname="CHELSA_process",
-        account=account,
-        root_dir=os.environ["ROOT_DIR"],
-        time="01:00:00",
-        partition="standard",
-        mem="200G",
-        nodes=1,
-        ntasks=1,
-        output=f"{logs_dir}/%x-%A-%a.out",
-        error=f"{logs_dir}/%x-%A-%a.err",
-        modules=[
-            "LUMI/23.09",
-            "partition/L",
-            "GDAL",
-            "fontconfig",
-            "FriBidi",
-            "HarfBuzz",
-            "git",
-            "UDUNITS",
-            "libsodium",
-            "GSL",
-            "libarchive/3.6.2-cpeGNU-23.09",
-            "R",
-        ],
-        exports=["CRAYBLAS_WARN=0"],
-        script=script,
+    paths = natsorted(
+        os.path.abspath(os.path.join(input_dir, f))
+        for f in os.listdir(input_dir)
+        if f.endswith(".tif")
+    )
+    resources = dict(ARRAY_RESOURCES, mem=mem or shard_mem(paths))
+    code = (
+        "import os, sys; from feedbackloop.chelsa import convert_shard; "
+        "result = convert_shard(os.environ['SHARD_FILE'], "
+        f"{os.path.abspath(output_dir)!r}, "
+        "os.environ['SHARD_RESULT'], "
+        f"{plan_dir and os.path.abspath(plan_dir)!r}); "
+        "sys.exit(1 if result['failed'] else 0)"
+    )
+    body = PYTHON_PREAMBLE + f"cd workflows && python3 -c {shlex.quote(code)}"
+    # The history scales the memory of the next runs by the size of the largest
+    # layer
+    largest = max((os.path.getsize(path) for path in paths), default=None)
+    future = submit_array(
+        resources,
+        body,
+        paths,
+        logs_dir,
+        shards,
+        max_parallel,
+        dependency=dependency,
+        input_size=largest,
     )
 
-    # Submit the job to SLURM
-    ar = job.submit()
-
-    print("CHELSA processing job submitted successfully!")
-
-    ar.wait()  # Wait for the job to complete
-
-    job_state = ar.sucessful()
-
-    # Check the state of the job and return the appropriate message
-    if job_state == False:
-        print("CHELSA processing job failed!")
-        return False
+    print(
+        "CHELSA processing array job submitted successfully! "
+        f"({future.shards} shards)"
+    )
 
-    if job_state == True:
-        print("CHELSA processing job done!")
-        return True
+    if not wait:
+        return future
+    return gather(future, "CHELSA processing array job")
@@ -1,41 +1,245 @@
+import json
 import os
-import shutil
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-def delete_files(directory):
+# Files removed per task; on Lustre every unlink is a metadata round trip
+BATCH_SIZE = 500
+
+# Manifest fields holding file names or paths; other strings such as ETags are
+# ignored
+PATH_FIELDS = {"name", "key", "path", "file", "filename", "url", "href"}
+
+
+def _scan(path):
+    """Returns [(path, size, mtime)] of every file below path, or of path
+    itself if it is a file.
+
+    Files and directories removed while scanning, e.g. by a concurrent run, are
+    left out.
+    """
+    try:
+        if not os.path.isdir(path) or os.path.islink(path):
+            st = os.lstat(path)
+            return [(path, st.st_size, st.st_mtime)]
+    except FileNotFoundError:
+        return []
+    files = []
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        st = entry.stat(follow_symlinks=False)
+                        files.append((entry.path, st.st_size, st.st_mtime))
+        except FileNotFoundError:
+            continue
+    return files
+
+
+def _is_path_field(key):
+    # Plural fields such as "files" or "paths" hold lists of them
+    key = key.lower().removesuffix("s")
+    return key in PATH_FIELDS or key.endswith(("path", "url"))
+
+
+def _manifest_names(manifest_path):
+    """Returns the file names referenced by a JSON manifest.
+
+    Names come from the strings of lists and from the values of path fields
+    (see PATH_FIELDS, and any field ending in "path" or "url"), at any depth.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    names = set()
+    stack = [(None, manifest)]
+    while stack:
+        key, item = stack.pop()
+        if isinstance(item, dict):
+            stack.extend(item.items())
+        elif isinstance(item, list):
+            # Items of a list of paths inherit the list's field
+            stack.extend((key, value) for value in item)
+        elif isinstance(item, str) and (key is None or _is_path_field(key)):
+            # Windows paths also appear, e.g. the CLMS full_path
+            names.add(re.split(r"[\\/]", item.rstrip("/\\"))[-1])
+    names.add(os.path.basename(manifest_path))
+    return names
+
+
+def _delete_batch(paths):
+    """Removes a batch of files and returns (bytes removed, errors)."""
+    removed = 0
+    errors = []
+    for path, size in paths:
+        try:
+            os.remove(path)
+            removed += size
+        except OSError as e:
+            errors.append(f"{path}: {e}")
+    return removed, errors
+
+
+def _remove_empty_dirs(roots):
+    """Removes the directories left empty in the given trees, deepest first,
+    roots included.
+    """
+    removed = 0
+    for directory in roots:
+        if not os.path.isdir(directory) or os.path.islink(directory):
+            continue
+        for root, dirs, files in os.walk(directory, topdown=False):
+            try:
+                os.rmdir(root)
+                removed += 1
+            except OSError:
+                # Not empty, or removed meanwhile
+                pass
+    return removed
+
+
+def _newest(entries, count):
+    """Returns the count most recently modified entries, skipping those removed
+    meanwhile.
+    """
+    mtimes = {}
+    for path in entries:
+        try:
+            mtimes[path] = os.lstat(path).st_mtime
+        except FileNotFoundError:
+            continue
+    return sorted(mtimes, key=mtimes.get, reverse=True)[:count]
+
+
+def _oldest_over(files, total, max_bytes):
+    """Returns the oldest files whose deletion brings total under max_bytes."""
+    candidates = []
+    for path, size, mtime in sorted(files, key=lambda f: f[2]):
+        if total <= max_bytes:
+            break
+        candidates.append((path, size, mtime))
+        total -= size
+    return candidates
+
+
+def clean(
+    directory,
+    keep_last=None,
+    keep_manifest=None,
+    older_than=None,
+    max_bytes=None,
+    dry_run=False,
+    max_workers=16,
+):
+    """
+    Deletes the contents of a directory in parallel batches, subject to
+    retention rules.
+    Args:
+        directory (str): The directory to clean; the directory itself is kept.
+        keep_last (int): Keep the newest N top-level entries (runs), by
+            modification time.
+        keep_manifest (str): A JSON manifest; files whose names its path fields
+            reference are kept.
+        older_than (float): Only delete files not modified for this many
+            seconds.
+        max_bytes (int): Only delete the oldest files needed to bring the
+            directory under this size.
+        dry_run (bool): Report what would be deleted without deleting anything.
+        max_workers (int): The number of threads scanning and deleting.
+    Returns:
+        dict: files, bytes and directories deleted (or that would be), files
+            kept, errors and seconds.
+    """
+    start = time.time()
+    summary = {
+        "files": 0,
+        "bytes": 0,
+        "dirs": 0,
+        "kept": 0,
+        "errors": [],
+        "seconds": 0.0,
+        "dry_run": dry_run,
+    }
+    if not os.path.isdir(directory):
+        print(f"{directory} is not a directory.")
+        return summary
+
+    entries = [os.path.join(directory, name) for name in os.listdir(directory)]
+    protected = set()
+    if keep_last:
+        protected.update(_newest(entries, keep_last))
+    unprotected = [e for e in entries if e not in protected]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        scanned = list(pool.map(_scan, unprotected))
+    files = [f for group in scanned for f in group]
+    protected_files = [f for p in protected for f in _scan(p)]
+    kept = len(protected_files)
+
+    if keep_manifest:
+        referenced = _manifest_names(keep_manifest)
+        candidates = [
+            f for f in files if os.path.basename(f[0]) not in referenced
+        ]
+        kept += len(files) - len(candidates)
+        files = candidates
+    if older_than is not None:
+        cutoff = time.time() - older_than
+        candidates = [f for f in files if f[2] < cutoff]
+        kept += len(files) - len(candidates)
+        files = candidates
+    if max_bytes is not None:
+        total = sum(size for _, size, _ in files + protected_files)
+        candidates = _oldest_over(files, total, max_bytes)
+        kept += len(files) - len(candidates)
+        files = candidates
+
+    summary["kept"] = kept
+    summary["files"] = len(files)
+    if dry_run:
+        summary["bytes"] = sum(size for _, size, _ in files)
+    else:
+        batches = [
+            [(path, size) for path, size, _ in files[i:i + BATCH_SIZE]]
+            for i in range(0, len(files), BATCH_SIZE)
+        ]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for removed, errors in pool.map(_delete_batch, batches):
+                summary["bytes"] += removed
+                summary["errors"].extend(errors)
+        summary["files"] -= len(summary["errors"])
+        # The protected runs are left as they are, empty directories included
+        summary["dirs"] = _remove_empty_dirs(unprotected)
+    summary["seconds"] = time.time() - start
+
+    verb = "Would delete" if dry_run else "Deleted"
+    print(
+        f"{verb} {summary['files']} files ({summary['bytes'] / 1e9:.2f} GB) "
+        f"in {directory}, "
+        f"kept {summary['kept']}, removed {summary['dirs']} empty "
+        "directories, "
+        f"{len(summary['errors'])} errors in {summary['seconds']:.1f}s"
+    )
+    for error in summary["errors"][:10]:
+        print(f"An error occurred: {error}")
+    return summary
+
+
+def delete_files(directory, dry_run=False, max_workers=16):
     """
     Deletes all files and directories within the specified directory.
     Args:
         directory (str): The path to the directory from which all files and directories will be deleted.
+        dry_run (bool): Report the files and bytes that would be deleted
+            without deleting them.
+        max_workers (int): The number of threads deleting in parallel.
     Returns:
-        None
-    Prints:
-        - A message if the directory does not exist.
-        - A message if the path is not a directory.
-        - A message for each file or directory that is deleted.
-        - A message when all files in the directory have been deleted.
-        - An error message if an exception occurs during the deletion process.
-    """
-    
+        dict: The clean() summary.
+    """
     if not os.path.exists(directory):
         print(f"Directory {directory} does not exist.")
-        return
-
-    if not os.path.isdir(directory):
-        print(f"{directory} is not a directory.")
-        return
-
-    try:
-        for filename in os.listdir(directory):
-            file_path = os.path.join(directory, filename)
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-                print(f"Deleted file: {file_path}")
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-                print(f"Deleted directory and its contents: {file_path}")
-        print(f"All files in {directory} have been deleted.")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-
-# Example usage
-# delete_all_files('/path/to/directory')
\ No newline at end of file
+        return None
+    return clean(directory, dry_run=dry_run, max_workers=max_workers)
@@ -1,86 +1,295 @@
-from clusterjob import Job
 import os
+import shlex
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-account = "project_465001588"
+import numpy as np
+import rasterio
+from pyproj import Transformer
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
 
+from telemetry import stage, tree_bytes
+from service.chelsa import PYTHON_PREAMBLE
+from service.slurm import submit, finish
 
-def job_processor(script_path, logs_dir):
+# SLURM resources for the CORINE processing job. The tiled aggregation holds
+# one tile per worker plus the 10 km class counts, not the whole raster
+RESOURCES = {
+    "jobname": "CLC",
+    "time": "00:30:00",
+    "mem": "16G",
+    "nodes": 1,
+    "ntasks": 1,
+    "cpus_per_task": 8,
+}
+
+# CORINE Land Cover codes 1-44 are classes; 48 (no data) and 128 (outside) are
+# not
+N_CLASSES = 44
+TARGET_CRS = "EPSG:3035"
+RESOLUTION = 10000
+# Tile edge in source pixels, 2048 x 2048 uint8 pixels is 4 MB per tile
+TILE_SIZE = 2048
+MAJORITY_NODATA = 0
+
+
+def target_grid(src, crs=TARGET_CRS, resolution=RESOLUTION):
     """
-    Create and submit a SLURM job directly using clusterjob.
+    Computes the target grid covering a raster, snapped to multiples of the
+    resolution.
     Args:
-        script_path (str): Path to the R script to run.
-        logs_dir (str): Path to the directory to store job logs.
+        src: An open rasterio dataset.
+        crs (str): The target CRS.
+        resolution (float): The target cell size in CRS units.
+    Returns:
+        tuple: (transform, height, width) of the target grid.
+    """
+    left, bottom, right, top = transform_bounds(src.crs, crs, *src.bounds)
+    left = np.floor(left / resolution) * resolution
+    bottom = np.floor(bottom / resolution) * resolution
+    right = np.ceil(right / resolution) * resolution
+    top = np.ceil(top / resolution) * resolution
+    width = int(round((right - left) / resolution))
+    height = int(round((top - bottom) / resolution))
+    return from_origin(left, top, resolution, resolution), height, width
+
+
+def tiles(height, width, tile_size=TILE_SIZE):
+    """Returns the (col_off, row_off, width, height) windows tiling a raster.
     """
+    return [
+        (col, row, min(tile_size, width - col), min(tile_size, height - row))
+        for row in range(0, height, tile_size)
+        for col in range(0, width, tile_size)
+    ]
 
-    # Define a script
-    script = f"""
-    echo "Start time = $(date)"
-    echo "Submitting directory = "$SLURM_SUBMIT_DIR
-    echo "working directory = "$PWD
-    echo "Project name = "$SLURM_JOB_ACCOUNT
-    echo "Job id = "$SLURM_JOB_ID
-    echo "Job name = "$SLURM_JOB_NAME
-    echo "memory per CPU = "$SLURM_MEM_PER_CPU
-    echo "Node running the job script = "$SLURMD_NODENAME
-    echo "Process ID of the process started for the task = "$SLURM_TASK_PID
-    echo "Dependency = "$SLURM_JOB_DEPENDENCY
-    echo "Number of nodes assigned to a job = "$SLURM_NNODES
-    echo "Number of tasks requested by the job = "$SLURM_NTASKS
-    echo "Number of cpus per task = "$SLURM_CPUS_PER_TASK
-
-    Rscript --vanilla {script_path}
-
-    echo "End of program at `date`"
+
+def _tile_counts(path, window, dst_transform, dst_shape, dst_crs):
+    """
+    Counts the CORINE classes of one tile per target cell.
+    Args:
+        path (str): The CORINE GeoTIFF.
+        window (tuple): The (col_off, row_off, width, height) tile.
+        dst_transform (Affine): The target grid transform.
+        dst_shape (tuple): The target grid (height, width).
+        dst_crs (str): The target CRS.
+    Returns:
+        tuple: (cells, counts), the flat target cell indices the tile covers
+            and their class counts as a (len(cells), N_CLASSES + 1) array,
+            column 0 unused.
     """
-    # Define the SLURM job
-    job = Job(
-        backend="slurm",
-        jobname="CLC",
-        root_dir=os.environ["ROOT_DIR"],
-        account=account,
-        time="00:30:00",
-        partition="standard",
-        mem="100G",
-        nodes=1,
-        ntasks=1,
-        output=f"{logs_dir}/%x-%A-%a.out",
-        error=f"{logs_dir}/%x-%A-%a.err",
-        modules=[
-            "LUMI/23.09",
-            "partition/L",
-            "GDAL",
-            "fontconfig",
-            "FriBidi",
-            "HarfBuzz",
-            "git",
-            "UDUNITS",
-            "libsodium",
-            "GSL",
-            "libarchive/3.6.2-cpeGNU-23.09",
-            "R",
-        ],
-        exports=["CRAYBLAS_WARN=0"],
-        script=script,
+    window = Window(*window)
+    with rasterio.open(path) as src:
+        codes = src.read(1, window=window)
+        win_transform = window_transform(window, src.transform)
+        same_crs = src.crs == CRS.from_user_input(dst_crs)
+        src_crs = src.crs
+    height, width = dst_shape
+    inverse = ~dst_transform
+
+    # Target cell of every pixel centre
+    cols = np.arange(codes.shape[1]) + 0.5
+    rows = np.arange(codes.shape[0]) + 0.5
+    if same_crs and win_transform.b == 0 and win_transform.d == 0:
+        # Axis-aligned grids in the same CRS: rows and columns map
+        # independently
+        x = win_transform.c + cols * win_transform.a
+        y = win_transform.f + rows * win_transform.e
+        dc = np.floor((x - dst_transform.c) / dst_transform.a).astype(np.int64)
+        dr = np.floor((y - dst_transform.f) / dst_transform.e).astype(np.int64)
+        dc, dr = np.broadcast_to(dc, codes.shape), np.broadcast_to(
+            dr[:, np.newaxis], codes.shape
+        )
+    else:
+        c, r = np.meshgrid(cols, rows)
+        x, y = win_transform * (c, r)
+        x, y = Transformer.from_crs(
+            src_crs, dst_crs, always_xy=True
+        ).transform(x, y)
+        dc, dr = inverse * (x, y)
+        dc = np.floor(dc).astype(np.int64)
+        dr = np.floor(dr).astype(np.int64)
+
+    valid = (
+        (codes >= 1)
+        & (codes <= N_CLASSES)
+        & (dc >= 0)
+        & (dc < width)
+        & (dr >= 0)
+        & (dr < height)
+    )
+    cell = dr[valid] * width + dc[valid]
+    if cell.size == 0:
+        return np.empty(0, np.int64), np.empty((0, N_CLASSES + 1), np.uint32)
+    # One bincount over (cell, class) pairs of the cells this tile touches
+    first = cell.min()
+    local = (cell - first) * (N_CLASSES + 1) + codes[valid]
+    counts = np.bincount(
+        local, minlength=(cell.max() - first + 1) * (N_CLASSES + 1)
     )
-    # Submit the job to SLURM
-    job.submit()
+    counts = counts.reshape(-1, N_CLASSES + 1)
+    touched = np.flatnonzero(counts.any(axis=1))
+    return touched + first, counts[touched].astype(np.uint32)
+
 
-    print("Corine processing job submitted successfully!")
+def aggregate(
+    input_path,
+    output_dir,
+    crs=TARGET_CRS,
+    resolution=RESOLUTION,
+    tile_size=TILE_SIZE,
+    max_workers=None,
+):
+    """
+    Aggregates a CORINE Land Cover GeoTIFF to per-class fractions and the
+    majority class on a coarse grid.
+    The raster is read in tiles spread across a process pool, and each tile is
+    reduced to class counts per target cell with a single bincount, so memory
+    scales with the tile size and the target grid, not with the raster.
+    Args:
+        input_path (str): The CORINE GeoTIFF, e.g. the 100 m raster for Europe.
+        output_dir (str): The directory the aggregated GeoTIFFs are written to.
+        crs (str): The target CRS.
+        resolution (float): The target cell size in CRS units, 10 km by
+            default.
+        tile_size (int): The tile edge in source pixels.
+        max_workers (int): The number of processes, defaults to the CPU count.
+    Returns:
+        dict: The paths of the "fractions" GeoTIFF, one band per class in
+            percent, and of the "majority" GeoTIFF.
+    """
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    os.makedirs(output_dir, exist_ok=True)
+    with stage("corine.aggregate") as metrics:
+        with rasterio.open(input_path) as src:
+            dst_transform, height, width = target_grid(src, crs, resolution)
+            windows = tiles(src.height, src.width, tile_size)
+        counts = np.zeros((height * width, N_CLASSES + 1), np.uint32)
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(
+                    _tile_counts,
+                    input_path,
+                    window,
+                    dst_transform,
+                    (height, width),
+                    crs,
+                )
+                for window in windows
+            ]
+            for future in as_completed(futures):
+                cells, tile_counts = future.result()
+                # Tiles may share border cells, so counts are added rather than
+                # assigned
+                counts[cells] += tile_counts
+
+        totals = counts.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fractions = (100 * counts[:, 1:] / totals[:, np.newaxis]).astype(
+                np.float32
+            )
+        majority = np.where(
+            totals > 0, counts[:, 1:].argmax(axis=1) + 1, MAJORITY_NODATA
+        ).astype(np.uint8)
+
+        profile = {
+            "driver": "GTiff",
+            "height": height,
+            "width": width,
+            "crs": crs,
+            "transform": dst_transform,
+            "tiled": True,
+            "blockxsize": 256,
+            "blockysize": 256,
+            "compress": "deflate",
+        }
+        outputs = {
+            "fractions": os.path.join(
+                output_dir, f"{name}_fractions_{int(resolution / 1000)}km.tif"
+            ),
+            "majority": os.path.join(
+                output_dir, f"{name}_majority_{int(resolution / 1000)}km.tif"
+            ),
+        }
+        with rasterio.open(
+            outputs["fractions"],
+            "w",
+            count=N_CLASSES,
+            dtype="float32",
+            nodata=np.nan,
+            predictor=3,
+            **profile,
+        ) as dst:
+            for code in range(1, N_CLASSES + 1):
+                dst.write(fractions[:, code - 1].reshape(height, width), code)
+                dst.set_band_description(code, f"class_{code}")
+        with rasterio.open(
+            outputs["majority"],
+            "w",
+            count=1,
+            dtype="uint8",
+            nodata=MAJORITY_NODATA,
+            **profile,
+        ) as dst:
+            dst.write(majority.reshape(height, width), 1)
+
+        metrics.update(
+            files=len(outputs),
+            tiles=len(windows),
+            bytes_written=sum(tree_bytes(path) for path in outputs.values()),
+        )
+    print(
+        f"Aggregated {input_path} to {height} x {width} cells of {resolution} "
+        f"m in {len(windows)} tiles"
+    )
+    return outputs
 
-    # Submit the job to SLURM
-    ar = job.submit()
 
-    print("Corine processing job submitted successfully!")
+def aggregate_code(input_path, output_dir):
+    """Returns the Python code a job runs to aggregate a CORINE GeoTIFF."""
+    return (
+        "from service.corine import aggregate; "
+        f"aggregate({input_path!r}, {output_dir!r}, "
+        f"max_workers={RESOURCES['cpus_per_task']})"
+    )
 
-    ar.wait()  # Wait for the job to complete
 
-    job_state = ar.sucessful()
+def job_aggregate(
+    input_path, output_dir, logs_dir, wait=False, dependency=None
+):
+    """
+    Submit a SLURM job aggregating a CORINE GeoTIFF to the 10 km grid on a
+    small allocation.
+    Args:
+        input_path (str): The CORINE GeoTIFF.
+        output_dir (str): The directory for the aggregated GeoTIFFs.
+        logs_dir (str): Path to the directory to store job logs.
+        wait (bool): Wait for the job to finish instead of returning its
+            future.
+        dependency (str): An sbatch --dependency expression.
+    Returns:
+        SlurmFuture: The job future, or whether the job completed when wait
+            is True.
+    """
+    input_path = os.path.abspath(input_path)
+    code = aggregate_code(input_path, os.path.abspath(output_dir))
+    body = PYTHON_PREAMBLE + f"cd workflows && python3 -c {shlex.quote(code)}"
+    input_size = (
+        os.path.getsize(input_path) if os.path.exists(input_path) else None
+    )
+    future = submit(
+        RESOURCES,
+        body,
+        logs_dir,
+        dependency=dependency,
+        input_size=input_size,
+    )
 
-    # Check the state of the job and return the appropriate message
-    if job_state == False:
-        print("Corine processing job failed!")
-        return False
+    print("Corine aggregation job submitted successfully!")
 
-    if job_state == True:
-        print("Corine processing job done!")
-        return True
+    if not wait:
+        return future
+    return finish(future, "Corine aggregation job")
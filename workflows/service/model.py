@@ -0,0 +1,118 @@
+from service.slurm import submit, submit_rscript, finish
+
+# Directory where state/modelFitting.R prepares one sub-directory per habitat
+# model
+MODEL_DIR = "datasets/processed/model_fitting"
+
+# SLURM resources for preparing the model inputs and the fitting commands
+PREP_RESOURCES = {
+    "jobname": "Model_prep",
+    "time": "04:00:00",
+    "mem": "200G",
+    "nodes": 1,
+    "ntasks": 1,
+}
+
+# The fitting job only submits the prepared fit jobs, which run on their own
+# allocations
+FIT_RESOURCES = {
+    "jobname": "Model_fit",
+    "time": "00:15:00",
+    "mem": "1G",
+    "nodes": 1,
+    "ntasks": 1,
+}
+
+# One Hmsc chain per GPU, as prepared by Mod_Prep4HPC in state/modelFitting.R
+CHAIN_RESOURCES = {
+    "jobname": "Hmsc_chain",
+    "partition": "small-g",
+    "time": "3-00:00:00",
+    "mem_per_cpu": "200G",
+    "ntasks": 1,
+    "gpus_per_node": 1,
+}
+
+# Merging the chains of the fitted models of one model directory
+MERGE_RESOURCES = {
+    "jobname": "Hmsc_merge",
+    "time": "02:00:00",
+    "mem": "100G",
+    "nodes": 1,
+    "ntasks": 1,
+    "cpus_per_task": 4,
+}
+
+
+def fit_body(model_dir=MODEL_DIR):
+    """
+    Shell commands that submit every prepared Bash_Fit SLURM file without
+    waiting for them.
+    The fit jobs are queued on their own allocations, so the submitting job
+    ends at once instead of holding an allocation for as long as the fits run.
+    Args:
+        model_dir (str): The directory passed to Mod_Prep4HPC as Path_Model.
+    Returns:
+        str: The commands, exiting non-zero if there is nothing to submit or a
+            submission failed.
+    """
+    return f"""status=0
+for f in {model_dir}/*/Bash_Fit*.slurm; do
+    if [ ! -e "$f" ]; then
+        echo "No Bash_Fit files in {model_dir}"
+        exit 1
+    fi
+    job_id=$(sbatch --parsable "$f") || status=1
+    echo "$f submitted as job $job_id"
+done
+test $status -eq 0"""
+
+
+def job_prep(script_path, logs_dir, wait=False, dependency=None):
+    """
+    Submit a SLURM job preparing the Hmsc models for fitting.
+    Args:
+        script_path (str): Path to the R script to run, usually
+            state/modelFitting.R.
+        logs_dir (str): Path to the directory to store job logs.
+        wait (bool): Wait for the job to finish instead of returning its
+            future.
+        dependency (str): An sbatch --dependency expression.
+    Returns:
+        SlurmFuture: The job future, or whether the job completed when wait
+            is True.
+    """
+    future = submit_rscript(
+        script_path, logs_dir, PREP_RESOURCES, dependency=dependency
+    )
+
+    print("Model preparation job submitted successfully!")
+
+    if not wait:
+        return future
+    return finish(future, "Model preparation job")
+
+
+def job_fit(logs_dir, model_dir=MODEL_DIR, wait=False, dependency=None):
+    """
+    Submit a SLURM job queueing the fits of the prepared Hmsc models, see
+    fit_body().
+    Args:
+        logs_dir (str): Path to the directory to store job logs.
+        model_dir (str): The directory with the prepared models.
+        wait (bool): Wait until the fits are queued instead of returning the
+            job future.
+        dependency (str): An sbatch --dependency expression.
+    Returns:
+        SlurmFuture: The job future, or whether every fit was queued when
+            wait is True.
+    """
+    future = submit(
+        FIT_RESOURCES, fit_body(model_dir), logs_dir, dependency=dependency
+    )
+
+    print("Model fitting job submitted successfully!")
+
+    if not wait:
+        return future
+    return finish(future, "Model fitting job")
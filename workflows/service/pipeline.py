@@ -0,0 +1,256 @@
+"""SLURM dependency graph of the whole workflow.
+
+Every stage is a node with its resources, its commands and the stages it
+runs after. The graph is submitted in a single pass: each job is queued at
+once with --dependency=afterok on its parents, so SLURM starts it as soon
+as they complete and independent sources wait in the queue concurrently.
+"""
+
+import os
+import shlex
+
+from service import (
+    EASIN,
+    GBIF,
+    IAS,
+    chelsa,
+    corine,
+    eLTER,
+    model,
+    railways,
+    roads,
+    samplingEfforts,
+)
+from service.slurm import R_EXPORTS, R_MODULES, root_dir, submit
+
+# Paths are relative to the repository root, the working directory of every job
+CHELSA_LIST = "references/chelsa/test.txt"
+CHELSA_RAW = "datasets/raw/chelsa/"
+CORINE_RASTER = "datasets/raw/corine/U2018_CLC2018_V2020_20u1.tif"
+CORINE_PROCESSED = "datasets/processed/corine/"
+
+
+def rscript_node(script_path, resources, after=()):
+    """Returns a node running an R script with the LUMI R environment."""
+    return {
+        "resources": resources,
+        "body": f"Rscript --vanilla {script_path}",
+        "modules": R_MODULES,
+        "exports": R_EXPORTS,
+        "after": list(after),
+    }
+
+
+def python_node(code, resources, after=()):
+    """Returns a node running Python code from the workflows directory."""
+    return {
+        "resources": resources,
+        "body": chelsa.PYTHON_PREAMBLE
+        + f"cd workflows && python3 -c {shlex.quote(code)}",
+        "after": list(after),
+    }
+
+
+def build_graph(chelsa_list=CHELSA_LIST, chelsa_raw=CHELSA_RAW):
+    """
+    Builds the workflow graph from sensing to model fitting.
+    Args:
+        chelsa_list (str): The CHELSA download list.
+        chelsa_raw (str): The directory for the raw CHELSA files.
+    Returns:
+        dict: {name: node}, where a node has "resources", "body", optional
+            "modules" and "exports", and "after", the names of its parents.
+    """
+    sources = {
+        "GBIF": rscript_node("workflows/process/GBIF.R", GBIF.RESOURCES),
+        "EASIN": rscript_node("workflows/process/EASIN.R", EASIN.RESOURCES),
+        "eLTER": rscript_node("workflows/process/eLTER.R", eLTER.RESOURCES),
+        # The tiled aggregation replaces corine.R and its 100G node
+        "corine": python_node(
+            corine.aggregate_code(
+                f"../{CORINE_RASTER}", f"../{CORINE_PROCESSED}"
+            ),
+            corine.RESOURCES,
+        ),
+        "railways": rscript_node(
+            "workflows/process/railways.R", railways.RESOURCES
+        ),
+        "roads": rscript_node("workflows/process/roads.R", roads.RESOURCES),
+        "samplingEfforts": rscript_node(
+            "workflows/process/samplingEfforts.R", samplingEfforts.RESOURCES
+        ),
+    }
+    graph = {
+        "chelsa_vSensor": python_node(
+            "from feedbackloop.chelsa import vSensor; "
+            f"vSensor('../{chelsa_list}', '../logs/feedback/chelsa/', "
+            "'../logs/diff/chelsa/')",
+            chelsa.VSENSOR_RESOURCES,
+        ),
+        "chelsa_intaker": python_node(
+            "from feedbackloop.chelsa import intaker; "
+            f"intaker('../{chelsa_list}', '../{chelsa_raw}', "
+            "snapshot='../logs/feedback/chelsa/')",
+            chelsa.INTAKER_RESOURCES,
+            after=["chelsa_vSensor"],
+        ),
+        "chelsa": rscript_node(
+            "workflows/process/chelsa.R",
+            chelsa.PROCESSOR_RESOURCES,
+            after=["chelsa_intaker"],
+        ),
+        **sources,
+        # IAS merges the species occurrences of the GBIF, EASIN and eLTER
+        # outputs
+        "IAS": rscript_node(
+            "workflows/process/IAS.R",
+            IAS.RESOURCES,
+            after=["GBIF", "EASIN", "eLTER"],
+        ),
+    }
+    predictors = [
+        "IAS",
+        "chelsa",
+        "corine",
+        "railways",
+        "roads",
+        "samplingEfforts",
+    ]
+    graph["model_prep"] = rscript_node(
+        "workflows/state/modelFitting.R",
+        model.PREP_RESOURCES,
+        after=predictors,
+    )
+    graph["model_fit"] = {
+        "resources": model.FIT_RESOURCES,
+        "body": model.fit_body(),
+        "after": ["model_prep"],
+    }
+    return graph
+
+
+def topological_order(graph):
+    """
+    Orders the nodes so every node comes after its parents.
+    Args:
+        graph (dict): {name: node}.
+    Returns:
+        list: The node names, in submission order.
+    Raises:
+        ValueError: If a node depends on an unknown node or the graph has a
+            cycle.
+    """
+    for name, node in graph.items():
+        unknown = [parent for parent in node["after"] if parent not in graph]
+        if unknown:
+            raise ValueError(
+                f"{name} depends on unknown nodes: {', '.join(unknown)}"
+            )
+
+    remaining = {name: set(node["after"]) for name, node in graph.items()}
+    order = []
+    while remaining:
+        # Keep the declaration order among nodes that are ready
+        ready = [name for name, parents in remaining.items() if not parents]
+        if not ready:
+            raise ValueError(
+                f"Dependency cycle between: {', '.join(remaining)}"
+            )
+        for name in ready:
+            order.append(name)
+            del remaining[name]
+        for parents in remaining.values():
+            parents.difference_update(ready)
+    return order
+
+
+def format_graph(graph):
+    """Renders the graph as text, one node per line in submission order."""
+    lines = []
+    for name in topological_order(graph):
+        node = graph[name]
+        resources = node["resources"]
+        after = (
+            f" afterok: {', '.join(node['after'])}" if node["after"] else ""
+        )
+        lines.append(
+            f"{name} [{resources['jobname']}, {resources.get('time')}, "
+            f"{resources.get('mem')}]{after}"
+        )
+    return "\n".join(lines)
+
+
+def submit_graph(graph, logs_dir, dry_run=False):
+    """
+    Submits every node of the graph in one pass, chained with afterok
+    dependencies.
+    Args:
+        graph (dict): {name: node}, see build_graph().
+        logs_dir (str): Path to the directory to store batch scripts and job
+            logs.
+        dry_run (bool): Only print the graph, without submitting anything.
+    Returns:
+        dict: {name: SlurmFuture}, empty on a dry run.
+    """
+    order = topological_order(graph)
+    print(format_graph(graph))
+    if dry_run:
+        return {}
+
+    futures = {}
+    for name in order:
+        node = graph[name]
+        resources = dict(node["resources"])
+        dependency = None
+        if node["after"]:
+            dependency = "afterok:" + ":".join(
+                futures[parent].job_id for parent in node["after"]
+            )
+            # Cancel the job instead of leaving it pending when a parent fails
+            resources["kill_on_invalid_dep"] = "yes"
+        futures[name] = submit(
+            resources,
+            node["body"],
+            logs_dir,
+            modules=node.get("modules"),
+            exports=node.get("exports"),
+            dependency=dependency,
+        )
+        print(f"{name} submitted as job {futures[name].job_id}")
+    return futures
+
+
+def check_root():
+    """
+    Checks that ROOT_DIR is the repository root the node paths are relative to.
+    Returns:
+        str: The repository root.
+    Raises:
+        RuntimeError: If ROOT_DIR is not set or has no workflows directory.
+    """
+    root = root_dir()
+    if not os.path.isdir(os.path.join(root, "workflows")):
+        raise RuntimeError(
+            f"ROOT_DIR={root!r} is not the repository root, it has no "
+            "workflows directory"
+        )
+    return root
+
+
+def run_pipeline(logs_dir="../logs", dry_run=False, graph=None):
+    """
+    Queues the whole workflow on SLURM and returns without waiting for it.
+    Args:
+        logs_dir (str): Path to the directory to store batch scripts and job
+            logs.
+        dry_run (bool): Only print the graph, without submitting anything.
+        graph (dict): The graph to submit, defaults to build_graph().
+    Returns:
+        dict: {name: SlurmFuture} of the queued jobs, empty on a dry run.
+            Wait for them with service.slurm.wait_all().
+    """
+    if not dry_run:
+        check_root()
+    return submit_graph(
+        build_graph() if graph is None else graph, logs_dir, dry_run=dry_run
+    )
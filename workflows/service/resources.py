@@ -0,0 +1,334 @@
+"""Resource advisor for SLURM jobs.
+
+Every finished job is looked up in sacct and its peak memory, elapsed time
+and CPU efficiency are appended to a JSON lines history, keyed by job name
+and input size. The next submission of the same job can then request a
+high percentile of what it actually used, plus some headroom.
+"""
+
+import datetime
+import json
+import math
+import os
+import subprocess
+
+HISTORY_PATH = os.environ.get("SLURM_HISTORY", "../logs/slurm/history.jsonl")
+
+# "off" ignores the history, "suggest" prints advice, "apply" changes the
+# request
+MODE = os.environ.get("SLURM_RIGHT_SIZE", "suggest")
+PERCENTILE = 95
+HEADROOM = 1.25
+MIN_RUNS = 3
+MIN_MEM_MB = 1024
+MIN_TIME_S = 10 * 60
+
+# Failed because the request was too small: the next request of that dimension
+# must be larger
+MEM_EXCEEDED = "OUT_OF_MEMORY"
+TIME_EXCEEDED = "TIMEOUT"
+
+UNITS = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024 * 1024}
+
+
+def parse_mem(value, cpus=1):
+    """
+    Parses a sacct/sbatch memory value such as 123456K, 4000M, 200G, 200Gn or
+    4000Mc to MB.
+    Args:
+        value (str): The memory value; a "c" suffix is per CPU and an "n"
+            suffix per node.
+        cpus (int): The number of CPUs a per-CPU value is multiplied by.
+    Returns:
+        float: The memory in MB, or None for an empty value.
+    """
+    value = value.strip()
+    if value.endswith("c"):
+        per_cpu = parse_mem(value[:-1])
+        return None if per_cpu is None else per_cpu * max(1, cpus)
+    value = value.rstrip("n")
+    if not value:
+        return None
+    if value[-1].upper() in UNITS:
+        return float(value[:-1]) * UNITS[value[-1].upper()]
+    # Plain numbers are bytes in sacct and MB in sbatch; only sacct prints them
+    return float(value) / 1024**2
+
+
+def parse_duration(value):
+    """Parses [D-]HH:MM:SS, MM:SS.mmm or MM to seconds."""
+    value = value.strip()
+    if not value or value in ("UNLIMITED", "INVALID"):
+        return None
+    days = 0
+    if "-" in value:
+        days, value = value.split("-", 1)
+    parts = [float(p) for p in value.split(":")]
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + part
+    if len(parts) == 1:
+        # sbatch reads a bare number as minutes
+        seconds *= 60
+    return int(days) * 86400 + seconds
+
+
+def format_mem(mb):
+    """Formats MB as an sbatch memory value, in whole GB above 1G."""
+    return f"{math.ceil(mb / 1024)}G" if mb >= 1024 else f"{math.ceil(mb)}M"
+
+
+def format_duration(seconds):
+    """Formats seconds as an sbatch [D-]HH:MM:SS time limit, rounded up to
+    minutes.
+    """
+    minutes = math.ceil(seconds / 60)
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    time = f"{hours:02d}:{minutes:02d}:00"
+    return f"{days}-{time}" if days else time
+
+
+def usage(job_id):
+    """
+    Reads the accounting of a finished job, one record per job or array task.
+    Args:
+        job_id (str): The SLURM job id.
+    Returns:
+        list: Dicts with job_id, state, elapsed_s, queue_wait_s, max_rss_mb,
+            req_mem_mb, cpus and cpu_efficiency.
+    """
+    result = subprocess.run(
+        [
+            "sacct",
+            "-n",
+            "-P",
+            "-j",
+            job_id,
+            "-o",
+            "JobID,State,Elapsed,TotalCPU,AllocCPUS,MaxRSS,ReqMem,"
+            "Submit,Start",
+        ],
+        capture_output=True,
+        text=True,
+    )
+    records = {}
+    for line in result.stdout.splitlines():
+        fields = line.split("|")
+        if len(fields) != 9:
+            continue
+        (
+            step_id,
+            state,
+            elapsed,
+            total_cpu,
+            cpus,
+            max_rss,
+            req_mem,
+            submitted,
+            started,
+        ) = fields
+        # Steps such as 123.batch or 123_4.0 report the memory of their task
+        task_id = step_id.split(".")[0]
+        record = records.setdefault(
+            task_id, {"job_id": task_id, "max_rss_mb": 0.0}
+        )
+        if "." not in step_id:
+            record["state"] = state.split()[0] if state else ""
+            record["elapsed_s"] = parse_duration(elapsed)
+            record["cpu_s"] = parse_duration(total_cpu)
+            record["cpus"] = int(cpus or 0)
+            record["req_mem_mb"] = (
+                parse_mem(req_mem, record["cpus"]) if req_mem else None
+            )
+            record["queue_wait_s"] = _wait(submitted, started)
+        if max_rss:
+            record["max_rss_mb"] = max(
+                record["max_rss_mb"], parse_mem(max_rss)
+            )
+    for record in records.values():
+        elapsed, cpu, cpus = (
+            record.get("elapsed_s"),
+            record.pop("cpu_s", None),
+            record.get("cpus"),
+        )
+        record["cpu_efficiency"] = (
+            cpu / (elapsed * cpus)
+            if elapsed and cpu is not None and cpus
+            else None
+        )
+    return [record for record in records.values() if "state" in record]
+
+
+def _wait(submitted, started):
+    """Returns the seconds between two sacct timestamps, or None if the job
+    never started.
+    """
+    try:
+        start = datetime.datetime.fromisoformat(started)
+        return (
+            start - datetime.datetime.fromisoformat(submitted)
+        ).total_seconds()
+    except ValueError:
+        return None
+
+
+def record(future, history_path=HISTORY_PATH):
+    """
+    Appends the accounting of a finished job to the history.
+    Args:
+        future (SlurmFuture): The finished job, with its resources and
+            input_size.
+        history_path (str): The JSON lines history file.
+    Returns:
+        list: The records written.
+    """
+    records = usage(future.job_id)
+    resources = getattr(future, "resources", None) or {}
+    os.makedirs(os.path.dirname(history_path) or ".", exist_ok=True)
+    with open(history_path, "a") as f:
+        for entry in records:
+            entry.update(
+                name=future.name,
+                input_size=getattr(future, "input_size", None),
+                req_time_s=(
+                    parse_duration(str(resources["time"]))
+                    if resources.get("time")
+                    else None
+                ),
+            )
+            f.write(json.dumps(entry) + "\n")
+    return records
+
+
+def load_history(name, history_path=HISTORY_PATH):
+    """Returns the history records of the jobs called name, oldest first."""
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return [entry for entry in entries if entry.get("name") == name]
+
+
+def percentile(values, q):
+    """Returns the q-th percentile of values with linear interpolation."""
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    low = math.floor(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def _samples(entries, used, requested, exceeded):
+    """
+    Usage samples of one dimension of the request, memory or time.
+    Completed jobs give what they used and jobs that ran out of this dimension
+    (the exceeded state) twice what they requested. Other failures are left
+    out, as they stopped before reaching their peak.
+    """
+    samples = []
+    for entry in entries:
+        if entry["state"] == "COMPLETED" and entry.get(used):
+            samples.append((entry[used], entry.get("input_size")))
+        elif entry["state"] == exceeded and entry.get(requested):
+            samples.append((2 * entry[requested], entry.get("input_size")))
+    return samples
+
+
+def _estimate(samples, input_size, q, headroom):
+    """Estimates a request from samples, scaled by input size when every sample
+    has one.
+    """
+    if input_size and all(size for _, size in samples):
+        return (
+            percentile([value / size for value, size in samples], q)
+            * input_size
+            * headroom
+        )
+    return percentile([value for value, _ in samples], q) * headroom
+
+
+def suggest(
+    name,
+    input_size=None,
+    history_path=HISTORY_PATH,
+    q=PERCENTILE,
+    headroom=HEADROOM,
+    min_runs=MIN_RUNS,
+):
+    """
+    Suggests memory, time and CPU requests for a job from its history.
+    Args:
+        name (str): The job name.
+        input_size (float): The size of the input of the next run, in the unit
+            recorded.
+        history_path (str): The JSON lines history file.
+        q (float): The percentile of the past usage to cover.
+        headroom (float): The factor applied on top of the percentile.
+        min_runs (int): The number of past runs needed before suggesting
+            anything.
+    Returns:
+        dict: sbatch options ("mem", "time" and, for multi-CPU jobs,
+            "cpus_per_task"), empty when the history is too short.
+    """
+    entries = load_history(name, history_path)
+    suggestion = {}
+    memory = _samples(entries, "max_rss_mb", "req_mem_mb", MEM_EXCEEDED)
+    if len(memory) >= min_runs:
+        suggestion["mem"] = format_mem(
+            max(_estimate(memory, input_size, q, headroom), MIN_MEM_MB)
+        )
+    elapsed = _samples(entries, "elapsed_s", "req_time_s", TIME_EXCEEDED)
+    if len(elapsed) >= min_runs:
+        suggestion["time"] = format_duration(
+            max(_estimate(elapsed, input_size, q, headroom), MIN_TIME_S)
+        )
+    used_cpus = [
+        entry["cpu_efficiency"] * entry["cpus"]
+        for entry in entries
+        if entry["state"] == "COMPLETED"
+        and entry.get("cpu_efficiency")
+        and entry["cpus"] > 1
+    ]
+    if len(used_cpus) >= min_runs:
+        suggestion["cpus_per_task"] = max(
+            1, math.ceil(percentile(used_cpus, q) * headroom)
+        )
+    return suggestion
+
+
+def right_size(
+    resources, input_size=None, mode=None, history_path=HISTORY_PATH
+):
+    """
+    Adjusts a resource spec from the job's history.
+    Args:
+        resources (dict): sbatch options with at least "jobname".
+        input_size (float): The size of the input of this run.
+        mode (str): "off", "suggest" or "apply", defaults to SLURM_RIGHT_SIZE.
+        history_path (str): The JSON lines history file.
+    Returns:
+        dict: The resources to submit with; unchanged unless mode is "apply".
+    """
+    mode = mode or MODE
+    if mode == "off":
+        return resources
+    suggestion = suggest(resources["jobname"], input_size, history_path)
+    if "cpus_per_task" not in resources:
+        suggestion.pop("cpus_per_task", None)
+    if "mem_per_cpu" in resources:
+        # sbatch rejects --mem together with --mem-per-cpu
+        suggestion.pop("mem", None)
+    changes = {
+        k: v for k, v in suggestion.items() if str(resources.get(k)) != str(v)
+    }
+    if not changes:
+        return resources
+    described = ", ".join(
+        f"{k}={resources.get(k)} -> {v}" for k, v in changes.items()
+    )
+    if mode == "apply":
+        print(f"Right-sizing {resources['jobname']}: {described}")
+        return {**resources, **changes}
+    print(f"Suggested resources for {resources['jobname']}: {described}")
+    return resources
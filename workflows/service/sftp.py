@@ -1,13 +1,592 @@
-from simple_sftp.client import Client
+import hashlib
 import os
+import posixpath
+import queue
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 
-# Read the relavant environment variables in the .env file
-ip = os.environ["FTP_SERVER_IP"]
-user = os.environ["FTP_LOGIN_USER"]
-password = os.environ["FTP_LOGIN_PASSWORD"]
-PORT = os.environ["FTP_CONNECT_PORT"]  # not required. default 22
+import paramiko
 
-c = Client(ip, user, password)
+CHUNK_SIZE = 1024 * 1024
+PART_SUFFIX = ".part"
+# Sidecar of a .part file with the size and mtime of the source it holds
+VALIDATOR_SUFFIX = ".validator"
+# Concurrent SFTP connections per pool
+POOL_SIZE = 4
+
+
+def _config():
+    """
+    Reads the SFTP server settings from the environment (the .env file).
+    Returns:
+        dict: host, user, password, port and known_hosts, the optional
+            FTP_KNOWN_HOSTS file.
+    """
+    missing = [
+        name
+        for name in ("FTP_SERVER_IP", "FTP_LOGIN_USER", "FTP_LOGIN_PASSWORD")
+        if name not in os.environ
+    ]
+    if missing:
+        raise RuntimeError(
+            f"Missing SFTP settings in the environment: {', '.join(missing)}"
+        )
+    return {
+        "host": os.environ["FTP_SERVER_IP"],
+        "user": os.environ["FTP_LOGIN_USER"],
+        "password": os.environ["FTP_LOGIN_PASSWORD"],
+        "port": int(os.environ.get("FTP_CONNECT_PORT") or 22),
+        "known_hosts": os.environ.get("FTP_KNOWN_HOSTS") or None,
+    }
+
+
+class SFTPPool:
+    """
+    A pool of SFTP connections to one server, opened on first use.
+    Every connection has its own SSH transport, so concurrent transfers do not
+    share one encrypted channel. Connections that fail are dropped and
+    reopened. The server must be listed in the system known_hosts or in
+    known_hosts; unknown host keys are rejected.
+    Args:
+        host (str): The server address.
+        user (str): The login user.
+        password (str): The login password, None to use keys.
+        port (int): The SSH port.
+        size (int): The maximum number of open connections.
+        key_filename (str): A private key file.
+        known_hosts (str): A known_hosts file with the server's host key, on
+            top of the system ones.
+    """
+
+    def __init__(
+        self,
+        host,
+        user,
+        password=None,
+        port=22,
+        size=POOL_SIZE,
+        key_filename=None,
+        known_hosts=None,
+    ):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = port
+        self.size = size
+        self.key_filename = key_filename
+        self.known_hosts = known_hosts
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._open = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, size=POOL_SIZE):
+        """Creates a pool from the FTP_* environment variables."""
+        return cls(size=size, **_config())
+
+    def _connect(self):
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        if self.known_hosts:
+            client.load_host_keys(self.known_hosts)
+        client.set_missing_host_key_policy(paramiko.RejectPolicy())
+        client.connect(
+            self.host,
+            port=self.port,
+            username=self.user,
+            password=self.password,
+            key_filename=self.key_filename,
+            allow_agent=False,
+            look_for_keys=self.password is None,
+        )
+        sftp = client.open_sftp()
+        with self._lock:
+            self._open.append(client)
+        return client, sftp
+
+    def _discard(self, conn):
+        client, sftp = conn
+        with self._lock:
+            if client in self._open:
+                self._open.remove(client)
+        try:
+            sftp.close()
+            client.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """Lends an SFTPClient, waiting while all connections are in use."""
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn[1]
+            finally:
+                transport = conn[0].get_transport()
+                if transport is not None and transport.is_active():
+                    self._idle.put(conn)
+                else:
+                    # A broken connection is dropped, the next user opens a new
+                    # one
+                    self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Closes all connections."""
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        with self._lock:
+            clients, self._open = self._open, []
+        for client in clients:
+            client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _sha256_local(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _sha256_remote(sftp, path):
+    h = hashlib.sha256()
+    with sftp.open(path, "rb") as f:
+        f.prefetch()
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _remote_stat(sftp, path):
+    try:
+        return sftp.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _matches(local_path, local_st, remote_attr, sftp, remote_path, checksum):
+    """Tells whether the remote and local files hold the same data, by size and
+    mtime or by checksum.
+    """
+    if remote_attr is None or remote_attr.st_size != local_st.st_size:
+        return False
+    if checksum:
+        return _sha256_local(local_path) == _sha256_remote(sftp, remote_path)
+    return int(remote_attr.st_mtime) == int(local_st.st_mtime)
+
+
+def _validator(st):
+    """Returns the size and mtime of a source file as a .part validator."""
+    return f"{st.st_size} {int(st.st_mtime)}"
+
+
+def _is_partial(name):
+    """Tells whether a file name is a .part file or its validator."""
+    return name.endswith((PART_SUFFIX, PART_SUFFIX + VALIDATOR_SUFFIX))
+
+
+def _makedirs(sftp, path):
+    """Creates a remote directory and its parents."""
+    missing = []
+    while path not in ("", "/") and _remote_stat(sftp, path) is None:
+        missing.append(path)
+        path = posixpath.dirname(path)
+    for directory in reversed(missing):
+        try:
+            sftp.mkdir(directory)
+        except OSError:
+            # Created by a concurrent transfer
+            if _remote_stat(sftp, directory) is None:
+                raise
+
+
+def _rename(sftp, source, destination):
+    try:
+        sftp.posix_rename(source, destination)
+    except (IOError, paramiko.SSHException):
+        # Servers without the posix-rename extension do not overwrite
+        if _remote_stat(sftp, destination) is not None:
+            sftp.remove(destination)
+        sftp.rename(source, destination)
+
+
+def _upload_once(sftp, local_path, remote_path, verify=False):
+    """Uploads into <remote_path>.part, resuming from its size, and renames it
+    into place.
+
+    The .part file is only resumed if its validator records the size and
+    mtime the local file still has. With verify, a resumed upload is also
+    compared by SHA-256 before the rename; on a mismatch the .part file is
+    removed so the next attempt starts over.
+    """
+    part_path = remote_path + PART_SUFFIX
+    validator_path = part_path + VALIDATOR_SUFFIX
+    st = os.stat(local_path)
+    size = st.st_size
+    part = _remote_stat(sftp, part_path)
+    offset = part.st_size if part is not None and part.st_size <= size else 0
+    if offset:
+        try:
+            with sftp.open(validator_path, "r") as f:
+                recorded = f.read().decode().strip()
+        except FileNotFoundError:
+            recorded = None
+        if recorded != _validator(st):
+            # The local file changed since the .part file was started
+            offset = 0
+    if not offset:
+        with sftp.open(validator_path, "w") as f:
+            f.write(_validator(st))
+    written = 0
+    with open(local_path, "rb") as src, sftp.open(
+        part_path, "r+b" if offset else "wb"
+    ) as dst:
+        dst.set_pipelined(True)
+        src.seek(offset)
+        dst.seek(offset)
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            dst.write(chunk)
+            written += len(chunk)
+    if sftp.stat(part_path).st_size != size:
+        raise IOError(
+            f"{part_path} has {sftp.stat(part_path).st_size} of {size} bytes"
+        )
+    if (
+        verify
+        and offset
+        and _sha256_local(local_path) != _sha256_remote(sftp, part_path)
+    ):
+        sftp.remove(part_path)
+        raise IOError(
+            f"{part_path} does not match {local_path} after resuming"
+        )
+    _rename(sftp, part_path, remote_path)
+    sftp.remove(validator_path)
+    sftp.utime(remote_path, (st.st_atime, st.st_mtime))
+    return written
+
+
+def _download_once(sftp, remote_path, local_path, remote_attr, verify=False):
+    """Downloads into <local_path>.part, resuming from its size, and renames it
+    into place.
+
+    The .part file is only resumed if its validator records the size and
+    mtime the remote file still has. With verify, a resumed download is also
+    compared by SHA-256 before the rename; on a mismatch the .part file is
+    removed so the next attempt starts over.
+    """
+    part_path = local_path + PART_SUFFIX
+    validator_path = part_path + VALIDATOR_SUFFIX
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset > remote_attr.st_size:
+        offset = 0
+    if offset:
+        recorded = None
+        if os.path.exists(validator_path):
+            with open(validator_path) as f:
+                recorded = f.read().strip()
+        if recorded != _validator(remote_attr):
+            # The remote file changed since the .part file was started
+            offset = 0
+    if not offset:
+        with open(validator_path, "w") as f:
+            f.write(_validator(remote_attr))
+    written = 0
+    with sftp.open(remote_path, "rb") as src, open(
+        part_path, "ab" if offset else "wb"
+    ) as dst:
+        src.seek(offset)
+        src.prefetch(remote_attr.st_size - offset)
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            dst.write(chunk)
+            written += len(chunk)
+    if os.path.getsize(part_path) != remote_attr.st_size:
+        raise IOError(
+            f"{part_path} has {os.path.getsize(part_path)} of "
+            f"{remote_attr.st_size} bytes"
+        )
+    if (
+        verify
+        and offset
+        and _sha256_local(part_path) != _sha256_remote(sftp, remote_path)
+    ):
+        os.remove(part_path)
+        raise IOError(
+            f"{part_path} does not match {remote_path} after resuming"
+        )
+    os.replace(part_path, local_path)
+    os.remove(validator_path)
+    os.utime(local_path, (remote_attr.st_atime, remote_attr.st_mtime))
+    return written
+
+
+def _transfer(
+    pool, direction, local_path, remote_path, checksum, retries, backoff
+):
+    """
+    Uploads or downloads one file with retries, skipping it when both sides
+    match.
+    Returns:
+        dict: local and remote paths, status ("done", "skipped" or "failed"),
+            bytes, seconds and error.
+    """
+    result = {
+        "local": local_path,
+        "remote": remote_path,
+        "status": "skipped",
+        "bytes": 0,
+        "seconds": 0.0,
+        "error": None,
+    }
+    start = time.monotonic()
+    for attempt in range(1, retries + 1):
+        try:
+            with pool.connection() as sftp:
+                remote_attr = _remote_stat(sftp, remote_path)
+                if direction == "upload":
+                    if _matches(
+                        local_path,
+                        os.stat(local_path),
+                        remote_attr,
+                        sftp,
+                        remote_path,
+                        checksum,
+                    ):
+                        break
+                    _makedirs(sftp, posixpath.dirname(remote_path))
+                    result["bytes"] += _upload_once(
+                        sftp, local_path, remote_path, checksum
+                    )
+                else:
+                    if remote_attr is None:
+                        raise FileNotFoundError(remote_path)
+                    if os.path.exists(local_path) and _matches(
+                        local_path,
+                        os.stat(local_path),
+                        remote_attr,
+                        sftp,
+                        remote_path,
+                        checksum,
+                    ):
+                        break
+                    os.makedirs(
+                        os.path.dirname(local_path) or ".", exist_ok=True
+                    )
+                    result["bytes"] += _download_once(
+                        sftp, remote_path, local_path, remote_attr, checksum
+                    )
+            result["status"] = "done"
+            result["error"] = None
+            break
+        except FileNotFoundError as e:
+            # Retrying does not help
+            result["error"] = f"No such file: {e.filename or e}"
+            result["status"] = "failed"
+            break
+        except (OSError, EOFError, paramiko.SSHException) as e:
+            result["error"] = str(e)
+            print(
+                f"Attempt {attempt}/{retries} to {direction} {local_path} "
+                f"failed: {e}"
+            )
+            if attempt < retries:
+                time.sleep(backoff**attempt)
+    else:
+        result["status"] = "failed"
+    result["seconds"] = time.monotonic() - start
+    return result
+
+
+def _run(pool, direction, pairs, max_workers, checksum, retries, backoff):
+    """
+    Transfers (local, remote) pairs concurrently.
+    Returns:
+        dict: The per-file results and aggregate done, skipped, failed, bytes,
+            seconds and throughput (MB/s).
+    """
+    start = time.monotonic()
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers or pool.size) as executor:
+        futures = [
+            executor.submit(
+                _transfer,
+                pool,
+                direction,
+                local,
+                remote,
+                checksum,
+                retries,
+                backoff,
+            )
+            for local, remote in pairs
+        ]
+        for future in as_completed(futures):
+            res = future.result()
+            results.append(res)
+            if res["status"] == "failed":
+                print(f"Failed to {direction} {res['local']}: {res['error']}")
+    elapsed = time.monotonic() - start
+    total_bytes = sum(r["bytes"] for r in results)
+    summary = {
+        "files": results,
+        "done": sum(r["status"] == "done" for r in results),
+        "skipped": sum(r["status"] == "skipped" for r in results),
+        "failed": sum(r["status"] == "failed" for r in results),
+        "bytes": total_bytes,
+        "seconds": elapsed,
+        "throughput": total_bytes / max(elapsed, 1e-9) / 1e6,
+    }
+    print(
+        f"SFTP {direction}: {summary['done']} files transferred, "
+        f"{summary['skipped']} skipped, "
+        f"{summary['failed']} failed, {total_bytes} bytes in {elapsed:.1f}s "
+        f"({summary['throughput']:.2f} MB/s)"
+    )
+    return summary
+
+
+def upload_tree(
+    local_dir,
+    remote_dir,
+    pool=None,
+    max_workers=None,
+    checksum=False,
+    retries=3,
+    backoff=2,
+):
+    """
+    Uploads a local directory tree to the server over concurrent connections.
+    Files whose remote copy has the same size and mtime, or the same SHA-256
+    with checksum=True, are skipped. Interrupted uploads resume from the
+    remote .part file.
+    Args:
+        local_dir (str): The local directory.
+        remote_dir (str): The remote directory, created if missing.
+        pool (SFTPPool): The connection pool, defaults to the pool from the
+            environment.
+        max_workers (int): The number of concurrent transfers, defaults to the
+            pool size.
+        checksum (bool): Compare SHA-256 checksums instead of size and mtime,
+            and verify resumed transfers.
+        retries (int): Number of attempts per file before giving up.
+        backoff (float): Base of the exponential wait (seconds) between
+            attempts.
+    Returns:
+        dict: The per-file results and aggregate bytes, seconds and throughput
+            (MB/s).
+    """
+    pool = pool or default_pool()
+    pairs = []
+    for root, _, files in os.walk(local_dir):
+        relative = os.path.relpath(root, local_dir)
+        remote_root = (
+            remote_dir
+            if relative == "."
+            else posixpath.join(remote_dir, *relative.split(os.sep))
+        )
+        pairs.extend(
+            (os.path.join(root, name), posixpath.join(remote_root, name))
+            for name in files
+            if not _is_partial(name)
+        )
+    return _run(pool, "upload", pairs, max_workers, checksum, retries, backoff)
+
+
+def _walk_remote(sftp, remote_dir):
+    """Returns the paths of all files below a remote directory."""
+    files = []
+    stack = [remote_dir]
+    while stack:
+        directory = stack.pop()
+        for attr in sftp.listdir_attr(directory):
+            path = posixpath.join(directory, attr.filename)
+            if stat.S_ISDIR(attr.st_mode):
+                stack.append(path)
+            elif not _is_partial(attr.filename):
+                files.append(path)
+    return files
+
+
+def download_tree(
+    remote_dir,
+    local_dir,
+    pool=None,
+    max_workers=None,
+    checksum=False,
+    retries=3,
+    backoff=2,
+):
+    """
+    Downloads a remote directory tree over concurrent connections.
+    Files whose local copy has the same size and mtime, or the same SHA-256
+    with checksum=True, are skipped. Interrupted downloads resume from the
+    local .part file.
+    Args:
+        remote_dir (str): The remote directory.
+        local_dir (str): The local directory, created if missing.
+        pool (SFTPPool): The connection pool, defaults to the pool from the
+            environment.
+        max_workers (int): The number of concurrent transfers, defaults to the
+            pool size.
+        checksum (bool): Compare SHA-256 checksums instead of size and mtime,
+            and verify resumed transfers.
+        retries (int): Number of attempts per file before giving up.
+        backoff (float): Base of the exponential wait (seconds) between
+            attempts.
+    Returns:
+        dict: The per-file results and aggregate bytes, seconds and throughput
+            (MB/s).
+    """
+    pool = pool or default_pool()
+    with pool.connection() as sftp:
+        remote_files = _walk_remote(sftp, remote_dir)
+    pairs = [
+        (
+            os.path.join(
+                local_dir, *posixpath.relpath(path, remote_dir).split("/")
+            ),
+            path,
+        )
+        for path in remote_files
+    ]
+    return _run(
+        pool, "download", pairs, max_workers, checksum, retries, backoff
+    )
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_pool():
+    """Returns the pool for the server in the environment, created on first
+    use.
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = SFTPPool.from_env()
+        return _default
 
 
 def upload(remote_path, local_path):
@@ -19,8 +598,11 @@ def upload(remote_path, local_path):
     Returns:
         str: A message indicating the success of the upload.
     """
-
-    c.upload(remote_path, local_path)
+    result = _transfer(
+        default_pool(), "upload", local_path, remote_path, False, 3, 2
+    )
+    if result["status"] == "failed":
+        raise IOError(f"SFTP upload of {local_path} failed: {result['error']}")
     return "SFTP Upload Success"
 
 
@@ -33,6 +615,11 @@ def download(remote_path, local_path):
     Returns:
         str: A message indicating the download was successful.
     """
-
-    c.download(remote_path, local_path)
+    result = _transfer(
+        default_pool(), "download", local_path, remote_path, False, 3, 2
+    )
+    if result["status"] == "failed":
+        raise IOError(
+            f"SFTP download of {remote_path} failed: {result['error']}"
+        )
     return "SFTP Download Success"
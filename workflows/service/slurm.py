@@ -0,0 +1,571 @@
+import json
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+
+import telemetry
+from service import resources as advisor
+
+ACCOUNT = "project_465001588"
+PARTITION = "standard"
+
+# Modules and environment needed by the R processing scripts on LUMI
+R_MODULES = [
+    "LUMI/23.09",
+    "partition/L",
+    "GDAL",
+    "fontconfig",
+    "FriBidi",
+    "HarfBuzz",
+    "git",
+    "UDUNITS",
+    "libsodium",
+    "GSL",
+    "libarchive/3.6.2-cpeGNU-23.09",
+    "R",
+]
+R_EXPORTS = {"CRAYBLAS_WARN": "0"}
+
+# Job information echoed at the start of every job
+PREAMBLE = """echo "Start time = $(date)"
+echo "Submitting directory = "$SLURM_SUBMIT_DIR
+echo "working directory = "$PWD
+echo "Project name = "$SLURM_JOB_ACCOUNT
+echo "Job id = "$SLURM_JOB_ID
+echo "Job name = "$SLURM_JOB_NAME
+echo "memory per CPU = "$SLURM_MEM_PER_CPU
+echo "Node running the job script = "$SLURMD_NODENAME
+echo "Process ID of the process started for the task = "$SLURM_TASK_PID
+echo "Dependency = "$SLURM_JOB_DEPENDENCY
+echo "Number of nodes assigned to a job = "$SLURM_NNODES
+echo "Number of tasks requested by the job = "$SLURM_NTASKS
+echo "Number of cpus per task = "$SLURM_CPUS_PER_TASK
+"""
+
+# squeue/sacct states after which a job will not run again
+SUCCESS_STATES = {"COMPLETED"}
+FAILED_STATES = {
+    "BOOT_FAIL",
+    "CANCELLED",
+    "DEADLINE",
+    "FAILED",
+    "NODE_FAIL",
+    "OUT_OF_MEMORY",
+    "PREEMPTED",
+    "REVOKED",
+    "TIMEOUT",
+}
+
+# Number of job ids passed to a single squeue/sacct call
+BATCH_SIZE = 500
+
+
+def root_dir():
+    """
+    Returns the repository root every job runs from, set in $ROOT_DIR.
+    Raises:
+        RuntimeError: If ROOT_DIR is not set or is not a directory.
+    """
+    root = os.environ.get("ROOT_DIR")
+    if not root or not os.path.isdir(root):
+        raise RuntimeError(
+            f"ROOT_DIR={root!r} must be set to the repository root, "
+            "the jobs run from it"
+        )
+    return root
+
+
+def render(resources, body, logs_dir, modules=None, exports=None):
+    """
+    Builds a SLURM batch script from a declarative resource spec.
+    Args:
+        resources (dict): sbatch options, e.g. {"jobname": "GBIF", "time":
+            "02:00:00", "mem": "200G"}. Keys use underscores for dashes;
+            "jobname" maps to --job-name.
+        body (str): The commands to run.
+        logs_dir (str): Directory for the job's stdout and stderr files.
+        modules (list): Environment modules to load before the body.
+        exports (dict): Environment variables to export before the body.
+    Returns:
+        str: The batch script.
+    Raises:
+        RuntimeError: If ROOT_DIR is not set, see root_dir().
+    """
+    options = {
+        "account": ACCOUNT,
+        "partition": PARTITION,
+        "output": f"{logs_dir}/%x-%A-%a.out",
+        "error": f"{logs_dir}/%x-%A-%a.err",
+        "chdir": root_dir(),
+    }
+    options.update(resources)
+    lines = ["#!/bin/bash"]
+    for key, value in options.items():
+        if value is None:
+            continue
+        key = "job-name" if key == "jobname" else key.replace("_", "-")
+        lines.append(f"#SBATCH --{key}={value}")
+    lines.append("")
+    lines.append(PREAMBLE)
+    if modules:
+        lines.append(f"module load {' '.join(modules)}")
+    for key, value in (exports or {}).items():
+        lines.append(f"export {key}={value}")
+    lines.append("")
+    lines.append(body)
+    # Keep the exit status of the body so failures reach sacct
+    lines.append("status=$?")
+    lines.append("")
+    lines.append('echo "End of program at `date`"')
+    lines.append("exit $status")
+    return "\n".join(lines) + "\n"
+
+
+def sbatch(script_path, dependency=None):
+    """
+    Submits a batch script with sbatch without waiting for it.
+    Args:
+        script_path (str): Path to the batch script.
+        dependency (str): An sbatch --dependency expression, e.g.
+            "afterok:123:124".
+    Returns:
+        str: The SLURM job id.
+    """
+    command = ["sbatch", "--parsable"]
+    if dependency:
+        command.append(f"--dependency={dependency}")
+    command.append(script_path)
+    result = subprocess.run(
+        command, capture_output=True, text=True, check=True
+    )
+    # --parsable prints "jobid" or "jobid;cluster"
+    return result.stdout.strip().split(";")[0]
+
+
+class SlurmFuture(Future):
+    """A Future resolved with the final SLURM state of a job."""
+
+    def __init__(self, job_id, name=None, resources=None, input_size=None):
+        super().__init__()
+        self.job_id = job_id
+        self.name = name or job_id
+        self.state = "PENDING"
+        self.resources = resources
+        self.input_size = input_size
+
+    def successful(self):
+        """Waits for the job and returns True if it completed."""
+        return self.result() in SUCCESS_STATES
+
+
+class JobTracker:
+    """Tracks submitted jobs by polling squeue and sacct for all of them at
+    once.
+
+    A single background thread polls every poll_interval seconds while jobs
+    are outstanding, so many jobs cost one squeue call per interval.
+    """
+
+    def __init__(self, poll_interval=None, history_path=None):
+        self.poll_interval = poll_interval or float(
+            os.environ.get("SLURM_POLL_INTERVAL", 30)
+        )
+        self.history_path = history_path or advisor.HISTORY_PATH
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def track(self, job_id, name=None, resources=None, input_size=None):
+        """Starts tracking a job and returns its future."""
+        future = SlurmFuture(job_id, name, resources, input_size)
+        with self._lock:
+            self._jobs[job_id] = future
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return future
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._jobs:
+                    self._thread = None
+                    return
+            time.sleep(self.poll_interval)
+            try:
+                self.poll()
+            except (OSError, subprocess.SubprocessError) as e:
+                print(f"Polling SLURM failed, retrying: {e}")
+
+    def poll(self):
+        """Updates the state of every tracked job with batched squeue and sacct
+        calls.
+        """
+        with self._lock:
+            job_ids = list(self._jobs)
+        if not job_ids:
+            return
+        active = {}
+        for i in range(0, len(job_ids), BATCH_SIZE):
+            active.update(_squeue(job_ids[i:i + BATCH_SIZE]))
+        finished = [job_id for job_id in job_ids if job_id not in active]
+        final = {}
+        for i in range(0, len(finished), BATCH_SIZE):
+            final.update(_sacct(finished[i:i + BATCH_SIZE]))
+
+        with self._lock:
+            for job_id, state in active.items():
+                if job_id in self._jobs:
+                    self._jobs[job_id].state = state
+            done = [
+                (self._jobs.pop(job_id), state)
+                for job_id, state in final.items()
+                if job_id in self._jobs
+            ]
+        for future, state in done:
+            future.state = state
+            # Keep the usage history for right-sizing the next submission
+            try:
+                for usage in advisor.record(future, self.history_path):
+                    telemetry.record(
+                        future.name,
+                        kind="slurm",
+                        job_id=usage["job_id"],
+                        state=usage["state"],
+                        wall_s=usage["elapsed_s"],
+                        queue_wait_s=usage["queue_wait_s"],
+                        peak_rss_mb=usage["max_rss_mb"],
+                        cpu_efficiency=usage["cpu_efficiency"],
+                    )
+            except (OSError, subprocess.SubprocessError, ValueError) as e:
+                print(
+                    f"Recording the usage of job {future.job_id} failed: {e}"
+                )
+            future.set_result(state)
+
+
+def _base_id(job_id):
+    """Maps array task ids such as 123_4 or 123_[1-5] to the array job id."""
+    return job_id.split("_")[0].split(".")[0]
+
+
+def _squeue(job_ids):
+    """Returns {job id: state} for the jobs still known to squeue."""
+    result = subprocess.run(
+        ["squeue", "-h", "-o", "%i %T", "-j", ",".join(job_ids)],
+        capture_output=True,
+        text=True,
+    )
+    states = {}
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            states[_base_id(parts[0])] = parts[1]
+    return states
+
+
+def _sacct(job_ids):
+    """Returns {job id: final state} for jobs whose every task has finished.
+
+    For array jobs the state is COMPLETED only if every task completed,
+    otherwise the first failure state. Jobs sacct does not know yet are left
+    out.
+    """
+    result = subprocess.run(
+        [
+            "sacct",
+            "-n",
+            "-P",
+            "-X",
+            "-o",
+            "JobID,State",
+            "-j",
+            ",".join(job_ids),
+        ],
+        capture_output=True,
+        text=True,
+    )
+    tasks = {}
+    for line in result.stdout.splitlines():
+        if "|" not in line:
+            continue
+        job_id, state = line.split("|", 1)
+        # e.g. "CANCELLED by 1234"
+        tasks.setdefault(_base_id(job_id), []).append(
+            state.split()[0] if state else ""
+        )
+    final = {}
+    for job_id, states in tasks.items():
+        if all(s in SUCCESS_STATES | FAILED_STATES for s in states):
+            failed = [s for s in states if s in FAILED_STATES]
+            final[job_id] = failed[0] if failed else "COMPLETED"
+    return final
+
+
+tracker = JobTracker()
+
+
+def submit(
+    resources,
+    body,
+    logs_dir,
+    modules=None,
+    exports=None,
+    dependency=None,
+    input_size=None,
+):
+    """
+    Writes and submits a SLURM job without blocking.
+    The request is checked against the job's usage history first, see
+    service.resources.
+    Args:
+        resources (dict): sbatch options, see render().
+        body (str): The commands to run.
+        logs_dir (str): Directory for the batch script and the job logs.
+        modules (list): Environment modules to load.
+        exports (dict): Environment variables to export.
+        dependency (str): An sbatch --dependency expression.
+        input_size (float): The size of the job's input, e.g. a number of files
+            or bytes, used to scale the request from past runs.
+    Returns:
+        SlurmFuture: Resolved with the final job state once the job has
+            finished.
+    """
+    resources = advisor.right_size(
+        resources, input_size, history_path=tracker.history_path
+    )
+    # Records written by the job belong to the same run
+    exports = {"WORKFLOW_RUN_ID": telemetry.RUN_ID, **(exports or {})}
+    os.makedirs(logs_dir, exist_ok=True)
+    script_path = os.path.join(
+        logs_dir, f"{resources['jobname']}-{time.time_ns()}.slurm"
+    )
+    with open(script_path, "w") as f:
+        f.write(render(resources, body, logs_dir, modules, exports))
+    job_id = sbatch(script_path, dependency)
+    return tracker.track(job_id, resources["jobname"], resources, input_size)
+
+
+def submit_rscript(
+    script_path, logs_dir, resources, dependency=None, input_size=None
+):
+    """
+    Submits an R processing script with the LUMI R environment.
+    Args:
+        script_path (str): Path to the R script to run.
+        logs_dir (str): Path to the directory to store job logs.
+        resources (dict): sbatch options, see render().
+        dependency (str): An sbatch --dependency expression.
+        input_size (float): The size of the job's input.
+    Returns:
+        SlurmFuture: The job future.
+    """
+    return submit(
+        resources,
+        f"Rscript --vanilla {script_path}",
+        logs_dir,
+        modules=R_MODULES,
+        exports=R_EXPORTS,
+        dependency=dependency,
+        input_size=input_size,
+    )
+
+
+def write_shards(items, shard_dir, shards):
+    """
+    Splits a manifest into contiguous shards of nearly equal size, one file per
+    shard.
+    Args:
+        items (list): The manifest entries, e.g. file paths or species names.
+        shard_dir (str): Directory for the shard files shard-<i>.txt.
+        shards (int): The maximum number of shards.
+    Returns:
+        int: The number of shards written.
+    """
+    items = list(items)
+    shards = max(1, min(shards, len(items)))
+    size, extra = divmod(len(items), shards)
+    os.makedirs(shard_dir, exist_ok=True)
+    start = 0
+    for i in range(shards):
+        end = start + size + (1 if i < extra else 0)
+        with open(os.path.join(shard_dir, f"shard-{i}.txt"), "w") as f:
+            f.write("".join(f"{item}\n" for item in items[start:end]))
+        start = end
+    return shards
+
+
+def submit_array(
+    resources,
+    body,
+    items,
+    logs_dir,
+    shards,
+    max_parallel=None,
+    modules=None,
+    exports=None,
+    dependency=None,
+    input_size=None,
+):
+    """
+    Shards a manifest and submits one array job with a task per shard.
+    Every task runs body with SHARD_FILE set to its shard file and SHARD_RESULT
+    to the JSON file it may write its result to, both read back by gather().
+    Args:
+        resources (dict): sbatch options for a single task, see render().
+        body (str): The commands to run for one shard.
+        items (list): The manifest entries.
+        logs_dir (str): Directory for the batch script, the shards and the job
+            logs.
+        shards (int): The maximum number of array tasks.
+        max_parallel (int): The maximum number of tasks running at once (the
+            %max throttle).
+        modules (list): Environment modules to load.
+        exports (dict): Environment variables to export.
+        dependency (str): An sbatch --dependency expression.
+        input_size (float): The input size of a single task, defaults to the
+            number of items per shard.
+    Returns:
+        SlurmFuture: The array job future, with shard_dir and shards
+            attributes.
+    """
+    items = list(items)
+    shard_dir = os.path.join(
+        logs_dir, f"{resources['jobname']}-{time.time_ns()}-shards"
+    )
+    n = write_shards(items, shard_dir, shards)
+    array = f"0-{n - 1}" + (f"%{max_parallel}" if max_parallel else "")
+    exports = {
+        **(exports or {}),
+        "SHARD_FILE": f"{shard_dir}/shard-$SLURM_ARRAY_TASK_ID.txt",
+        "SHARD_RESULT": f"{shard_dir}/result-$SLURM_ARRAY_TASK_ID.json",
+    }
+    # Each task is sized for its own shard
+    if input_size is None:
+        input_size = len(items) / n
+    future = submit(
+        {**resources, "array": array},
+        body,
+        logs_dir,
+        modules,
+        exports,
+        dependency,
+        input_size,
+    )
+    future.shard_dir = shard_dir
+    future.shards = n
+    return future
+
+
+def queued_tasks(user=None, partition=None):
+    """
+    Counts the pending and running jobs of a user, each array task counted
+    separately as it is by the per-user job limits.
+    Args:
+        user (str): The user name, defaults to $USER.
+        partition (str): Only count jobs in this partition.
+    Returns:
+        int: The number of queued jobs and array tasks.
+    """
+    command = [
+        "squeue",
+        "-h",
+        "-r",
+        "-o",
+        "%i",
+        "-u",
+        user or os.environ.get("USER", ""),
+    ]
+    if partition:
+        command += ["-p", partition]
+    result = subprocess.run(
+        command, capture_output=True, text=True, check=True
+    )
+    return len(result.stdout.split())
+
+
+def array_states(job_id):
+    """Returns {task index: final state} of the finished tasks of an array job.
+    """
+    result = subprocess.run(
+        ["sacct", "-n", "-P", "-X", "-o", "JobID,State", "-j", job_id],
+        capture_output=True,
+        text=True,
+    )
+    states = {}
+    for line in result.stdout.splitlines():
+        task_id, _, state = line.partition("|")
+        if "_" in task_id and task_id.split("_")[1].isdigit():
+            states[int(task_id.split("_")[1])] = (
+                state.split()[0] if state else ""
+            )
+    return states
+
+
+def gather(future, label):
+    """
+    Waits for an array job and collects the outcome of every shard.
+    Args:
+        future (SlurmFuture): The future returned by submit_array().
+        label (str): The job description used in the messages.
+    Returns:
+        dict: {"state", "shards", "completed": [task ids], "failed": {task id:
+            state}, "results": {task id: the JSON written to SHARD_RESULT}}.
+    """
+    state = future.result()
+    states = array_states(future.job_id)
+    summary = {
+        "state": state,
+        "shards": future.shards,
+        "completed": [],
+        "failed": {},
+        "results": {},
+    }
+    for i in range(future.shards):
+        task_state = states.get(i, "UNKNOWN")
+        if task_state in SUCCESS_STATES:
+            summary["completed"].append(i)
+        else:
+            summary["failed"][i] = task_state
+        result_path = os.path.join(future.shard_dir, f"result-{i}.json")
+        if os.path.exists(result_path):
+            with open(result_path) as f:
+                summary["results"][i] = json.load(f)
+    with open(os.path.join(future.shard_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    print(
+        f"{label}: {len(summary['completed'])}/{future.shards} shards "
+        "completed"
+    )
+    for i, task_state in summary["failed"].items():
+        print(f"{label}: shard {i} {task_state}")
+    return summary
+
+
+def finish(future, label):
+    """
+    Waits for a job and reports its outcome.
+    Args:
+        future (SlurmFuture): The job future.
+        label (str): The job description used in the messages, e.g. "GBIF job".
+    Returns:
+        bool: True if the job completed, False otherwise.
+    """
+    if future.successful():
+        print(f"{label} done!")
+        return True
+    print(f"{label} failed!")
+    return False
+
+
+def wait_all(futures):
+    """
+    Waits for several jobs running concurrently on the cluster.
+    Args:
+        futures (dict): {label: SlurmFuture}.
+    Returns:
+        dict: {label: True if the job completed}.
+    """
+    return {label: finish(future, label) for label, future in futures.items()}
@@ -0,0 +1,247 @@
+"""State of the Hmsc chain fits prepared by IASDT.R::Mod_Prep4HPC.
+
+Mod_Prep4HPC writes one command per chain to Commands_All.txt. This module
+reads those commands, checks which chain posteriors are on disk and resubmits
+only the missing ones as an array job. Every model then gets a merge job of
+its own chains that depends on their array tasks, so it starts as soon as that
+model is complete instead of after the whole batch.
+"""
+
+import os
+import re
+import shlex
+
+from service.model import CHAIN_RESOURCES, MERGE_RESOURCES
+from service.slurm import (
+    R_EXPORTS,
+    R_MODULES,
+    finish,
+    gather,
+    submit,
+    submit_array,
+)
+
+COMMANDS_FILE = "Commands_All.txt"
+MERGE_SCRIPT = "workflows/state/mergeChains.R"
+
+CHAIN_PATTERN = re.compile(r"_Chain(\d+)")
+
+# Array task body running the chain commands of its shard
+CHAIN_BODY = """status=0
+while IFS= read -r cmd; do
+    eval "$cmd" || status=1
+done < "$SHARD_FILE"
+test $status -eq 0"""
+
+
+def parse_commands(commands_path):
+    """
+    Reads the chain commands of a commands file.
+    Args:
+        commands_path (str): A file with one Hmsc-HPC command per line, e.g.
+            Commands_All.txt.
+    Returns:
+        list: One dict per chain with "command", "input", "output", "model",
+            "chain" and the command's "options".
+    """
+    chains = []
+    with open(commands_path) as f:
+        for line in f:
+            command = line.strip()
+            if not command or command.startswith("#"):
+                continue
+            args = shlex.split(command)
+            options = {}
+            for i, arg in enumerate(args[:-1]):
+                if arg.startswith("--"):
+                    options[arg[2:]] = args[i + 1]
+            if "output" not in options:
+                raise ValueError(f"No --output in command: {command}")
+            output = options["output"]
+            name = os.path.basename(output)
+            match = CHAIN_PATTERN.search(name)
+            if match:
+                model, chain = name[: match.start()], int(match.group(1))
+            else:
+                model, chain = (
+                    os.path.splitext(name)[0],
+                    int(options.get("chain", 0)) + 1,
+                )
+            chains.append(
+                {
+                    "command": command,
+                    "input": options.get("input"),
+                    "output": output,
+                    "model": model,
+                    "chain": chain,
+                    "options": options,
+                }
+            )
+    return chains
+
+
+def is_fitted(chain, root="."):
+    """
+    Checks whether the posterior of a chain is complete on disk.
+    A chain counts as fitted when its output exists, is not empty and is not
+    older than the model input it was fitted from.
+    Args:
+        chain (dict): A chain from parse_commands().
+        root (str): The directory the command paths are relative to.
+    Returns:
+        bool: True if the chain does not need to be fitted again.
+    """
+    output = os.path.join(root, chain["output"])
+    if not os.path.exists(output) or os.path.getsize(output) == 0:
+        return False
+    if chain["input"]:
+        input_path = os.path.join(root, chain["input"])
+        if os.path.exists(input_path) and os.path.getmtime(
+            output
+        ) < os.path.getmtime(input_path):
+            return False
+    return True
+
+
+def check(commands_path, root="."):
+    """
+    Reports which chains and models are fitted.
+    Args:
+        commands_path (str): The commands file of a model directory.
+        root (str): The directory the command paths are relative to.
+    Returns:
+        dict: {"chains": the parsed chains with a "fitted" flag, "complete":
+            models with every chain fitted, "missing": {model: [chain
+            numbers]}}.
+    """
+    chains = parse_commands(commands_path)
+    status = {"chains": chains, "complete": [], "missing": {}}
+    for chain in chains:
+        chain["fitted"] = is_fitted(chain, root)
+        if not chain["fitted"]:
+            status["missing"].setdefault(chain["model"], []).append(
+                chain["chain"]
+            )
+    models = dict.fromkeys(chain["model"] for chain in chains)
+    status["complete"] = [
+        model for model in models if model not in status["missing"]
+    ]
+    name = os.path.basename(os.path.dirname(os.path.abspath(commands_path)))
+    fitted = sum(chain["fitted"] for chain in chains)
+    print(
+        f"{name}: {fitted}/{len(chains)} chains fitted, "
+        f"{len(status['complete'])}/{len(models)} models complete"
+    )
+    return status
+
+
+def submit_merge(model_dir, logs_dir, dependency=None, models=None):
+    """
+    Submits the merge job of a model directory after the given dependency.
+    Args:
+        model_dir (str): The model directory, relative to the jobs' working
+            directory.
+        logs_dir (str): Path to the directory to store job logs.
+        dependency (str): An sbatch --dependency expression.
+        models (list): The models to merge, every fitted model of the directory
+            by default.
+    Returns:
+        SlurmFuture: The merge job future.
+    """
+    # singleton keeps the merges of one directory from running at the same time
+    resources = dict(
+        MERGE_RESOURCES,
+        jobname=f"{MERGE_RESOURCES['jobname']}_{os.path.basename(model_dir)}",
+    )
+    dependency = f"{dependency},singleton" if dependency else "singleton"
+    if "afterok" in dependency:
+        resources["kill_on_invalid_dep"] = "yes"
+    return submit(
+        resources,
+        shlex.join(
+            ["Rscript", "--vanilla", MERGE_SCRIPT, model_dir, *(models or [])]
+        ),
+        logs_dir,
+        modules=R_MODULES,
+        exports=R_EXPORTS,
+        dependency=dependency,
+    )
+
+
+def refit(
+    commands_path,
+    logs_dir,
+    root=".",
+    max_parallel=None,
+    merge=True,
+    dry_run=False,
+    wait=True,
+):
+    """
+    Resubmits the missing chains of a model directory and merges each model
+    once it is complete.
+    Args:
+        commands_path (str): The commands file, usually <model
+            dir>/Commands_All.txt.
+        logs_dir (str): Path to the directory to store job logs and shards.
+        root (str): The directory the command paths are relative to, the jobs'
+            working directory.
+        max_parallel (int): The maximum number of chains running at once.
+        merge (bool): Submit the merge jobs.
+        dry_run (bool): Only report the missing chains.
+        wait (bool): Block until the chains and merges have finished.
+    Returns:
+        dict: The check() status with "chains_job" and "merge_jobs" {model:
+            SlurmFuture} when jobs were submitted.
+    """
+    status = check(commands_path, root)
+    missing = [chain for chain in status["chains"] if not chain["fitted"]]
+    for model, numbers in status["missing"].items():
+        print(f"{model}: refitting chains {', '.join(map(str, numbers))}")
+    if dry_run:
+        return status
+
+    model_dir = os.path.relpath(
+        os.path.dirname(os.path.abspath(commands_path)), os.path.abspath(root)
+    )
+    status["chains_job"] = None
+    status["merge_jobs"] = {}
+    if missing:
+        # One chain per array task, so a model's merge can wait for its own
+        # tasks only
+        future = submit_array(
+            CHAIN_RESOURCES,
+            CHAIN_BODY,
+            [c["command"] for c in missing],
+            logs_dir,
+            len(missing),
+            max_parallel,
+        )
+        status["chains_job"] = future
+        print(f"{len(missing)} chains submitted as array job {future.job_id}")
+        if merge:
+            for model in status["missing"]:
+                tasks = [
+                    i
+                    for i, chain in enumerate(missing)
+                    if chain["model"] == model
+                ]
+                dependency = "afterok:" + ":".join(
+                    f"{future.job_id}_{i}" for i in tasks
+                )
+                status["merge_jobs"][model] = submit_merge(
+                    model_dir, logs_dir, dependency, [model]
+                )
+    if merge and status["complete"]:
+        status["merge_jobs"]["complete"] = submit_merge(
+            model_dir, logs_dir, None, status["complete"]
+        )
+
+    if wait:
+        if status["chains_job"] is not None:
+            status["summary"] = gather(
+                status["chains_job"], "Hmsc chain refit"
+            )
+        for model, future in status["merge_jobs"].items():
+            finish(future, f"Merging {model}")
+    return status
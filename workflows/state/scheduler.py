@@ -0,0 +1,322 @@
+"""Rolling submission of Hmsc chains under the per-user job limit.
+
+Mod_Prep4HPC splits the chain commands into files of at most 210 commands,
+the small-g limit of queued jobs per user, and leaves their submission to us.
+This scheduler reads every Commands_All.txt under a model directory, orders
+the unfitted chains by estimated cost, longest first, and keeps the queue
+filled up to the limit: whenever earlier tasks finish, the next chains are
+submitted as a new array job. Each model is merged once all its chains are in;
+the merges run on the partition of MERGE_RESOURCES, the default one unless it
+names another, and are counted against the queue of that partition.
+"""
+
+import glob
+import os
+import subprocess
+import time
+
+from service.model import CHAIN_RESOURCES, MERGE_RESOURCES, MODEL_DIR
+from service.slurm import (
+    FAILED_STATES,
+    PARTITION,
+    SUCCESS_STATES,
+    array_states,
+    gather,
+    queued_tasks,
+    submit_array,
+    tracker,
+)
+from state.chains import (
+    CHAIN_BODY,
+    COMMANDS_FILE,
+    check,
+    is_fitted,
+    submit_merge,
+)
+
+JOB_LIMIT = 210
+# Smallest array worth submitting while more chains are waiting
+MIN_BATCH = 10
+# Times a merge rejected by sbatch is submitted again before giving up
+MERGE_RETRIES = 3
+# The partition the merges run on, counted separately from the chains'
+MERGE_PARTITION = MERGE_RESOURCES.get("partition", PARTITION)
+
+
+def collect(model_root=MODEL_DIR, root="."):
+    """
+    Reads the unfitted chains of every model directory under model_root.
+    Args:
+        model_root (str): The directory holding the model directories, each
+            with a Commands_All.txt.
+        root (str): The directory the command paths are relative to.
+    Returns:
+        list: The unfitted chains from parse_commands(), each with its
+            "model_dir".
+    """
+    chains = []
+    pattern = os.path.join(root, model_root, "**", COMMANDS_FILE)
+    for commands_path in sorted(glob.glob(pattern, recursive=True)):
+        model_dir = os.path.relpath(os.path.dirname(commands_path), root)
+        for chain in check(commands_path, root)["chains"]:
+            if not chain["fitted"]:
+                chains.append(dict(chain, model_dir=model_dir))
+    return chains
+
+
+def chain_cost(chain, root="."):
+    """
+    Estimates the relative cost of fitting a chain.
+    The number of Gibbs iterations (transient + samples * thin) times the size
+    of the model input, which grows with the number of species and sites.
+    Args:
+        chain (dict): A chain from parse_commands().
+        root (str): The directory the command paths are relative to.
+    Returns:
+        float: The estimated cost.
+    """
+    options = chain["options"]
+    iterations = int(options.get("transient", 0)) + int(
+        options.get("samples", 1)
+    ) * int(options.get("thin", 1))
+    size = 1
+    if chain["input"] and os.path.exists(os.path.join(root, chain["input"])):
+        size = os.path.getsize(os.path.join(root, chain["input"])) or 1
+    return iterations * size
+
+
+def take_batch(queue, free, remaining, merge=True):
+    """
+    Splits off the chains that fit in the free slots together with the merges
+    they complete.
+    Args:
+        queue (list): The chains waiting, in submission order.
+        free (int): The number of jobs that may still be queued.
+        remaining (dict): {(model_dir, model): number of chains not submitted
+            yet}.
+        merge (bool): Count a slot for the merge of every model the batch
+            completes.
+    Returns:
+        tuple: (batch, rest of the queue).
+    """
+    left = dict(remaining)
+    used = 0
+    taken = 0
+    for chain in queue:
+        key = (chain["model_dir"], chain["model"])
+        needed = 1 + (1 if merge and left[key] == 1 else 0)
+        if used + needed > free:
+            break
+        used += needed
+        taken += 1
+        left[key] -= 1
+    return queue[:taken], queue[taken:]
+
+
+def merge_dependency(tasks, root="."):
+    """
+    Builds the afterok dependency of a model's merge from the array tasks of
+    its chains.
+    Tasks that already finished may have left the controller, where sbatch
+    rejects a dependency on them, so they are looked up in sacct and left out.
+    Args:
+        tasks (list): (array task id such as 123_4, chain) pairs.
+        root (str): The directory the command paths are relative to.
+    Returns:
+        tuple: (the dependency, None when every task completed; the task ids
+            that failed).
+    """
+    states = {}
+    waiting, failed = [], []
+    for task, chain in tasks:
+        job_id, index = task.split("_")
+        if job_id not in states:
+            states[job_id] = array_states(job_id)
+        state = states[job_id].get(int(index))
+        if state in FAILED_STATES:
+            failed.append(task)
+        elif state not in SUCCESS_STATES and not is_fitted(chain, root):
+            waiting.append(task)
+    return ("afterok:" + ":".join(waiting) if waiting else None), failed
+
+
+def _submit_merges(pending, submitted, result, logs_dir, root, free):
+    """Submits the pending merges that fit in the free slots, keeping rejected
+    ones for a retry.
+    """
+    count = 0
+    for key in list(pending):
+        if count >= free:
+            break
+        dependency, failed = merge_dependency(submitted[key], root)
+        if failed:
+            print(
+                f"Not merging {key[1]}: chain tasks {', '.join(failed)} failed"
+            )
+            result["failed"][key[1]] = failed
+            del pending[key]
+            continue
+        try:
+            result["merges"][key[1]] = submit_merge(
+                key[0], logs_dir, dependency, [key[1]]
+            )
+        except subprocess.CalledProcessError as e:
+            pending[key] += 1
+            if pending[key] > MERGE_RETRIES:
+                raise RuntimeError(
+                    f"Submitting the merge of {key[1]} failed {pending[key]} "
+                    f"times: {e.stderr}"
+                ) from e
+            print(
+                f"Submitting the merge of {key[1]} failed, retrying: "
+                f"{e.stderr}"
+            )
+            continue
+        del pending[key]
+        count += 1
+    return count
+
+
+def _merge_round(pending, submitted, result, logs_dir, root, free, limit):
+    """
+    Submits the pending merges that fit in the queue of their partition.
+    Args:
+        free (int): The free slots of the chains' partition, None when the
+            merges run on another partition.
+        limit (int): The maximum number of queued jobs in that other
+            partition.
+    Returns:
+        int: The number of slots the merges took in the chains' partition.
+    """
+    if free is not None:
+        return _submit_merges(pending, submitted, result, logs_dir, root, free)
+    if pending:
+        _submit_merges(
+            pending,
+            submitted,
+            result,
+            logs_dir,
+            root,
+            limit - queued_tasks(partition=MERGE_PARTITION),
+        )
+    return 0
+
+
+def schedule(
+    model_root=MODEL_DIR,
+    logs_dir="../logs",
+    root=".",
+    limit=JOB_LIMIT,
+    min_batch=MIN_BATCH,
+    partition=CHAIN_RESOURCES["partition"],
+    merge=True,
+    merge_limit=JOB_LIMIT,
+    dry_run=False,
+    wait=True,
+):
+    """
+    Fits every unfitted chain with a rolling window of array jobs.
+    Merges count against the queue of the partition they run on: when that is
+    the chains' partition, every batch leaves a slot for the merge of each
+    model it completes. A merge sbatch rejects is retried on the next round, up
+    to MERGE_RETRIES times.
+    Args:
+        model_root (str): The directory holding the model directories.
+        logs_dir (str): Path to the directory to store job logs and shards.
+        root (str): The directory the command paths are relative to, the jobs'
+            working directory.
+        limit (int): The maximum number of queued jobs and array tasks in the
+            partition.
+        min_batch (int): The smallest array submitted while more chains are
+            waiting.
+        partition (str): The partition whose queue counts against the limit.
+        merge (bool): Submit a merge job for each model once all its chains are
+            submitted.
+        merge_limit (int): The maximum number of queued jobs in the partition
+            of the merges, when it is not the chains' partition.
+        dry_run (bool): Only print the planned order.
+        wait (bool): Block until the last array job has finished.
+    Returns:
+        dict: {"chains": number of chains, "arrays": [SlurmFuture], "merges":
+            {model: SlurmFuture}, "failed": {model: failed chain tasks, not
+            merged}, "summaries": per-array gather() summaries when waiting}.
+    Raises:
+        RuntimeError: If a merge is still rejected after MERGE_RETRIES retries.
+    """
+    queue = sorted(
+        collect(model_root, root),
+        key=lambda chain: chain_cost(chain, root),
+        reverse=True,
+    )
+    result = {
+        "chains": len(queue),
+        "arrays": [],
+        "merges": {},
+        "failed": {},
+        "summaries": [],
+    }
+    print(
+        f"{len(queue)} chains to fit with at most {limit} queued in "
+        f"{partition}"
+    )
+    if dry_run:
+        for chain in queue:
+            print(
+                f"{chain['model_dir']}/{chain['model']} chain "
+                f"{chain['chain']}: cost {chain_cost(chain, root):.3g}"
+            )
+        return result
+
+    remaining = {}
+    for chain in queue:
+        key = (chain["model_dir"], chain["model"])
+        remaining[key] = remaining.get(key, 0) + 1
+    submitted = {}
+    # {(model_dir, model): failed submissions} of the models ready to merge
+    pending = {}
+    shared = MERGE_PARTITION == partition
+    while queue or pending:
+        free = limit - queued_tasks(partition=partition)
+        free -= _merge_round(
+            pending,
+            submitted,
+            result,
+            logs_dir,
+            root,
+            free if shared else None,
+            merge_limit,
+        )
+        batch, rest = take_batch(queue, free, remaining, merge and shared)
+        if not batch or len(batch) < min(min_batch, len(queue)):
+            if queue or pending:
+                time.sleep(tracker.poll_interval)
+            continue
+        queue = rest
+        future = submit_array(
+            CHAIN_RESOURCES,
+            CHAIN_BODY,
+            [c["command"] for c in batch],
+            logs_dir,
+            len(batch),
+        )
+        result["arrays"].append(future)
+        print(
+            f"{len(batch)} chains submitted as array job {future.job_id}, "
+            f"{len(queue)} waiting"
+        )
+
+        for i, chain in enumerate(batch):
+            key = (chain["model_dir"], chain["model"])
+            submitted.setdefault(key, []).append(
+                (f"{future.job_id}_{i}", chain)
+            )
+            remaining[key] -= 1
+            if merge and not remaining[key]:
+                pending[key] = 0
+
+    if wait:
+        result["summaries"] = [
+            gather(future, f"Hmsc chains {future.job_id}")
+            for future in result["arrays"]
+        ]
+    return result
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Run telemetry for the workflow stages.
+
+Every stage appends one JSON line to ``../logs/telemetry.jsonl`` with its
+wall time, bytes downloaded and written, file counts and the peak RSS of the
+process and its workers. SLURM jobs are recorded when they finish with their
+job id, queue wait and run time. All records of one run share a run id, which
+is passed on to the SLURM jobs through WORKFLOW_RUN_ID.
+
+Compare two runs from the workflows directory with:
+
+    python telemetry.py [base run id] [new run id]
+"""
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+TELEMETRY_PATH = os.environ.get(
+    "WORKFLOW_TELEMETRY", "../logs/telemetry.jsonl"
+)
+# The PID keeps runs started within the same second apart
+RUN_ID = (
+    os.environ.get("WORKFLOW_RUN_ID")
+    or f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+)
+os.environ["WORKFLOW_RUN_ID"] = RUN_ID
+
+# Relative change above which a stage is reported as a regression
+THRESHOLD = 0.2
+
+_lock = threading.Lock()
+
+
+def _own_peak_kb():
+    """Returns the peak resident memory of this process since the last reset,
+    in KB.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux and is never reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _children_peak_kb():
+    """Returns the largest peak resident memory of the finished children, in
+    KB.
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident memory of this process, on Linux 4.0 and later.
+    :return: True if the peak was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Returns the peak resident memory of this process and of its finished
+    children, in MB.
+    """
+    return max(_own_peak_kb(), _children_peak_kb()) / 1024
+
+
+def record(stage, path=None, **fields):
+    """
+    Appends a telemetry record.
+    :param stage: The stage name, e.g. "chelsa.intaker".
+    :param path: The JSON lines file, defaults to TELEMETRY_PATH.
+    :param fields: The measurements.
+    """
+    entry = {"run_id": RUN_ID, "stage": stage, "time": time.time(), **fields}
+    path = path or TELEMETRY_PATH
+    with _lock:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+    return entry
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """Times a stage and records it, yielding a dict for the stage's own
+    measurements.
+
+    Example:
+        with stage("chelsa.convert2nc") as metrics:
+            metrics["files"] = len(paths)
+
+    The peak RSS is that of the process during the stage where the kernel
+    allows resetting it, peak_rss_scope is "process" where it does not.
+    The kernel keeps only the largest peak of all finished children, so
+    children_peak_rss_mb is recorded only when a child finished during the
+    stage has raised it.
+    """
+    metrics = dict(fields)
+    scope = "stage" if reset_peak_rss() else "process"
+    children_before = _children_peak_kb()
+    start = time.time()
+    status = "ok"
+    try:
+        yield metrics
+    except BaseException as e:
+        status = "error"
+        metrics["error"] = repr(e)
+        raise
+    finally:
+        own = _own_peak_kb()
+        children = _children_peak_kb()
+        children = children if children > children_before else None
+        record(
+            name,
+            kind="stage",
+            status=status,
+            wall_s=time.time() - start,
+            peak_rss_mb=max(own, children or 0) / 1024,
+            peak_rss_scope=scope,
+            children_peak_rss_mb=children and children / 1024,
+            **metrics,
+        )
+
+
+def tree_bytes(path):
+    """Returns the size in bytes of a file or of all files under a directory.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+
+def load(path=None):
+    """Reads all telemetry records."""
+    path = path or TELEMETRY_PATH
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(records, run_id):
+    """
+    Aggregates the records of a run per stage.
+    Returns:
+        dict of stage -> {"count", "wall_s", "queue_wait_s",
+        "bytes_downloaded", "bytes_written", "files", "peak_rss_mb"}, with
+        sums, except peak_rss_mb which is the maximum.
+    """
+    summary = {}
+    for entry in records:
+        if entry["run_id"] != run_id:
+            continue
+        row = summary.setdefault(
+            entry["stage"], {"count": 0, "peak_rss_mb": 0.0}
+        )
+        row["count"] += 1
+        for key in (
+            "wall_s",
+            "queue_wait_s",
+            "bytes_downloaded",
+            "bytes_written",
+            "files",
+        ):
+            if entry.get(key) is not None:
+                row[key] = row.get(key, 0) + entry[key]
+        row["peak_rss_mb"] = max(
+            row["peak_rss_mb"], entry.get("peak_rss_mb") or 0
+        )
+    return summary
+
+
+def compare(base, new, threshold=THRESHOLD, path=None):
+    """
+    Compares the stages of two runs.
+    :param base: The reference run id.
+    :param new: The run id to check.
+    :param threshold: The relative increase of wall time or peak RSS reported
+        as a regression.
+
+    Returns:
+        list of {"stage", "metric", "base", "new", "change", "regression"}
+        rows.
+    """
+    records = load(path)
+    old, current = summarize(records, base), summarize(records, new)
+    rows = []
+    for name in sorted(old.keys() | current.keys()):
+        for metric in (
+            "wall_s",
+            "queue_wait_s",
+            "peak_rss_mb",
+            "bytes_written",
+            "bytes_downloaded",
+        ):
+            a = old.get(name, {}).get(metric)
+            b = current.get(name, {}).get(metric)
+            if a is None and b is None:
+                continue
+            change = (b - a) / a if a and b is not None else None
+            rows.append(
+                {
+                    "stage": name,
+                    "metric": metric,
+                    "base": a,
+                    "new": b,
+                    "change": change,
+                    "regression": metric in ("wall_s", "peak_rss_mb")
+                    and change is not None
+                    and change > threshold,
+                }
+            )
+    return rows
+
+
+def runs(path=None):
+    """Returns the run ids in the order they first appear."""
+    return list(dict.fromkeys(entry["run_id"] for entry in load(path)))
+
+
+if __name__ == "__main__":
+    known = runs()
+    if len(sys.argv) > 2:
+        base, new = sys.argv[1], sys.argv[2]
+    elif len(known) >= 2:
+        base, new = known[-2], known[-1]
+    else:
+        sys.exit("Need two runs to compare")
+    print(f"{base} -> {new}")
+    print(
+        f"{'stage':<28} {'metric':<17} {'base':>12} {'new':>12} {'change':>8}"
+    )
+
+    def fmt(value):
+        return f"{value:>12.2f}" if value is not None else f"{'-':>12}"
+
+    for row in compare(base, new):
+        change = (
+            f"{row['change']:>+8.0%}"
+            if row["change"] is not None
+            else f"{'-':>8}"
+        )
+        flag = "  REGRESSION" if row["regression"] else ""
+        print(
+            f"{row['stage']:<28} {row['metric']:<17} {fmt(row['base'])} "
+            f"{fmt(row['new'])} {change}{flag}"
+        )